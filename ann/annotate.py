@@ -10,7 +10,12 @@
 ##
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
+import bisect
+
+import cache as rc
 import file_utils as fu
+import lookup
+import pipeline
 import utils as u
 
 indicesKnownGenes = [12, 1, 3]  # 12 for gene
@@ -90,27 +95,9 @@ def collapseRefSeq(line):
     return ";".join(collapsed)
 
 
-def binarySearchUniqueAndSorted(arg0, key):
-    low = 0
-    high = len(arg0) - 1
-    mid = 0
-    obj = 0
-
-    while low <= high:
-        mid = (low + high) / 2
-        obj = arg0[mid]
-
-        if obj < key:
-            low = mid + 1
-        elif obj > key:
-            high = mid - 1
-        else:
-            return mid
-
-    return -1  # NOT_FOUND
-
-
 """Cleans characters not accepted by MySQL
+   Values are now passed as statement parameters; the quotes are still
+   stripped so that records match as they always have
 """
 
 
@@ -147,495 +134,919 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""Chromosome naming differs between reference tables;
+   some tables have no "chr" preceeding the number
 """
 
 
-def getSnpsFromDbSnp(
-    vcf, format="vcf", tmpextin="", tmpextout=".1", varclass="SNV", sep="\t"
-):
+def stripChromPrefix(chr):
+    if chr.startswith("chr"):
+        chr = chr.replace("chr", "")
+    return chr
 
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + ".count.log"
-    fh_log = open(logcountfile, "w")
-    var_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = (
-                'select * from dbSNP where CHR="'
-                + str(chr)
-                + '" AND POS='
-                + str(pos)
-                + ' AND ( REF="'
-                + str(ref)
-                + '" OR REF ="'
-                + str(compRef)
-                + '" )  AND INFO = "'
-                + varclass
-                + '" ;'
-            )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
 
-            fields[2] = "."
-            rsids = []
-            mafs = []
-            if len(rows) > 0:
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if str(row[7]) != ".":
-                        mafs.append("GMAF=" + str(row[7]))
+def addChromPrefix(chr):
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
+    return chr
 
-                maf_str = ""
-                if len(mafs) > 0:
-                    maf_str = ";" + ";".join([str(x) for x in mafs])
 
-                var_count = var_count + 1
-                if str(fields[7]) == ".":
-                    fields[7] = "DB" + maf_str
-                else:
-                    fields[7] = fields[7] + ";DB;VC=" + varclass + maf_str
+"""Base class for annotation stages
+   A stage looks up one record in the reference database (fetch) and
+   folds the result into the record fields (apply). Stages are driven
+   by pipeline.run, which parses every record only once.
+   inputs are the record columns fetch reads and outputs the columns
+   apply writes; pipeline.schedule uses them to run the lookups of
+   independent stages concurrently. Since a lookup only depends on its
+   inputs, its result can be reused for records repeating a site
+   (cache.SiteMemo) and kept across jobs (cache.ResultCache).
+   Stages that offer several lookups list them in modes; the planner
+   (planner.py) can pick one for the job, given to the stage as a plan
+   in place of its mode
+"""
 
-                fields[2] = str(";".join(rsids))
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
+# Record columns by name, as positions in the format specific indices
+COLUMNS = {"CHROM": 0, "POS": 1, "REF": 2, "ALT": 3}
+
+
+class Stage(object):
+    label = "stage"
+    countkeys = ("var_count", "line_count")
+    logmode = "a"
+    inputs = ("CHROM", "POS")
+    outputs = ("INFO",)
+    # Lookup modes the planner may choose from, cheapest to set up first,
+    # and whether it may choose one for each chromosome
+    modes = ()
+    planChroms = False
+
+    def __init__(self, format="vcf", table=None):
+        self.format = format
+        self.table = table
+        self.inds = getFormatSpecificIndices(format=format)
+        self.counts = dict.fromkeys(self.countkeys, 0)
+        self.conn = None
+        self.cursor = None
+        self.snapshot = None
+        self.cache = None
+        self.memo = None
+        self.plan = None
+
+    # A mode may be given as a plan (planner.StagePlan); the stage keeps
+    # the plan for the count log and uses the mode it picked overall
+    def useMode(self, mode):
+        if isinstance(mode, str):
+            return mode
+        self.plan = mode
+        return mode.default
+
+    def isHeader(self, line):
+        return (
+            line.startswith("##")
+            or line.startswith("CHROM")
+            or line.startswith("#CHROM")
+        )
+
+    # Reads from the snapshot when one is given, else from the database
+    # through a connection borrowed from the process-wide pool. dedup is
+    # the number of sites remembered for records that repeat a site
+    def open(self, snapshot=None, cache=None, dedup=0):
+        self.snapshot = snapshot
+        self.cache = cache
+        if cache is not None:
+            self.counts.setdefault("cache_hits", 0)
+            self.counts.setdefault("cache_misses", 0)
+        if dedup > 0:
+            self.memo = rc.SiteMemo(dedup)
+            self.counts.setdefault("dedup_records", 0)
+            self.counts.setdefault("dedup_reused", 0)
+        if snapshot is None:
+            self.conn = u.getPool().acquire()
+            self.cursor = self.conn.cursor()
+
+    def close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+        if self.conn is not None:
+            u.getPool().release(self.conn)
+        self.conn = None
+        self.cursor = None
+        self.snapshot = None
+        self.cache = None
+        self.memo = None
+
+    def fetch(self, fields):
+        return None
+
+    def apply(self, fields, result):
+        pass
+
+    # Stages that can look up many records at once override this
+    def fetchBatch(self, batch):
+        return [self.fetch(fields) for fields in batch]
+
+    def annotate(self, fields):
+        self.apply(fields, self.fetch(fields))
+
+    def annotateBatch(self, batch):
+        for fields, result in zip(batch, self.lookupBatch(batch)):
+            self.apply(fields, result)
+
+    # What, besides the inputs, the result of a lookup depends on
+    def cacheKey(self):
+        return [type(self).__name__, str(self.table)]
+
+    def siteKey(self, fields):
+        return "\t".join(
+            self.cacheKey()
+            + [fields[self.inds[COLUMNS[name]]].strip() for name in self.inputs]
+        )
+
+    # fetchBatch, looking up each site once: records repeating a site
+    # reuse its result, and the cache answers what it can
+    def lookupBatch(self, batch):
+        if self.cache is None and self.memo is None:
+            return self.fetchBatch(batch)
+
+        results = [None] * len(batch)
+        # key -> (site, positions in batch) of the sites still to look up
+        pending = {}
+        for i, fields in enumerate(batch):
+            key = self.siteKey(fields)
+            site = (
+                fields[self.inds[0]].strip(),
+                int(fields[self.inds[1]].strip()),
+            )
+            if self.memo is not None:
+                self.memo.advance(*site)
+                found, result = self.memo.get(key)
+                if found:
+                    results[i] = result
+                    continue
+            pending.setdefault(key, (site, []))[1].append(i)
+
+        if self.memo is not None:
+            self.counts["dedup_records"] += len(batch)
+            self.counts["dedup_reused"] += len(batch) - len(pending)
+
+        keys = list(pending)
+        found = {}
+        if self.cache is not None:
+            # Cached results are only valid for the same reference data
+            versioned = dict((self.cache.version + "\t" + key, key) for key in keys)
+            for key, result in self.cache.get(list(versioned)).items():
+                found[versioned[key]] = result
+            self.counts["cache_hits"] += len(found)
+            self.counts["cache_misses"] += len(keys) - len(found)
+
+        missing = [key for key in keys if key not in found]
+        if len(missing) > 0:
+            fetched = self.fetchBatch([batch[pending[key][1][0]] for key in missing])
+            found.update(zip(missing, fetched))
+            if self.cache is not None:
+                self.cache.put(
+                    [
+                        (self.cache.version + "\t" + key, result)
+                        for key, result in zip(missing, fetched)
+                    ]
+                )
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write("\t".join([str(x) for x in fields]) + "\n")
+        for key in keys:
+            site, positions = pending[key]
+            for i in positions:
+                results[i] = found[key]
+            if self.memo is not None:
+                self.memo.put(key, site, found[key])
+        return results
+
+    def writeLog(self, fh_log):
+        fh_log.write(
+            f"In {str(self.table)}: {str(self.counts['var_count'])} in "
+            + f"{str(self.counts['line_count'])} variants\n"
+        )
+
+
+"""Base class for stages that overlap the variant position with the
+   [startName, endName] intervals of a reference table
+   mode selects the lookup: "query" sends one SELECT per variant,
+   "sweep" loads each chromosome once and sweeps it, "index" loads each
+   chromosome once into an in-memory interval index, "window" prefetches
+   the rows of a stretch of the chromosome at a time, "batch" sends the
+   variants of a batch with one SELECT (see lookup.py); a plan picks
+   one of these for each chromosome.
+   With a snapshot the stage always reads from the snapshot
+"""
 
-            linenum = linenum + 1
 
+class IntervalStage(Stage):
+    chromColumn = "chrom"
+    startName = "chromStart"
+    endName = "chromEnd"
+    # Stages that only ever looked at the first overlapping row
+    first = False
+    modes = ("query", "batch", "window", "index")
+    planChroms = True
+
+    def __init__(self, format="vcf", table=None, mode="query"):
+        Stage.__init__(self, format=format, table=table)
+        self.mode = self.useMode(mode)
+        self.lookup = None
+
+    # The chromosome of a record, named as in the table
+    def chromName(self, chrom):
+        return addChromPrefix(chrom)
+
+    def chrom(self, fields):
+        return self.chromName(fields[self.inds[0]].strip())
+
+    def open(self, **options):
+        Stage.open(self, **options)
+        if self.snapshot is not None:
+            self.lookup = lookup.SnapshotLookup(
+                self.snapshot.table(self.table), self.startName, self.endName
+            )
+        elif self.plan is not None:
+            self.lookup = lookup.PlannedLookup(
+                self.plan,
+                self.cursor,
+                self.table,
+                self.chromColumn,
+                self.startName,
+                self.endName,
+            )
         else:
-            fh_out.write(line + "\n")
+            self.lookup = lookup.create(
+                self.mode,
+                self.cursor,
+                self.table,
+                self.chromColumn,
+                self.startName,
+                self.endName,
+            )
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+    def close(self):
+        Stage.close(self)
+        self.lookup = None
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def overlaps(self, rows):
+        if self.first:
+            if len(rows) > 0:
+                return rows[0]
+            return None
+        return rows
 
+    def fetch(self, fields):
+        pos = int(fields[self.inds[1]].strip())
+        return self.overlaps(self.lookup.find(self.chrom(fields), pos))
 
-"""NOTE: all isoforms are collapsed in one record
-    1. chrom_pos_equal_base
-    2. chrom_pos_equal_nobase
-    3. chrom_pos_unequal
+    def fetchBatch(self, batch):
+        if not hasattr(self.lookup, "findBatch"):
+            return Stage.fetchBatch(self, batch)
+        sites = [
+            (self.chrom(fields), int(fields[self.inds[1]].strip())) for fields in batch
+        ]
+        return [self.overlaps(rows) for rows in self.lookup.findBatch(sites)]
+
+
+"""Selects columns from snapshot rows, like a "select a, b, c" would
 """
 
 
-def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t"):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = (
-                'select * from chrom_pos_equal_base where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ' AND ((haplotypeReference="'
-                + str(ref)
-                + '" AND haplotypeAlternate ="'
-                + str(alt)
-                + '") OR (haplotypeReference="'
-                + str(compRef)
-                + '" AND haplotypeAlternate ="'
-                + str(compAlt)
-                + '"));'
-            )
+def project(table, rows, columns):
+    indices = [table.columnIndex(name) for name in columns]
+    return tuple(tuple(row[i] for i in indices) for row in rows)
 
-            sql2 = (
-                'select * from chrom_pos_equal_nobase where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ";"
-            )
 
-            sql3 = (
-                'select * from chrom_pos_unequal where CHR="'
-                + str(chr)
-                + '" AND start <= '
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= end ;"
-            )
+"""Rows of the first tier of a lookup cascade that has any rows
+   tagged holds (tier, row) pairs; rows keep their order within the tier
+"""
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
 
-            if len(rows) > 0:
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(
-                        collapseRefSeq("\t".join([str(x) for x in row[1 : len(row)]]))
-                    )
+def firstTier(tagged):
+    if len(tagged) == 0:
+        return ()
+    best = min(tier for tier, row in tagged)
+    return tuple(row for tier, row in tagged if tier == best)
 
-                fields[7] = fields[7] + ";" + ";".join(m)
-                if str(fields[7]).startswith(".;"):
-                    fields[7] = str(fields[7]).replace(".;", "", 1)
-
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
-
-            if keep_going:
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
-
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
-
-            if keep_going:
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
+"""Runs a single stage from one temp file to the next
+   Keeps the file-to-file interface of the original stage functions
+"""
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
 
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
+def runStage(stage, vcf, tmpextin, tmpextout, sep="\t"):
+    pipeline.run(
+        vcf + tmpextin,
+        vcf + tmpextout,
+        [stage],
+        logfile=vcf + ".count.log",
+        sep=sep,
+    )
 
-            if keep_going:
-                fh_out.write(line + "\n")
 
-            vcf_linenum = vcf_linenum + 1
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""
 
-        else:
-            fh_out.write(line + "\n")
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+class DbSnpStage(Stage):
+    label = "dbSNP"
+    countkeys = ("linenum", "var_count")
+    logmode = "w"
+    inputs = ("CHROM", "POS", "REF")
+    outputs = ("ID", "INFO")
+    chromColumn = "CHR"
+    startName = "POS"
+    endName = "POS"
+    modes = ("query", "batch", "window", "index")
+
+    def __init__(self, format="vcf", table="dbSNP", varclass="SNV", mode="query"):
+        Stage.__init__(self, format=format, table=table)
+        self.varclass = varclass
+        self.mode = self.useMode(mode)
+        self.index = None
+        self.window = None
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def cacheKey(self):
+        return Stage.cacheKey(self) + [self.varclass]
+
+    def open(self, **options):
+        Stage.open(self, **options)
+        if self.mode not in ("query", "index", "window", "batch"):
+            raise ValueError(f"Unknown dbSNP lookup mode '{self.mode}'")
+        if self.mode == "index" and self.snapshot is None:
+            self.index = lookup.sharedIndex(("dbSNP", self.table), u.DbSnpIndex)
+        if self.mode == "window" and self.snapshot is None:
+            self.window = lookup.WindowLookup(
+                self.cursor, self.table, "CHR", "POS", "POS"
+            )
 
+    def close(self):
+        Stage.close(self)
+        self.index = None
+        self.window = None
+
+    def chromName(self, chrom):
+        return stripChromPrefix(chrom)
+
+    def variant(self, fields):
+        chr = self.chromName(fields[self.inds[0]].strip())
+        pos = fields[self.inds[1]].strip()
+        ref = clean_mysql_chars(fields[self.inds[2]]).strip()
+        return (chr, pos, ref, getComplementary(ref))
+
+    # Returns the (rsID, GMAF) of every matching dbSNP row
+    def fetch(self, fields):
+        if self.index is not None:
+            return self.fetchBatch([fields])[0]
+
+        chr, pos, ref, compRef = self.variant(fields)
+
+        if self.snapshot is not None or self.window is not None:
+            if self.snapshot is not None:
+                table = self.snapshot.table(self.table)
+                rows = table.query(chr, int(pos))
+                refIndex = table.columnIndex("REF")
+                infoIndex = table.columnIndex("INFO")
+            else:
+                rows = self.window.find(chr, int(pos))
+                refIndex = self.window.columns.index("REF")
+                infoIndex = self.window.columns.index("INFO")
+            return tuple(
+                (row[3], row[7])
+                for row in rows
+                if str(row[refIndex]) in (ref, compRef)
+                and str(row[infoIndex]) == self.varclass
+            )
 
-"""Get information about location in gene structures
-"""
+        sql = (
+            "select * from dbSNP where CHR = %s AND POS = %s"
+            + " AND ( REF = %s OR REF = %s ) AND INFO = %s;"
+        )
+        args = (str(chr), int(pos), str(ref), str(compRef), self.varclass)
+        rows = u.execute(self.cursor, sql, args).fetchall()
+        return tuple((row[3], row[7]) for row in rows)
+
+    # With the index, every chromosome in the batch is probed at once;
+    # in batch mode the whole batch is sent to the database together
+    def fetchBatch(self, batch):
+        if self.mode == "batch" and self.snapshot is None:
+            matches = u.probeRows(
+                self.cursor,
+                self.table,
+                ("chrom", "pos", "ref", "compref"),
+                [
+                    (str(chr), int(pos), str(ref), str(compRef))
+                    for chr, pos, ref, compRef in map(self.variant, batch)
+                ],
+                "t.CHR = p.chrom AND t.POS = p.pos"
+                + " AND ( t.REF = p.ref OR t.REF = p.compref ) AND t.INFO = %s",
+                (self.varclass,),
+            )
+            return [tuple((row[3], row[7]) for row in rows) for rows in matches]
+        if self.index is None:
+            return Stage.fetchBatch(self, batch)
+
+        byChrom = {}
+        for i, fields in enumerate(batch):
+            chr, pos, ref, compRef = self.variant(fields)
+            byChrom.setdefault(chr, []).append((i, int(pos), ref, compRef))
+
+        results = [()] * len(batch)
+        for chr, variants in byChrom.items():
+            if chr not in self.index:
+                u.loadDbSnpIndex(self.cursor, chr, index=self.index, table=self.table)
+            ids, positions, refs, compRefs = zip(*variants)
+            hits = self.index.probe(chr, positions, refs, compRefs, self.varclass)
+            for i, rows in zip(ids, hits):
+                results[i] = rows
+        return results
+
+    def apply(self, fields, rows):
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        fields[2] = "."
+        rsids = []
+        mafs = []
+        if len(rows) > 0:
+            for rsid, gmaf in rows:
+                rsids.append(str(rsid))
+                if str(gmaf) != ".":
+                    mafs.append("GMAF=" + str(gmaf))
+
+            maf_str = ""
+            if len(mafs) > 0:
+                maf_str = ";" + ";".join([str(x) for x in mafs])
+
+            self.counts["var_count"] += 1
+            if fields[7].isMissing():
+                fields[7].set("DB" + maf_str)
+            else:
+                fields[7].extend("DB;VC=" + self.varclass + maf_str)
 
+            fields[2] = str(";".join(rsids))
 
-def getGenes(
+        self.counts["linenum"] += 1
+
+    def writeLog(self, fh_log):
+        # The total counts from one, as it always has
+        linenum = self.counts["linenum"] + 1
+        var_count = self.counts["var_count"]
+        ratioInDbSnp = (var_count / float(linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
+
+
+def getSnpsFromDbSnp(
     vcf,
     format="vcf",
-    table="refGene",
-    promoter_offset=500,
-    tmpextin=".2",
-    tmpextout=".3",
+    tmpextin="",
+    tmpextout=".1",
+    varclass="SNV",
     sep="\t",
+    mode="query",
 ):
+    # dbSNP is always the first stage and reads the input file itself
+    stage = DbSnpStage(format=format, varclass=varclass, mode=mode)
+    runStage(stage, vcf, "", tmpextout, sep)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
-
-            sql = (
-                "select * from "
-                + table
-                + ' where chrom="'
-                + str(chr)
-                + '" AND (txStart - '
-                + str(promoter_offset)
-                + ") <= "
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= (txEnd + "
-                + str(promoter_offset)
-                + ");"
-            )
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
+"""NOTE: all isoforms are collapsed in one record
+    1. chrom_pos_equal_base
+    2. chrom_pos_equal_nobase
+    3. chrom_pos_unequal
+"""
 
-            if len(rows) > 0:
-                cnt = 1
-                for row in rows:
-                    # count location
-                    positionType = str(
-                        u.parse_field(info_field, "positionType", ";", "=")
-                    )
 
-                    if positionType == "intron":
-                        intronic_count = intronic_count + 1
-                    elif positionType == "non_coding_intron":
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif positionType == "CDS":
-                        cds_count = cds_count + 1
-                    elif positionType == "non_coding_exon":
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif positionType == "utr5":
-                        utr5_count = utr5_count + 1
-                    elif positionType == "utr3":
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts = str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(",")
-                    exonsEn = exonEnds.split(",")
-
-                    if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "non_coding_exon="
-                                    + "ex"
-                                    + str(exnum)
-                                    + "/"
-                                    + str(exonCount)
-                                )
-                        if len(exons) > 0:
-                            region = ";".join(exons)
-                    elif u.isBetween(pos, cdsStart, cdsEnd):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
-                                )
-                                exonic_count = exonic_count + 1
-                        if len(exons) > 0:
-                            region = ";".join(exons)
-
-                    elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ""
-
-                    if region != "":
-                        info.append(
-                            collapseGeneNames(
-                                row=row,
-                                indices=indicesKnownGenes,
-                                region=region,
-                                cnt=cnt,
-                            )
-                        )
+class BigRefGeneStage(Stage):
+    label = "BigRefGene"
+    countkeys = ()
+    inputs = ("CHROM", "POS", "REF", "ALT")
+    tables = ("chrom_pos_equal_base", "chrom_pos_equal_nobase", "chrom_pos_unequal")
+
+    def __init__(self, format="vcf"):
+        Stage.__init__(self, format=format)
+        self.sql = None
+
+    # The three tiers in one round trip, each row tagged with its tier.
+    # The tiers select the columns of the first table by name, so a table
+    # whose columns differ fails the statement instead of shifting them
+    def open(self, **options):
+        Stage.open(self, **options)
+        if self.snapshot is not None:
+            return
+        columns = ", ".join(
+            "t." + name for name in u.tableColumns(self.cursor, self.tables[0])
+        )
+        self.sql = (
+            f"select 1 as tier, {columns} from {self.tables[0]} t"
+            + " where t.CHR = %s AND t.start = %s"
+            + " AND ((t.haplotypeReference = %s AND t.haplotypeAlternate = %s)"
+            + " OR (t.haplotypeReference = %s AND t.haplotypeAlternate = %s))"
+            + " union all "
+            + f"select 2 as tier, {columns} from {self.tables[1]} t"
+            + " where t.CHR = %s AND t.start = %s"
+            + " union all "
+            + f"select 3 as tier, {columns} from {self.tables[2]} t"
+            + " where t.CHR = %s AND t.start <= %s AND %s <= t.end"
+            + " order by tier;"
+        )
+
+    def fetch(self, fields):
+        chr = stripChromPrefix(fields[self.inds[0]].strip())
+        pos = fields[self.inds[1]].strip()
+        ref = clean_mysql_chars(fields[self.inds[2]]).strip()
+        alt = clean_mysql_chars(fields[self.inds[3]]).strip()
+
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
+
+        if self.snapshot is not None:
+            return self.fetchSnapshot(chr, int(pos), ref, alt, compRef, compAlt)
+
+        chr = str(chr)
+        pos = int(pos)
+        args = (chr, pos, ref, alt, compRef, compAlt, chr, pos, chr, pos, pos)
+        rows = u.execute(self.cursor, self.sql, args).fetchall()
+        return firstTier([(row[0], row[1:]) for row in rows])
+
+    # The same cascade against the snapshot; each tier is a local lookup
+    def fetchSnapshot(self, chr, pos, ref, alt, compRef, compAlt):
+        tagged = []
+
+        base = self.snapshot.table("chrom_pos_equal_base")
+        startIndex = base.columnIndex("start")
+        refIndex = base.columnIndex("haplotypeReference")
+        altIndex = base.columnIndex("haplotypeAlternate")
+        tagged.extend(
+            (1, row)
+            for row in base.query(chr, pos)
+            if int(row[startIndex]) == pos
+            and (
+                (str(row[refIndex]) == ref and str(row[altIndex]) == alt)
+                or (str(row[refIndex]) == compRef and str(row[altIndex]) == compAlt)
+            )
+        )
+        if len(tagged) > 0:
+            return firstTier(tagged)
 
-                    cnt = cnt + 1
+        nobase = self.snapshot.table("chrom_pos_equal_nobase")
+        startIndex = nobase.columnIndex("start")
+        tagged.extend(
+            (2, row) for row in nobase.query(chr, pos) if int(row[startIndex]) == pos
+        )
+        if len(tagged) > 0:
+            return firstTier(tagged)
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ";" + str_info
-                fh_out.write("\t".join(fields) + "\n")
+        unequal = self.snapshot.table("chrom_pos_unequal")
+        tagged.extend((3, row) for row in unequal.query(chr, pos))
+        return firstTier(tagged)
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write("\t".join(fields) + "\n")
-                interGenic_count = interGenic_count + 1
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            m = set([])
+            for row in rows:
+                m.add(collapseRefSeq("\t".join([str(x) for x in row[1 : len(row)]])))
 
-            linenum = linenum + 1
+            fields[7].extend(";".join(m))
+            fields[7].dropPrefix(".;")
 
-        else:
-            fh_out.write(line + "\n")
+    def writeLog(self, fh_log):
+        pass
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t"):
+    runStage(BigRefGeneStage(format=format), vcf, tmpextin, tmpextout, sep)
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
 
-    print(f"In '3 UTR {str(utr3_count)}")
-    fh_log.write(f"In '3 UTR {str(utr3_count)}\n")
+"""A refGene transcript with its exon boundaries parsed once
 
-    print(f"In '5 UTR {str(utr5_count)}")
-    fh_log.write(f"In '5 UTR {str(utr5_count)}\n")
+   Exons are parsed on first use and located with a binary search over
+   the exon starts. That finds the only exon that can hold a position as
+   long as the exons are sorted and do not touch; transcripts where they
+   do are scanned exon by exon, as before
+"""
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+class TranscriptModel(object):
+    __slots__ = (
+        "strand",
+        "txStart",
+        "txEnd",
+        "cdsStart",
+        "cdsEnd",
+        "exonCount",
+        "exonBlobs",
+        "exonStarts",
+        "exonEnds",
+        "disjoint",
+    )
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+    def __init__(self, row):
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.exonBlobs = (row[9], row[10])
+        self.exonStarts = None
+        self.exonEnds = None
+        self.disjoint = False
+
+    def parseExons(self):
+        exonsSt = str(self.exonBlobs[0].decode("utf-8")).split(",")
+        exonsEn = str(self.exonBlobs[1].decode("utf-8")).split(",")
+        self.exonStarts = tuple(int(exonsSt[e]) for e in range(self.exonCount))
+        self.exonEnds = tuple(int(exonsEn[e]) for e in range(self.exonCount))
+        self.disjoint = all(
+            self.exonStarts[e] <= self.exonEnds[e] < self.exonStarts[e + 1]
+            for e in range(self.exonCount - 1)
+        )
+        self.exonBlobs = None
+
+    # Numbers (from 0, in genome order) of the exons holding pos
+    def exonsAt(self, pos):
+        if self.exonStarts is None:
+            self.parseExons()
+
+        if not self.disjoint:
+            return [
+                e
+                for e in range(self.exonCount)
+                if u.isBetween(pos, self.exonStarts[e], self.exonEnds[e])
+            ]
+
+        e = bisect.bisect_right(self.exonStarts, pos) - 1
+        if e >= 0 and pos <= self.exonEnds[e]:
+            return [e]
+        return []
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+"""Get information about location in gene structures
+"""
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
 
+class GenesStage(Stage):
+    label = "Genes"
+    countkeys = (
+        "interGenic",
+        "cds",
+        "utr3",
+        "utr5",
+        "intronic",
+        "non_coding_intronic",
+        "exonic",
+        "non_coding_exonic",
+        "promoter",
+    )
+    chromColumn = "chrom"
+    startName = "txStart"
+    endName = "txEnd"
+    modes = ("query", "batch", "window")
+
+    def __init__(
+        self, format="vcf", table="refGene", promoter_offset=500, mode="query"
+    ):
+        Stage.__init__(self, format=format, table=table)
+        self.promoter_offset = promoter_offset
+        # "query" sends one SELECT per variant, "window" prefetches
+        # the transcripts of a stretch of the chromosome at a time,
+        # "batch" sends the variants of a batch with one SELECT
+        self.mode = self.useMode(mode)
+        self.window = None
+        # refGene row -> TranscriptModel, built once per job
+        self.models = {}
+        self.cpgLookup = None
+
+    # CpG islands are loaded a chromosome at a time into an interval
+    # index and resolved locally, instead of one SELECT per promoter hit
+    def open(self, **options):
+        Stage.open(self, **options)
+        if self.snapshot is None:
+            self.cpgLookup = lookup.IndexLookup(
+                self.cursor,
+                "cpgIslandExt",
+                "chrom",
+                "chromStart",
+                "chromEnd",
+                columns="chrom, chromStart, chromEnd, name",
+            )
+            if self.mode == "window":
+                self.window = lookup.WindowLookup(
+                    self.cursor, self.table, "chrom", "txStart", "txEnd"
+                )
+            elif self.mode not in ("query", "batch"):
+                raise ValueError(f"Unknown transcript lookup mode '{self.mode}'")
+
+    def close(self):
+        Stage.close(self)
+        self.cpgLookup = None
+        self.window = None
+
+    def cacheKey(self):
+        return Stage.cacheKey(self) + [str(self.promoter_offset)]
+
+    def chromName(self, chrom):
+        return addChromPrefix(chrom)
+
+    def model(self, row):
+        if row not in self.models:
+            self.models[row] = TranscriptModel(row)
+        return self.models[row]
+
+    def fetch(self, fields):
+        chr = addChromPrefix(fields[self.inds[0]].strip())
+        pos = fields[self.inds[1]].strip()
+
+        return self.withCpgIsland(chr, int(pos), self.fetchTranscripts(chr, pos))
+
+    def fetchBatch(self, batch):
+        if self.mode != "batch" or self.snapshot is not None:
+            return Stage.fetchBatch(self, batch)
+
+        sites = [
+            (addChromPrefix(fields[self.inds[0]].strip()), int(fields[self.inds[1]]))
+            for fields in batch
+        ]
+        offset = int(self.promoter_offset)
+        matches = u.probeRows(
+            self.cursor,
+            self.table,
+            ("chrom", "pos"),
+            sites,
+            "t.chrom = p.chrom"
+            + " AND (t.txStart - %s) <= p.pos AND p.pos <= (t.txEnd + %s)",
+            (offset, offset),
+        )
+        return [
+            self.withCpgIsland(chr, pos, rows)
+            for (chr, pos), rows in zip(sites, matches)
+        ]
+
+    # The CpG island only depends on the position, so look it up once
+    # for all transcripts whose promoter window contains the variant
+    def withCpgIsland(self, chr, pos, rows):
+        cpg = None
+        if any(self.inPromoterWindow(row, pos) for row in rows):
+            cpg = self.fetchCpgIsland(chr, pos)
+        return (rows, cpg)
+
+    def fetchTranscripts(self, chr, pos):
+        # Transcripts whose span, widened by the promoter offset, holds pos
+        start = int(pos) - int(self.promoter_offset)
+        end = int(pos) + int(self.promoter_offset)
+        if self.snapshot is not None:
+            return self.snapshot.table(self.table).queryRange(chr, start, end)
+        if self.window is not None:
+            return self.window.findRange(chr, start, end)
+
+        sql = (
+            "select * from "
+            + self.table
+            + " where chrom = %s AND (txStart - %s) <= %s AND %s <= (txEnd + %s);"
+        )
+        offset = int(self.promoter_offset)
+        args = (str(chr), offset, int(pos), int(pos), offset)
+        return u.execute(self.cursor, sql, args).fetchall()
+
+    def inPromoterWindow(self, row, pos):
+        model = self.model(row)
+        txtStart = model.txStart
+        txtEnd = model.txEnd
+        strand = model.strand
+        promoter_plus = txtStart - int(self.promoter_offset)
+        promoter_minus = txtEnd + int(self.promoter_offset)
+        return (u.isBetween(pos, promoter_plus, txtStart) and (strand == "+")) or (
+            u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")
+        )
+
+    def fetchCpgIsland(self, chr, pos):
+        if self.snapshot is not None:
+            table = self.snapshot.table("cpgIslandExt")
+            rows = project(
+                table,
+                table.query(chr, pos),
+                ["chrom", "chromStart", "chromEnd", "name"],
+            )
+        else:
+            rows = self.cpgLookup.find(chr, pos)
+
+        if len(rows) > 0:
+            return rows[0]
+        return None
+
+    def promoterRegion(self, cpg):
+        if cpg is not None:
+            self.counts["promoter"] += 1
+            return "putativePromoterRegion=" + "".join(str(cpg[3]).split())
+        return ""
+
+    def exonRegions(self, model, pos, label):
+        exonCount = model.exonCount
+
+        exons = []
+        for e in model.exonsAt(pos):
+            exnum = e + 1
+            if model.strand == "-":
+                exnum = exonCount - e
+            exons.append(label + "=" + "ex" + str(exnum) + "/" + str(exonCount))
+        return exons
+
+    def locate(self, row, pos, cpg):
+        model = self.model(row)
+        txtStart = model.txStart
+        txtEnd = model.txEnd
+        cdsStart = model.cdsStart
+        cdsEnd = model.cdsEnd
+        strand = model.strand
+
+        promoter_plus = txtStart - int(self.promoter_offset)
+        promoter_minus = txtEnd + int(self.promoter_offset)
+        region = ""
+
+        if cdsStart == cdsEnd:
+            exons = self.exonRegions(model, pos, "non_coding_exon")
+            if len(exons) > 0:
+                region = ";".join(exons)
+        elif u.isBetween(pos, cdsStart, cdsEnd):
+            exons = self.exonRegions(model, pos, "exon")
+            self.counts["exonic"] += len(exons)
+            if len(exons) > 0:
+                region = ";".join(exons)
+        elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
+            region = self.promoterRegion(cpg)
+        elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
+            region = self.promoterRegion(cpg)
+
+        return region
+
+    def apply(self, fields, result):
+        rows, cpg = result
+        pos = int(fields[self.inds[1]].strip())
+        # Where earlier stages placed the variant, counted for every row
+        positionType = clean_mysql_chars(fields[7].get("positionType")).strip()
+
+        if len(rows) > 0:
+            info = []
+            cnt = 1
+            for row in rows:
+                # count location
+                if positionType == "intron":
+                    self.counts["intronic"] += 1
+                elif positionType == "non_coding_intron":
+                    self.counts["non_coding_intronic"] += 1
+                elif positionType == "CDS":
+                    self.counts["cds"] += 1
+                elif positionType == "non_coding_exon":
+                    self.counts["non_coding_exonic"] += 1
+                elif positionType == "utr5":
+                    self.counts["utr5"] += 1
+                elif positionType == "utr3":
+                    self.counts["utr3"] += 1
+
+                region = self.locate(row, pos, cpg)
+                if region != "":
+                    info.append(
+                        collapseGeneNames(
+                            row=row,
+                            indices=indicesKnownGenes,
+                            region=region,
+                            cnt=cnt,
+                        )
+                    )
+                cnt = cnt + 1
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
-"""
+            fields[7].extend(";".join(info))
+
+        else:
+            fields[7].extend("positionType=interGenic")
+            self.counts["interGenic"] += 1
+
+    def writeLog(self, fh_log):
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
+
+        for title, key in [
+            ("In interGenic", "interGenic"),
+            ("In CDS", "cds"),
+            ("In '3 UTR", "utr3"),
+            ("In '5 UTR", "utr5"),
+            ("In Intronic", "intronic"),
+            ("In Non_coding_intronic", "non_coding_intronic"),
+            ("In Exonic", "exonic"),
+            ("In Non_coding_exonic", "non_coding_exonic"),
+            ("In Putative Promoter Region", "promoter"),
+        ]:
+            print(f"{title} {str(self.counts[key])}")
+            fh_log.write(f"{title} {str(self.counts[key])}\n")
 
 
-def getExonsEtAl(
+def getGenes(
     vcf,
     format="vcf",
     table="refGene",
@@ -643,1115 +1054,514 @@ def getExonsEtAl(
     tmpextin=".2",
     tmpextout=".3",
     sep="\t",
+    mode="query",
 ):
+    stage = GenesStage(
+        format=format, table=table, promoter_offset=promoter_offset, mode=mode
+    )
+    runStage(stage, vcf, tmpextin, tmpextout, sep)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
-
-            sql = (
-                "select * from "
-                + table
-                + ' where chrom="'
-                + str(chr)
-                + '"   AND (txStart - '
-                + str(promoter_offset)
-                + ") <= "
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= (txEnd + "
-                + str(promoter_offset)
-                + ");"
-            )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if len(rows) > 0:
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts = str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(",")
-                    exonsEn = exonEnds.split(",")
-
-                    if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "non_coding_exon="
-                                    + "ex"
-                                    + str(exnum)
-                                    + "/"
-                                    + str(exonCount)
-                                )
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if len(exons) > 0:
-                            region = "positionType=non_coding_exon;" + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = "positionType=non_coding_intron"
-
-                    elif u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
-                                )
-                                exonic_count = exonic_count + 1
-                        if len(exons) > 0:
-                            region = "positionType=CDS;" + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = "positionType=CDS;" + "intron"
-
-                    elif (
-                        u.isBetween(pos, txtStart, cdsStart)
-                        and (cdsStart < cdsEnd)
-                        and (strand == "+")
-                    ):
-                        utr5_count = utr5_count + 1
-                        region = "positionType=utr5"
-
-                    elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd)(
-                        strand == "+"
-                    ):
-                        utr3_count = utr3_count + 1
-                        region = "positionType=utr3"
-
-                    elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd)(
-                        strand == "-"
-                    ):
-                        utr5_count = utr5_count + 1
-                        region = "positionType=utr5"
-
-                    elif (
-                        u.isBetween(pos, txtStart, cdsStart)
-                        and (cdsStart < cdsEnd)
-                        and (strand == "-")
-                    ):
-                        utr3_count = utr3_count + 1
-                        region = "positionType=utr3"
-
-                    elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name "
-                            + 'from cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name "
-                            + 'from cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ""
-
-                    if region != "":
-                        info.append(
-                            collapseGeneNames(
-                                row=row,
-                                indices=indicesKnownGenes,
-                                region=region,
-                                cnt=cnt,
-                            )
-                        )
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ";" + str_info
-                fh_out.write("\t".join(fields) + "\n")
-
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write("\t".join(fields) + "\n")
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
-
-        else:
-            fh_out.write(line + "\n")
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
 
-    print(f"In '3 UTR {str(utr3_count)}")
-    fh_log.write(f"In '3 UTR {str(utr3_count)}\n")
+class ExonsEtAlStage(GenesStage):
+    label = "ExonsEtAl"
 
-    print(f"In '5 UTR {str(utr5_count)}")
-    fh_log.write(f"In '5 UTR {str(utr5_count)}\n")
+    def locate(self, row, pos, cpg):
+        model = self.model(row)
+        txtStart = model.txStart
+        txtEnd = model.txEnd
+        cdsStart = model.cdsStart
+        cdsEnd = model.cdsEnd
+        strand = model.strand
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic " + str(intronic_count) + "\n")
+        promoter_plus = txtStart - int(self.promoter_offset)
+        promoter_minus = txtEnd + int(self.promoter_offset)
+        region = ""
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+        if cdsStart == cdsEnd:
+            exons = self.exonRegions(model, pos, "non_coding_exon")
+            self.counts["non_coding_exonic"] += len(exons)
+            if len(exons) > 0:
+                region = "positionType=non_coding_exon;" + ";".join(exons)
+            else:
+                self.counts["non_coding_intronic"] += 1
+                region = "positionType=non_coding_intron"
+
+        elif u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd):
+            self.counts["cds"] += 1
+            exons = self.exonRegions(model, pos, "exon")
+            self.counts["exonic"] += len(exons)
+            if len(exons) > 0:
+                region = "positionType=CDS;" + ";".join(exons)
+            else:
+                self.counts["intronic"] += 1
+                region = "positionType=CDS;" + "intron"
+
+        elif (
+            u.isBetween(pos, txtStart, cdsStart)
+            and (cdsStart < cdsEnd)
+            and (strand == "+")
+        ):
+            self.counts["utr5"] += 1
+            region = "positionType=utr5"
+
+        elif (
+            u.isBetween(pos, cdsEnd, txtEnd)
+            and (cdsStart < cdsEnd)
+            and (strand == "+")
+        ):
+            self.counts["utr3"] += 1
+            region = "positionType=utr3"
+
+        elif (
+            u.isBetween(pos, cdsEnd, txtEnd)
+            and (cdsStart < cdsEnd)
+            and (strand == "-")
+        ):
+            self.counts["utr5"] += 1
+            region = "positionType=utr5"
+
+        elif (
+            u.isBetween(pos, txtStart, cdsStart)
+            and (cdsStart < cdsEnd)
+            and (strand == "-")
+        ):
+            self.counts["utr3"] += 1
+            region = "positionType=utr3"
+
+        elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
+            region = self.promoterRegion(cpg)
+
+        elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
+            region = self.promoterRegion(cpg)
+
+        return region
+
+    def apply(self, fields, result):
+        rows, cpg = result
+        pos = int(fields[self.inds[1]].strip())
+
+        if len(rows) > 0:
+            info = []
+            cnt = 1
+            for row in rows:
+                region = self.locate(row, pos, cpg)
+                if region != "":
+                    info.append(
+                        collapseGeneNames(
+                            row=row,
+                            indices=indicesKnownGenes,
+                            region=region,
+                            cnt=cnt,
+                        )
+                    )
+                cnt = cnt + 1
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+            fields[7].extend(";".join(info))
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+        else:
+            fields[7].extend("positionType=interGenic")
+            self.counts["interGenic"] += 1
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+def getExonsEtAl(
+    vcf,
+    format="vcf",
+    table="refGene",
+    promoter_offset=500,
+    tmpextin=".2",
+    tmpextout=".3",
+    sep="\t",
+    mode="query",
+):
+    stage = ExonsEtAlStage(
+        format=format, table=table, promoter_offset=promoter_offset, mode=mode
+    )
+    runStage(stage, vcf, tmpextin, tmpextout, sep)
 
 
 """Overlap with tfbsConsSites
 """
 
 
-def addOverlapWithTfbsConsSites(
-    vcf, format="vcf", table="tfbsConsSites", tmpextin=".2", tmpextout=".3", sep="\t"
-):
+class TfbsConsSitesStage(Stage):
+    label = "addOverlapWithTfbsConsSites"
 
-    allowed_chrom = [
-        "1",
-        "2",
-        "3",
-        "4",
-        "5",
-        "6",
-        "7",
-        "8",
-        "9",
-        "10",
-        "11",
-        "12",
-        "13",
-        "14",
-        "15",
-        "16",
-        "17",
-        "18",
-        "19",
-        "20",
-        "21",
-        "22",
-        "X",
-        "Y",
-    ]
+    allowed_chrom = [str(c) for c in range(1, 23)] + ["X", "Y"]
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+    def __init__(self, format="vcf", table="tfbsConsSites"):
+        Stage.__init__(self, format=format, table=table)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def fetch(self, fields):
+        # For some reason this table has no "chr" preceeding number
+        chr = addChromPrefix(fields[self.inds[0]].strip())
+        pos = fields[self.inds[1]].strip()
+        chrIndex = chr.replace("chr", "")
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
+        if chrIndex not in self.allowed_chrom:
+            return ()
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+        if self.snapshot is not None:
+            table = self.snapshot.table("tfbsConsSites" + chrIndex)
+            return project(
+                table,
+                table.query(chr, int(pos)),
+                ["chrom", "chromStart", "chromEnd", "name"],
+            )
 
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if line.startswith("##"):
-            fh_out.write(line + "\n")
+        sql = (
+            "select chrom, chromStart, chromEnd, name "
+            + "from tfbsConsSites"
+            + chrIndex
+            + " where chromStart <= %s AND %s <= chromEnd;"
+        )
+        return u.execute(self.cursor, sql, (int(pos), int(pos))).fetchall()
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.counts["line_count"] += 1
+            records = []
+            for row in rows:
+                self.counts["var_count"] += 1
+                t = (
+                    str(row[3])
+                    + "."
+                    + str(row[0])
+                    + "."
+                    + str(row[1])
+                    + "."
+                    + str(row[2])
+                )
+                t = t.strip()
+                records.append("tfbsRegion" + "=" + t)
 
-        # header line
-        elif line.startswith("#CHROM") or line.startswith("CHROM"):
-            fh_out.write(line + "\n")
+            fields[7].append(";".join(records))
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex = chr.replace("chr", "")
-
-            if chrIndex in allowed_chrom:
-                isOverlap = False
-                sql = (
-                    "select chrom, chromStart, chromEnd, name "
-                    + "from tfbsConsSites"
-                    + chrIndex
-                    + " where  chromStart <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd;"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = (
-                            str(row[3])
-                            + "."
-                            + str(row[0])
-                            + "."
-                            + str(row[1])
-                            + "."
-                            + str(row[2])
-                        )
-                        t = t.strip()
-                        records.append("tfbsRegion" + "=" + t)
-                        records_count = records_count + 1
 
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
+def addOverlapWithTfbsConsSites(
+    vcf, format="vcf", table="tfbsConsSites", tmpextin=".2", tmpextout=".3", sep="\t"
+):
+    stage = TfbsConsSitesStage(format=format, table=table)
+    runStage(stage, vcf, tmpextin, tmpextout, sep)
 
-                    fh_out.write("\t".join(fields) + "\n")
 
-                else:  # chrom is not on the list
-                    fh_out.write(line + "\n")
+"""Overlap with GadAll table
+"""
 
-            else:  # chrom is not on the list
-                fh_out.write(line + "\n")
 
-        linenum = linenum + 1
+class GadAllStage(IntervalStage):
+    label = "gadAll"
+    chromColumn = "chromosome"
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+    def __init__(self, format="vcf", table="gadAll", mode="query"):
+        IntervalStage.__init__(self, format=format, table=table, mode=mode)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    # For some reason this table has no "chr" preceeding number
+    def chromName(self, chrom):
+        return stripChromPrefix(chrom)
 
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.counts["line_count"] += 1
+            records = []
+            r_tmp = []
+            for row in rows:
+                self.counts["var_count"] += 1
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]))
+                    records.append(str(self.table) + "=" + str(row[3]))
 
-"""Overlap with GadAll table
-"""
+            fields[7].append(";".join(records))
 
 
 def addOverlapWithGadAll(
-    vcf, format="vcf", table="gadAll", tmpextin="", tmpextout=".1", sep="\t"
+    vcf,
+    format="vcf",
+    table="gadAll",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    mode="query",
 ):
+    stage = GadAllStage(format=format, table=table, mode=mode)
+    runStage(stage, vcf, tmpextin, tmpextout, sep)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chromosome="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]))
-                            records.append(str(table) + "=" + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t ".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+""" Overlap with gwasCatalog table """
 
-    conn.close()
-    fh.close()
-    fh_out.close()
 
+class GwasCatalogStage(IntervalStage):
+    label = "GwasCatalog"
+    startName = "chromEnd"
+
+    def __init__(self, format="vcf", table="gwasCatalog", mode="query"):
+        IntervalStage.__init__(self, format=format, table=table, mode=mode)
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.counts["line_count"] += 1
+            records = []
+            for row in rows:
+                self.counts["var_count"] += 1
+                records.append(
+                    str(self.table)
+                    + "="
+                    + str("pubMedID")
+                    + "="
+                    + str(row[5])
+                    + ",trait="
+                    + str(row[10])
+                )
 
-""" Overlap with gwasCatalog table """
+            fields[7].append(";".join(records))
 
 
 def addOverlapWithGwasCatalog(
-    vcf, format="vcf", table="gwasCatalog", tmpextin="", tmpextout=".1", sep="\t"
+    vcf,
+    format="vcf",
+    table="gwasCatalog",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    mode="query",
 ):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND chromEnd = '
-                    + str(pos)
-                    + ";"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(
-                            str(table)
-                            + "="
-                            + str("pubMedID")
-                            + "="
-                            + str(row[5])
-                            + ",trait="
-                            + str(row[10])
-                        )
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    stage = GwasCatalogStage(format=format, table=table, mode=mode)
+    runStage(stage, vcf, tmpextin, tmpextout, sep)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
 
 
-def addOverlapWitHUGOGeneNomenclature(
-    vcf, format="vcf", table="hugo", tmpextin="", tmpextout=".1", sep="\t"
-):
+class HugoGeneNomenclatureStage(IntervalStage):
+    label = "HUGO Gene Nomenclature Committee"
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + "," + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append("HGNC_GeneAnnotation" + "=" + t)
-                        records_count = records_count + 1
-
-                    records_str = ",".join(records).replace(";", ",")
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + records_str
-                    else:
-                        fields[7] = fields[7] + ";" + records_str
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+    def __init__(self, format="vcf", table="hugo", mode="query"):
+        IntervalStage.__init__(self, format=format, table=table, mode=mode)
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.counts["line_count"] += 1
+            records = []
+            r_tmp = []
+            for row in rows:
+                self.counts["var_count"] += 1
+                t = str(str(row[5]) + "," + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append("HGNC_GeneAnnotation" + "=" + t)
+
+            fields[7].append(",".join(records).replace(";", ","))
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def addOverlapWitHUGOGeneNomenclature(
+    vcf, format="vcf", table="hugo", tmpextin="", tmpextout=".1", sep="\t", mode="query"
+):
+    stage = HugoGeneNomenclatureStage(format=format, table=table, mode=mode)
+    runStage(stage, vcf, tmpextin, tmpextout, sep)
 
 
 """Overlap with segdup regions genomicSuperDups
 """
 
 
-def addOverlapWithGenomicSuperDups(
-    vcf, format="vcf", table="genomicSuperDups", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ""
-                otherStart = ""
-                otherEnd = ""
-                l = str(isOverlap)
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = (
-                        fields[7]
-                        + ";"
-                        + str(table)
-                        + "="
-                        + str(isOverlap)
-                        + ";"
-                        + "otherChrom="
-                        + str(otherChrom)
-                        + ";otherStart="
-                        + str(otherStart)
-                        + ";otherEnd="
-                        + str(otherEnd)
-                    )
+class GenomicSuperDupsStage(IntervalStage):
+    label = "genomicSuperDups"
+    first = True
 
-                fh_out.write("\t".join(fields) + "\n")
+    def __init__(self, format="vcf", table="genomicSuperDups", mode="query"):
+        IntervalStage.__init__(self, format=format, table=table, mode=mode)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+    def apply(self, fields, row):
+        if row is not None:
+            self.counts["line_count"] += 1
+            self.counts["var_count"] += 1
+            fields[7].extend(
+                str(self.table)
+                + "="
+                + str(True)
+                + ";"
+                + "otherChrom="
+                + str(row[7])
+                + ";otherStart="
+                + str(row[8])
+                + ";otherEnd="
+                + str(row[9])
+            )
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGenomicSuperDups(
+    vcf,
+    format="vcf",
+    table="genomicSuperDups",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    mode="query",
+):
+    stage = GenomicSuperDupsStage(format=format, table=table, mode=mode)
+    runStage(stage, vcf, tmpextin, tmpextout, sep)
 
 
-"""Searches Genes Databases and returns Genes/Cytobands 
+"""Searches Genes Databases and returns Genes/Cytobands
    with which SNP or INDEL overlaps
 """
 
 
-def addOverlapWithRefGene(
-    vcf, format="vcf", table="refGene", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-    colindex = 1
-    colindex2 = 12
-    name = "name"
-    name2 = "name2"
+class RefGeneStage(IntervalStage):
+    label = "refGene"
     startName = "txStart"
     endName = "txEnd"
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(
-                            name2
-                            + "="
-                            + str(row[colindex2])
-                            + ";"
-                            + name
-                            + "="
-                            + str(row[colindex])
-                        )
+    def __init__(self, format="vcf", table="refGene", mode="query"):
+        IntervalStage.__init__(self, format=format, table=table, mode=mode)
 
-                    genes = ";".join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ";" + str(genes)
-                fh_out.write("\t".join(fields) + "\n")
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.counts["line_count"] += 1
+            overlapsWith = []
+            for row in rows:
+                self.counts["var_count"] += 1
+                overlapsWith.append("name2=" + str(row[12]) + ";name=" + str(row[1]))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+            fields[7].append(";".join([str(x) for x in overlapsWith]))
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithRefGene(
+    vcf,
+    format="vcf",
+    table="refGene",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    mode="query",
+):
+    stage = RefGeneStage(format=format, table=table, mode=mode)
+    runStage(stage, vcf, tmpextin, tmpextout, sep)
 
 
 """Method to find overlap with Cytoband table
 """
 
 
-def addOverlapWithCytoband(
-    vcf, format="vcf", table="cytoBand", tmpextin="", tmpextout=".1", sep="\t"
-):
+class CytobandStage(IntervalStage):
+    label = "Cytoband"
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = "txStart"
-    endName = "txEnd"
+    def __init__(self, format="vcf", table="cytoBand", mode="query"):
+        IntervalStage.__init__(self, format=format, table=table, mode=mode)
+        self.colindex = 12
+        self.startName = "txStart"
+        self.endName = "txEnd"
 
-    if table == "cytoBand":
-        colindex = 3
-        startName = "chromStart"
-        endName = "chromEnd"
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ";".join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(cytoband)
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+        if table == "cytoBand":
+            self.colindex = 3
+            self.startName = "chromStart"
+            self.endName = "chromEnd"
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.counts["line_count"] += 1
+            overlapsWith = []
+            for row in rows:
+                self.counts["var_count"] += 1
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ";".join([str(x) for x in overlapsWith])
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+            fields[7].append(str(self.table) + "=" + str(cytoband))
+
+
+def addOverlapWithCytoband(
+    vcf,
+    format="vcf",
+    table="cytoBand",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    mode="query",
+):
+    stage = CytobandStage(format=format, table=table, mode=mode)
+    runStage(stage, vcf, tmpextin, tmpextout, sep)
 
 
 """Method to find overlap with CNV tables
 """
 
 
-def addOverlapWithCnvDatabase(
-    vcf, format="vcf", table="dgv_Cnv", tmpextin="", tmpextout=".1", sep="\t"
-):
+class CnvDatabaseStage(IntervalStage):
+    first = True
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(isOverlap)
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+    def __init__(self, format="vcf", table="dgv_Cnv", mode="query"):
+        IntervalStage.__init__(self, format=format, table=table, mode=mode)
+        self.label = table
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+    def apply(self, fields, row):
+        if row is not None:
+            self.counts["line_count"] += 1
+            self.counts["var_count"] += 1
+            fields[7].append(str(self.table) + "=" + str(True))
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def addOverlapWithCnvDatabase(
+    vcf,
+    format="vcf",
+    table="dgv_Cnv",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    mode="query",
+):
+    stage = CnvDatabaseStage(format=format, table=table, mode=mode)
+    runStage(stage, vcf, tmpextin, tmpextout, sep)
 
 
 """Method to find overlap with targetScanS tables
 """
 
 
-def addOverlapWithMiRNA(
-    vcf, format="vcf", table="targetScanS", tmpextin="", tmpextout=".1", sep="\t"
-):
+class MiRNAStage(IntervalStage):
+    label = "miRNA"
+    first = True
+
+    def __init__(self, format="vcf", table="targetScanS", mode="query"):
+        IntervalStage.__init__(self, format=format, table=table, mode=mode)
+
+    def apply(self, fields, row):
+        if row is not None:
+            self.counts["line_count"] += 1
+            self.counts["var_count"] += 1
+            t = (
+                str(row[4])
+                + ","
+                + str(row[1])
+                + "_"
+                + str(row[2])
+                + "_"
+                + str(row[3])
+            )
+            fields[7].append("miRNAsites=" + t.strip())
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = (
-                        str(rows[4])
-                        + ","
-                        + str(rows[1])
-                        + "_"
-                        + str(rows[2])
-                        + "_"
-                        + str(rows[3])
-                    )
-                    t = "miRNAsites=" + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ";" + t
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+    def writeLog(self, fh_log):
+        fh_log.write(
+            f"In miRNAsites: {str(self.counts['var_count'])} in "
+            + f"{str(self.counts['line_count'])} variants\n"
+        )
 
-    fh_log.write(
-        f"In miRNAsites: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithMiRNA(
+    vcf,
+    format="vcf",
+    table="targetScanS",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    mode="query",
+):
+    stage = MiRNAStage(format=format, table=table, mode=mode)
+    runStage(stage, vcf, tmpextin, tmpextout, sep)
 
 
 ### EOF
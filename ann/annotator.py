@@ -16,6 +16,9 @@ import subprocess
 from subprocess import Popen, PIPE
 from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError
 from botocore.client import Config
+from annotator_pool import AnnotatorPool
+from annotator_scheduler import (Backlog, Heartbeat, JobSlots, Tier,
+                                 TierScheduler, default_slots)
 
 # Get configuration
 from configparser import ConfigParser, ExtendedInterpolation
@@ -42,6 +45,148 @@ annotations_table = dynamodb.Table(db_table)
 sqs = boto3.resource('sqs', region_name=region)
 queue_url = config.get('sqs', 'QueueUrl')
 
+# Requests of premium users come in on a queue of their own, when one is
+# configured, and get a larger share of the free slots
+premium_queue_url = config.get('sqs', 'PremiumQueueUrl', fallback='')
+tiers = [Tier('free', sqs.Queue(queue_url),
+              config.getint('sqs', 'FreeWeight', fallback=1))]
+if premium_queue_url:
+    tiers.insert(0, Tier('premium', sqs.Queue(premium_queue_url),
+                         config.getint('sqs', 'PremiumWeight', fallback=3)))
+tier_scheduler = TierScheduler(
+    tiers, config.getint('sqs', 'MaxQueueWait', fallback=120))
+
+# Queue latency of each tier is printed, and sent to CloudWatch when a
+# namespace is set, every metrics_interval seconds
+metrics_interval = config.getint('sqs', 'MetricsInterval', fallback=300)
+metrics_namespace = config.get('sqs', 'MetricsNamespace', fallback='')
+cloudwatch = None
+if metrics_namespace:
+    cloudwatch = boto3.client('cloudwatch', region_name=region)
+
+# Warm workers that jobs are handed to; without them each job starts
+# run.py in a new process
+pool_workers = config.getint('ann', 'PoolWorkers', fallback=0)
+pool = None
+if pool_workers > 0:
+    pool = AnnotatorPool(pool_workers, '/home/ubuntu/gas/ann')
+
+# Jobs run at once; requests are only received for free slots
+job_slots = config.getint('ann', 'JobSlots', fallback=0)
+if job_slots <= 0:
+    job_slots = default_slots(config.getint('ann', 'JobMemoryMB', fallback=2048))
+if pool is not None:
+    job_slots = min(job_slots, pool_workers)
+
+# A request message stays on the queue, invisible, while its job runs;
+# the heartbeat pushes its visibility timeout back every interval
+visibility_timeout = config.getint('sqs', 'VisibilityTimeout', fallback=300)
+heartbeat_interval = config.getint('sqs', 'HeartbeatInterval', fallback=60)
+
+
+def extend_visibility(message):
+    try:
+        message.change_visibility(VisibilityTimeout=visibility_timeout)
+    except (BotoCoreError, ClientError) as e:
+        print(f"Error extending SQS message visibility: {e}")
+
+
+# Let a request held back in the backlog reappear on the queue at once
+def release_request(message):
+    try:
+        message.change_visibility(VisibilityTimeout=0)
+        print("message released")
+    except (BotoCoreError, ClientError) as e:
+        print(f"Error releasing SQS message: {e}")
+
+
+# Attempts at a job before it is marked FAILED and its request deleted
+max_attempts = config.getint('sqs', 'MaxAttempts', fallback=3)
+
+
+def delete_request(message):
+    try:
+        message.delete()
+        print("message deleted")
+    except (BotoCoreError, ClientError) as e:
+        print(f"Error deleting SQS message: {e}")
+    except Exception as e:
+        print(f"Unexpected error deleting message: {e}")
+
+
+"""
+Called when a job is done, or could not be started. The request message
+is deleted if the job succeeded. A failed job is attempted again when its
+message reappears on the queue, once its visibility timeout runs out,
+until it has been received max_attempts times; then it is marked FAILED
+and its message deleted.
+"""
+
+
+def finish_job(job_id, message, succeeded):
+    if succeeded:
+        delete_request(message)
+        return
+
+    attempts = int(message.attributes.get('ApproximateReceiveCount', 1))
+    if attempts < max_attempts:
+        print(f"Job {job_id} failed (attempt {attempts} of {max_attempts}); "
+              "its request will be received again")
+        return
+
+    print(f"Job {job_id} failed {attempts} times; giving up")
+    try:
+        annotations_table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET job_status = :status',
+            ExpressionAttributeValues={':status': 'FAILED'}
+        )
+    except (BotoCoreError, ClientError) as e:
+        print(f"Error updating DynamoDB: {e}")
+    delete_request(message)
+
+
+"""
+Marks a job RUNNING before it is started. A request received again for
+a job that has COMPLETED (or FAILED) since, e.g. because the message
+could not be deleted, is not run a second time: False is returned and
+the message is deleted
+"""
+
+
+def claim_job(job_id, message):
+    try:
+        annotations_table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET job_status = :status',
+            ConditionExpression='job_status IN (:pending_status, :status)',
+            ExpressionAttributeValues={
+                ':status': 'RUNNING',
+                ':pending_status': 'PENDING'
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            print(f"Job {job_id} is not PENDING or RUNNING; skipping it")
+            delete_request(message)
+            return False
+        print(f"Error updating DynamoDB: {e}")
+    except BotoCoreError as e:
+        print(f"Error updating DynamoDB: {e}")
+    return True
+
+
+# Requests received ahead of free slots, up to lookahead of them, and
+# started smallest input first; released to the queue again if held for
+# more than MaxBacklogWait seconds
+lookahead = config.getint('sqs', 'Lookahead', fallback=0)
+backlog = Backlog(config.getint('sqs', 'AgingHalfLife', fallback=120),
+                  config.getint('sqs', 'MaxBacklogWait', fallback=120))
+
+slots = JobSlots(job_slots, on_finish=finish_job)
+heartbeat = Heartbeat(slots, extend_visibility, heartbeat_interval, backlog,
+                      release_request)
+
 """
 Reads request messages from SQS and runs AnnTools as a subprocess.
 
@@ -54,33 +199,105 @@ bucket = config.get('s3', 'ResultsBucketName')
 keyPrefix = config.get('s3', 'KeyPrefix')
 
 
-def handle_requests_queue():
+"""
+Receives up to count requests from the queue of a tier, with the time
+each was sent, for TierScheduler.receive.
+"""
+
 
-    # Read messages from the queue
-    messages = sqs.Queue(queue_url).receive_messages(
-        MaxNumberOfMessages=int(config.get('sqs', 'MaxMessages')),
-        WaitTimeSeconds=int(config.get('sqs', 'WaitTime'))
+def receive_requests(tier, count, wait):
+    messages = tier.queue.receive_messages(
+        MaxNumberOfMessages=count,
+        WaitTimeSeconds=wait,
+        AttributeNames=['SentTimestamp', 'ApproximateReceiveCount']
     )
+    return [(message,
+             int(message.attributes.get('SentTimestamp', 0)) / 1000.0
+             or time.time())
+            for message in messages]
 
+
+def report_queue_latency():
+    for name, (count, mean, longest) in tier_scheduler.report().items():
+        print(f"Queue latency ({name}): {count} requests, "
+              f"mean {mean:.1f} s, max {longest:.1f} s")
+        if cloudwatch is None or count == 0:
+            continue
+        try:
+            dimensions = [{'Name': 'Tier', 'Value': name}]
+            cloudwatch.put_metric_data(
+                Namespace=metrics_namespace,
+                MetricData=[
+                    {'MetricName': 'RequestsReceived', 'Dimensions': dimensions,
+                     'Value': count, 'Unit': 'Count'},
+                    {'MetricName': 'QueueLatencyMean', 'Dimensions': dimensions,
+                     'Value': mean, 'Unit': 'Seconds'},
+                    {'MetricName': 'QueueLatencyMax', 'Dimensions': dimensions,
+                     'Value': longest, 'Unit': 'Seconds'}
+                ]
+            )
+        except (BotoCoreError, ClientError) as e:
+            print(f"Error sending queue latency to CloudWatch: {e}")
+
+
+def handle_requests_queue():
+
+    # Wait for a free slot, then read no more messages than there are
+    # free slots (and room in the backlog); the rest stay on the queue
+    # for other annotators. The slots are shared out between the tiers
+    # by tier_scheduler. While requests wait in the backlog, the queues
+    # are only checked, not long-polled
+    free = slots.wait()
+    wanted = min(free + lookahead - len(backlog),
+                 int(config.get('sqs', 'MaxMessages')))
+    messages = []
+    if wanted > 0:
+        wait_time = 0 if len(backlog) > 0 else int(config.get('sqs', 'WaitTime'))
+        messages = [message for tier, message in tier_scheduler.receive(
+            wanted, receive_requests, wait_time)]
+
+    # Keep all of them hidden while the jobs before them are started
+    for message in messages:
+        extend_visibility(message)
+
+    # A malformed request can never be run, so it is deleted right away
     for message in messages:
         try:
             sns_message = json.loads(message.body)
             message_data = json.loads(sns_message.get("Message", "{}"))
+            if not message_data.get("job_id"):
+                raise KeyError("job_id")
+            backlog.add(message, message_data,
+                        message_data.get("input_file_size"))
+        except json.JSONDecodeError:
+            print("Invalid JSON format in message.")
+            delete_request(message)
+        except KeyError as e:
+            print(f"Missing key in message: {e}")
+            delete_request(message)
+        except Exception as e:
+            print(f"Unexpected error when processing message: {e}")
+            delete_request(message)
 
+    # Start the smallest waiting jobs in the free slots
+    while len(backlog) > 0 and slots.free() > 0:
+        message, message_data = backlog.pop()
+        try:
             job_id = message_data.get("job_id")
             user_id = message_data.get("user_id")
             input_file_name = message_data.get("input_file_name")
             s3_inputs_bucket = message_data.get("s3_inputs_bucket")
             s3_key_input_file = message_data.get("s3_key_input_file")
 
-        except json.JSONDecodeError:
-            print("Invalid JSON format in message.")
         except KeyError as e:
             print(f"Missing key in message: {e}")
         except Exception as e:
             print(f"Unexpected error when processing message: {e}")
             continue
 
+        if not claim_job(job_id, message):
+            continue
+
         try:
             # Get the input file S3 object and copy it to a local file
             job_dir = f'/home/ubuntu/gas/ann/outputs/{job_id}'
@@ -93,59 +310,47 @@ def handle_requests_queue():
             print("file downloaded")
         except NoCredentialsError:
             print("AWS credentials not found.")
+            finish_job(job_id, message, False)
+            continue
         except (BotoCoreError, ClientError) as e:
             print(f"Error downloading file from S3: {e}")
+            finish_job(job_id, message, False)
+            continue
         except Exception as e:
             print(f"Unexpected error downloading file: {e}")
+            finish_job(job_id, message, False)
             continue
 
         try:
-            command = f'python /home/ubuntu/gas/ann/run.py {download_path} {job_id} {user_id} {input_file_name}'
-            subprocess.Popen(command, shell=True, cwd=job_dir)
+            if pool is not None:
+                job = pool.submit(download_path, job_id, user_id,
+                                  input_file_name, job_dir)
+            else:
+                command = f'python /home/ubuntu/gas/ann/run.py {download_path} {job_id} {user_id} {input_file_name}'
+                job = subprocess.Popen(command, shell=True, cwd=job_dir)
+            slots.add(job_id, job, message)
             print("file processed")
         except OSError as e:
             print(f"OS error occurred: {e}")
-        except Exception as e:
-            print(f"Unexpected error launching subprocess: {e}")
+            finish_job(job_id, message, False)
             continue
-
-        try:
-            # update data to dynamoDB
-            response = annotations_table.update_item(
-                Key={'job_id': job_id},
-                UpdateExpression='SET job_status = :status',
-                ConditionExpression='job_status = :pending_status',
-                ExpressionAttributeValues={
-                    ':status': 'RUNNING',
-                    ':pending_status': 'PENDING'
-                },
-                ReturnValues='UPDATED_NEW'
-            )
-
-            # check if the update was successful (the condition was met)
-            if 'Attributes' not in response:
-                print('Job status is not PENDING, cannot start processing.')
-        except (BotoCoreError, ClientError) as e:
-            print(f"Error updating DynamoDB: {e}")
         except Exception as e:
-            print(f"Unexpected error updating DynamoDB: {e}")
+            print(f"Unexpected error launching subprocess: {e}")
+            finish_job(job_id, message, False)
             continue
 
-        try:
-            # Delete the message
-            message.delete()
-            print("message deleted")
-        except (BotoCoreError, ClientError) as e:
-            print(f"Error deleting SQS message: {e}")
-        except Exception as e:
-            print(f"Unexpected error deleting message: {e}")
-
 
 def main():
 
-    # Poll queue for new results and process them
+    # Poll queue for new results and process them; the heartbeat keeps
+    # the requests of running jobs and deletes those of finished ones
+    heartbeat.start()
+    last_report = time.time()
     while True:
         handle_requests_queue()
+        if time.time() - last_report >= metrics_interval:
+            report_queue_latency()
+            last_report = time.time()
 
 
 if __name__ == "__main__":
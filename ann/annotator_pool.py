@@ -0,0 +1,120 @@
+# annotator_pool.py
+#
+# Pool of long-lived annotator workers
+#
+# Starting run.py for every job pays for a new interpreter, the boto3
+# import, new S3/DynamoDB/SNS clients and cold reference database
+# connections, and throws away the reference indexes the job loaded.
+# The workers of this pool are started once and kept: each imports
+# run.py (creating its clients and connection pool) when it starts,
+# keeps the indexes its jobs load (see lookup.keepIndexes) and runs the
+# jobs handed to it over the pool's queue with run.run_job.
+#
+# NOTE: This file lives on the AnnTools instance
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import multiprocessing
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+"""Runs once in each worker, before its first job
+"""
+
+
+def start_worker(base_dir):
+    # run.py and AnnTools are imported from the annotator directory
+    if base_dir not in sys.path:
+        sys.path.insert(0, base_dir)
+    os.chdir(base_dir)
+
+    import lookup
+    import run
+
+    lookup.keepIndexes()
+
+
+"""Runs one job in a worker, from the job directory as run.py would be
+"""
+
+
+def run_job(base_dir, job_dir, download_path, job_id, user_id, input_file_name):
+    import run
+
+    os.chdir(job_dir)
+    try:
+        return run.run_job(download_path, job_id, user_id, input_file_name)
+    finally:
+        # run.py deletes the job directory when it is done
+        os.chdir(base_dir)
+
+
+def report(job_id, future):
+    try:
+        if future.result() is False:
+            print(f"Job {job_id} failed")
+        else:
+            print(f"Job {job_id} finished")
+    except BrokenProcessPool:
+        print(f"Job {job_id} lost: its worker exited")
+    except Exception:
+        print(f"Job {job_id} failed:")
+        traceback.print_exc()
+
+
+"""Workers kept warm between jobs; submit takes the arguments of run.py
+   and replaces starting it with subprocess.Popen
+"""
+
+
+class AnnotatorPool(object):
+    def __init__(self, workers, base_dir):
+        self.workers = workers
+        self.base_dir = base_dir
+        self.executor = None
+
+    # Workers are started on demand, also after the annotator has started
+    # its threads (see annotator_scheduler.Heartbeat), so they are forked
+    # from a clean forkserver process rather than from the annotator
+    def start(self):
+        if not os.path.basename(sys.executable).startswith('python'):
+            # Under uwsgi, sys.executable is uwsgi itself
+            multiprocessing.set_executable(
+                os.path.join(sys.exec_prefix, 'bin', 'python'))
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('forkserver'),
+            initializer=start_worker,
+            initargs=(self.base_dir,))
+
+    # Queue a job for the next free worker; returns its future
+    def submit(self, download_path, job_id, user_id, input_file_name, job_dir):
+        args = (self.base_dir, job_dir, download_path, job_id, user_id,
+                input_file_name)
+        if self.executor is None:
+            self.start()
+        try:
+            future = self.executor.submit(run_job, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for its memory), which breaks
+            # the pool; start a new one
+            print("Annotator worker exited; restarting the worker pool")
+            self.executor.shutdown(wait=False)
+            self.start()
+            future = self.executor.submit(run_job, *args)
+        future.add_done_callback(lambda future: report(job_id, future))
+        return future
+
+    def shutdown(self, wait=True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+
+# EOF
@@ -0,0 +1,337 @@
+# annotator_scheduler.py
+#
+# Decides how many jobs the annotator takes on at once
+#
+# The annotator has a fixed number of job slots, set from the cores and
+# memory of the instance unless configured. A job holds a slot from its
+# launch until its run.py process (or pool worker) is done, and requests
+# are only received from SQS for the slots that are free, so that the
+# jobs this annotator cannot start yet stay on the queue for others.
+#
+# The request message of a job is kept until the job is done: a
+# heartbeat pushes its visibility timeout back while the job runs, and
+# it is deleted only once the job has succeeded. A job that fails, or an
+# annotator that dies, lets the message reappear for another attempt,
+# up to a number of attempts after which the job is marked FAILED and
+# the message deleted.
+#
+# Requests come in on one queue per user tier (premium and free). The
+# free slots are shared out between the tiers in proportion to their
+# weights, and a tier whose requests have waited longer than a limit is
+# served first, so that no tier starves while another is busy.
+#
+# A few more requests than there are free slots may be received and held
+# in a backlog, hidden by the heartbeat like running jobs; as slots free
+# up, the smallest input is started first, with the size of a request
+# counting for less the longer it waits. A request is only held for so
+# long: then the heartbeat lets it go back to the queue, for annotators
+# with a free slot, instead of hiding it again.
+#
+# NOTE: This file lives on the AnnTools instance
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import threading
+import time
+
+
+"""Job slots for an instance: one per core, as far as there is
+   job_memory_mb of memory for each
+"""
+
+
+def default_slots(job_memory_mb):
+    cores = os.cpu_count() or 1
+    try:
+        memory_mb = (os.sysconf('SC_PAGE_SIZE')
+                     * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024))
+    except (ValueError, OSError, AttributeError):
+        return cores
+    return max(1, min(cores, memory_mb // max(1, job_memory_mb)))
+
+
+"""The jobs running on this annotator, one per slot
+   A job is held as what launched it: the subprocess.Popen of its run.py
+   or the future of its pool worker (see annotator_pool.py), with the
+   request message it came in. When a job is found finished, on_finish
+   is called with its id, its message and whether it succeeded
+"""
+
+
+class JobSlots(object):
+    # Seconds between checks for finished jobs while all slots are taken
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, slots, on_finish=None):
+        self.slots = slots
+        self.on_finish = on_finish
+        self.running = {}
+        self.lock = threading.Lock()
+
+    def done(self, handle):
+        if hasattr(handle, 'poll'):
+            return handle.poll() is not None
+        return handle.done()
+
+    # run.py exits with status 0, and run_job returns True, on success
+    def succeeded(self, handle):
+        if hasattr(handle, 'poll'):
+            return handle.returncode == 0
+        return (not handle.cancelled() and handle.exception() is None
+                and handle.result() is not False)
+
+    # Let go of the slots of finished jobs
+    def reap(self):
+        with self.lock:
+            finished = [(job_id, job) for job_id, job in self.running.items()
+                        if self.done(job[0])]
+            for job_id, job in finished:
+                del self.running[job_id]
+        for job_id, (handle, message) in finished:
+            if self.on_finish is not None:
+                self.on_finish(job_id, message, self.succeeded(handle))
+
+    def free(self):
+        self.reap()
+        with self.lock:
+            return max(0, self.slots - len(self.running))
+
+    def add(self, job_id, handle, message=None):
+        with self.lock:
+            self.running[job_id] = (handle, message)
+
+    # The request messages of the running jobs
+    def messages(self):
+        with self.lock:
+            return [message for handle, message in self.running.values()
+                    if message is not None]
+
+    # Block until at least one slot is free; returns the free slots
+    def wait(self):
+        free = self.free()
+        while free == 0:
+            time.sleep(self.POLL_INTERVAL)
+            free = self.free()
+        return free
+
+
+"""Requests received but not started yet, started shortest job first
+   The size of a request (bytes of its input; 0 when unknown) is halved
+   for every half_life seconds it has waited, so that a large input is
+   not passed over for ever by a stream of small ones. A request waiting
+   more than max_wait seconds (if not 0) is expired
+"""
+
+
+class Backlog(object):
+    def __init__(self, half_life, max_wait=0):
+        self.half_life = half_life
+        self.max_wait = max_wait
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.requests)
+
+    def add(self, message, data, size):
+        with self.lock:
+            self.requests.append((time.time(), size or 0, message, data))
+
+    def score(self, request, now):
+        received, size, message, data = request
+        return size * 0.5 ** ((now - received) / self.half_life)
+
+    # The request to start next, as (message, data)
+    def pop(self):
+        now = time.time()
+        with self.lock:
+            best = min(self.requests,
+                       key=lambda request: (self.score(request, now),
+                                            request[0]))
+            self.requests.remove(best)
+        return best[2], best[3]
+
+    def messages(self):
+        with self.lock:
+            return [message for received, size, message, data
+                    in self.requests]
+
+    # Take out the requests that have waited too long; returns their
+    # messages
+    def expire(self):
+        if self.max_wait <= 0:
+            return []
+        now = time.time()
+        with self.lock:
+            expired = [request for request in self.requests
+                       if now - request[0] > self.max_wait]
+            for request in expired:
+                self.requests.remove(request)
+        return [message for received, size, message, data in expired]
+
+
+"""Keeps the request messages of running jobs invisible on the queue
+   Every interval seconds, finished jobs are reaped (so that their
+   messages are deleted, or left to reappear, soon after they end) and
+   extend is called with the message of each job still running, and of
+   each request waiting in backlog. Requests expired from backlog are
+   passed to release instead, to be made visible again
+"""
+
+
+class Heartbeat(threading.Thread):
+    def __init__(self, slots, extend, interval, backlog=None, release=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.slots = slots
+        self.extend = extend
+        self.interval = interval
+        self.backlog = backlog
+        self.release = release
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.beat()
+            except Exception as e:
+                print(f"Unexpected error in job heartbeat: {e}")
+
+    def beat(self):
+        self.slots.reap()
+        for message in self.slots.messages():
+            self.extend(message)
+        if self.backlog is not None:
+            for message in self.backlog.expire():
+                if self.release is not None:
+                    self.release(message)
+            for message in self.backlog.messages():
+                self.extend(message)
+
+
+"""A user tier and the queue its requests come in on
+   current is its standing in the weighted round robin; latencies are
+   the seconds its requests waited on the queue since the last report
+"""
+
+
+class Tier(object):
+    def __init__(self, name, queue, weight):
+        self.name = name
+        self.queue = queue
+        self.weight = weight
+        self.current = 0
+        self.latencies = []
+        self.last_latency = 0.0
+
+
+"""Shares the free slots out between the tiers and receives their
+   requests, weighted by tier (smooth weighted round robin); a tier
+   whose last request waited more than max_wait seconds is served first
+"""
+
+
+class TierScheduler(object):
+    def __init__(self, tiers, max_wait):
+        self.tiers = tiers
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+
+    # The tier with the next slot
+    def pick(self):
+        total = sum(tier.weight for tier in self.tiers)
+        for tier in self.tiers:
+            tier.current = tier.current + tier.weight
+        chosen = max(self.tiers, key=lambda tier: tier.current)
+        chosen.current = chosen.current - total
+        return chosen
+
+    # The slots of each tier, as (tier, slots) in the order to poll them:
+    # starved tiers first, then in the order the round robin reaches them
+    def allot(self, free):
+        starved = sorted(
+            [tier for tier in self.tiers if tier.last_latency > self.max_wait],
+            key=lambda tier: -tier.last_latency)
+        order = list(starved)
+        counts = dict((tier.name, 0) for tier in self.tiers)
+        for tier in starved[:free]:
+            counts[tier.name] = 1
+        for i in range(max(0, free - len(starved))):
+            tier = self.pick()
+            counts[tier.name] = counts[tier.name] + 1
+            if tier not in order:
+                order.append(tier)
+        order = order + [tier for tier in self.tiers if tier not in order]
+        return [(tier, counts[tier.name]) for tier in order]
+
+    def record(self, tier, latency):
+        with self.lock:
+            tier.latencies.append(latency)
+            tier.last_latency = latency
+
+    # Requests for up to free slots, as (tier, message)
+    # receive(tier, count, wait) long-polls the tier's queue for up to
+    # count messages and returns them with the time each was sent. The
+    # queues are polled without waiting, in the order of allot, and the
+    # slots a tier leaves unused go to the tiers after it; when all are
+    # empty, each is long-polled in turn for its share of wait_time (if
+    # wait_time is not 0). A short poll only samples the queue, so a tier
+    # keeps the latency of its last request until it is received again,
+    # or until a long poll of its queue comes back empty
+    def receive(self, free, receive, wait_time):
+        requests = []
+        spare = 0
+        empty = []
+        allotment = self.allot(free)
+        for tier, count in allotment:
+            count = count + spare
+            got = receive(tier, count, 0) if count > 0 else []
+            if len(got) < count:
+                empty.append(tier)
+            spare = count - len(got)
+            requests.extend((tier, message, sent) for message, sent in got)
+        for tier in self.tiers:
+            if spare == 0:
+                break
+            if tier in empty:
+                continue
+            got = receive(tier, spare, 0)
+            spare = spare - len(got)
+            requests.extend((tier, message, sent) for message, sent in got)
+
+        if len(requests) == 0 and wait_time > 0:
+            wait = max(1, wait_time // len(self.tiers))
+            for tier, count in allotment:
+                got = receive(tier, free, wait)
+                requests.extend((tier, message, sent) for message, sent in got)
+                if len(got) > 0:
+                    break
+                # Drained: nothing of the tier is left waiting
+                tier.last_latency = 0.0
+
+        now = time.time()
+        for tier, message, sent in requests:
+            self.record(tier, max(0.0, now - sent))
+        return [(tier, message) for tier, message, sent in requests]
+
+    # Queue latency of each tier since the last report, as
+    # name -> (requests, mean seconds, max seconds); starts a new period
+    def report(self):
+        metrics = {}
+        with self.lock:
+            for tier in self.tiers:
+                latencies = tier.latencies
+                tier.latencies = []
+                if len(latencies) == 0:
+                    metrics[tier.name] = (0, 0.0, 0.0)
+                else:
+                    metrics[tier.name] = (len(latencies),
+                                          sum(latencies) / len(latencies),
+                                          max(latencies))
+        return metrics
+
+# EOF
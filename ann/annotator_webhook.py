@@ -14,6 +14,7 @@ import boto3
 import json
 import os
 import subprocess
+import time
 from flask import Flask, request, jsonify
 
 # Create Flask app
@@ -23,6 +24,9 @@ from configparser import ConfigParser, ExtendedInterpolation
 import requests
 
 from annotator_webhook_config import Ann_Config
+from annotator_pool import AnnotatorPool
+from annotator_scheduler import (Heartbeat, JobSlots, Tier, TierScheduler,
+                                 default_slots)
 
 # Create Flask app
 app = Flask(__name__)
@@ -41,6 +45,18 @@ job_path = app.config["ANNOTATOR_JOBS_DIR"]
 queue_url = app.config["AWS_SQS_URL"]
 wait_time = app.config["AWS_SQS_WAIT_TIME"]
 max_messages = app.config["AWS_SQS_MAX_MESSAGES"]
+pool_workers = app.config["ANNOTATOR_POOL_WORKERS"]
+
+# Warm workers that jobs are handed to; without them each job starts
+# run.py in a new process
+pool = AnnotatorPool(pool_workers, base_path) if pool_workers > 0 else None
+
+# Jobs run at once; requests are only received for free slots
+job_slots = app.config["ANNOTATOR_JOB_SLOTS"]
+if job_slots <= 0:
+    job_slots = default_slots(app.config["ANNOTATOR_JOB_MEMORY_MB"])
+if pool is not None:
+    job_slots = min(job_slots, pool_workers)
 
 
 # Establish connections to AWS services
@@ -50,6 +66,111 @@ annotations_table = dynamodb.Table(db_table)
 # sns = boto3.client('sns', region_name=app.config["AWS_REGION_NAME"])
 sqs = boto3.client('sqs', region_name=app.config["AWS_REGION_NAME"])
 
+# A request message stays on the queue, invisible, while its job runs;
+# the heartbeat pushes its visibility timeout back every interval and
+# deletes the message once the job has succeeded
+visibility_timeout = app.config["AWS_SQS_VISIBILITY_TIMEOUT"]
+heartbeat_interval = app.config["AWS_SQS_HEARTBEAT_INTERVAL"]
+# Attempts at a job before it is marked FAILED and its request deleted
+max_attempts = app.config["AWS_SQS_MAX_ATTEMPTS"]
+
+
+# A request is held as (queue url, receipt handle, times received)
+def extend_visibility(request_message):
+    try:
+        sqs.change_message_visibility(
+            QueueUrl=request_message[0],
+            ReceiptHandle=request_message[1],
+            VisibilityTimeout=int(visibility_timeout)
+        )
+    except ClientError as e:
+        print(f"Error extending SQS message visibility: {str(e)}")
+
+
+def delete_request(request_message):
+    try:
+        sqs.delete_message(QueueUrl=request_message[0],
+                           ReceiptHandle=request_message[1])
+        print("messages deleted")
+    except ClientError as e:
+        print(f"messages delete failed: {str(e)}")
+
+
+# A failed job is attempted again when its request reappears, until the
+# request has been received max_attempts times
+def finish_job(job_id, request_message, succeeded):
+    if succeeded:
+        delete_request(request_message)
+        return
+
+    attempts = request_message[2]
+    if attempts < max_attempts:
+        print(f"Job {job_id} failed (attempt {attempts} of {max_attempts}); "
+              "its request will be received again")
+        return
+
+    print(f"Job {job_id} failed {attempts} times; giving up")
+    try:
+        annotations_table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET job_status = :status',
+            ExpressionAttributeValues={':status': 'FAILED'}
+        )
+    except (BotoCoreError, ClientError) as e:
+        print(f"Error updating DynamoDB: {e}")
+    delete_request(request_message)
+
+
+# Marks a job RUNNING before it is started; a request received again for
+# a job that has COMPLETED (or FAILED) since is deleted, not run again
+def claim_job(job_id, request_message):
+    try:
+        annotations_table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET job_status = :status',
+            ConditionExpression='job_status IN (:pending_status, :status)',
+            ExpressionAttributeValues={
+                ':status': 'RUNNING',
+                ':pending_status': 'PENDING'
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            print(f"Job {job_id} is not PENDING or RUNNING; skipping it")
+            delete_request(request_message)
+            return False
+        print(f"Error updating DynamoDB: {e}")
+    except BotoCoreError as e:
+        print(f"Error updating DynamoDB: {e}")
+    return True
+
+
+slots = JobSlots(job_slots, on_finish=finish_job)
+heartbeat = Heartbeat(slots, extend_visibility, int(heartbeat_interval))
+heartbeat.start()
+
+# Requests of premium users come in on a queue of their own, when one is
+# configured, and get a larger share of the free slots
+tiers = [Tier('free', queue_url, app.config["AWS_SQS_FREE_WEIGHT"])]
+if app.config["AWS_SQS_PREMIUM_URL"]:
+    tiers.insert(0, Tier('premium', app.config["AWS_SQS_PREMIUM_URL"],
+                         app.config["AWS_SQS_PREMIUM_WEIGHT"]))
+tier_scheduler = TierScheduler(tiers, app.config["AWS_SQS_MAX_QUEUE_WAIT"])
+
+
+def receive_requests(tier, count, wait):
+    response = sqs.receive_message(
+        QueueUrl=tier.queue,
+        MaxNumberOfMessages=count,
+        WaitTimeSeconds=wait,
+        AttributeNames=['SentTimestamp', 'ApproximateReceiveCount']
+    )
+    return [(message,
+             int(message.get('Attributes', {}).get('SentTimestamp', 0)) / 1000.0
+             or time.time())
+            for message in response.get('Messages', [])]
+
+
 @app.route("/process-job-request", methods=["POST"])
 def process_job_request():
     print("test check")
@@ -73,36 +194,45 @@ def process_job_request():
 
     # Process the SNS notification message
     if message['Type'] == 'Notification':
-        response = sqs.receive_message(
-            QueueUrl=queue_url,
-            MaxNumberOfMessages=int(max_messages),  
-            WaitTimeSeconds=int(wait_time)  
-        )
+        # Leave the request on the queue while all slots are taken; SNS
+        # retries the notification
+        free = slots.free()
+        if free == 0:
+            return jsonify(message="No free job slots."), 503
 
-        messages = response.get('Messages', [])
-        # print("messages: ", messages)
+        job_requests = tier_scheduler.receive(
+            min(free, int(max_messages)), receive_requests, int(wait_time))
 
-        if messages:
-            message_body = messages[0]['Body']
-            message_data = json.loads(message_body)
-            # print("message_data: ", message_data)
-            data_body = message_data['Message']
-            data = json.loads(data_body)
-            # print("data: ", data)
+        job_requests = [
+            (message, (tier.queue, message['ReceiptHandle'],
+                       int(message.get('Attributes', {})
+                           .get('ApproximateReceiveCount', 1))))
+            for tier, message in job_requests]
 
-            try: 
-                process_annotation_job(data)
-                try:
-                    # messages.delete()
-                    sqs.delete_message(
-                        QueueUrl=queue_url,
-                        ReceiptHandle=messages[0]['ReceiptHandle']
-                    )
-                    print("messages deleted")
-                except ClientError as e:
-                    print(f"messages delete failed: {str(e)}")
-                    return jsonify(message="messages delete failed."), 500
+        # Keep all of them hidden while the jobs before them are started
+        for message, request_message in job_requests:
+            extend_visibility(request_message)
 
+        for message, request_message in job_requests:
+            # A malformed request can never be run, so it is deleted
+            # right away
+            try:
+                message_body = message['Body']
+                message_data = json.loads(message_body)
+                # print("message_data: ", message_data)
+                data_body = message_data['Message']
+                data = json.loads(data_body)
+                # print("data: ", data)
+                if not data.get("job_id"):
+                    raise KeyError("job_id")
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                print(f"Malformed request message: {str(e)}")
+                delete_request(request_message)
+                continue
+
+            try: 
+                # The message is deleted by finish_job once the job is done
+                process_annotation_job(data, request_message)
             except Exception as e:
                 print(f"Process annotation failed: {str(e)}")
                 return jsonify(message="Process annotation failed"), 500
@@ -112,13 +242,22 @@ def process_job_request():
     return jsonify(message="Invalid message type received."), 400
 
 
+@app.route("/queue-latency", methods=["GET"])
+def queue_latency():
+    # Queue latency of each tier since the last call
+    metrics = {}
+    for name, (count, mean, longest) in tier_scheduler.report().items():
+        metrics[name] = {"requests": count, "mean": mean, "max": longest}
+    return jsonify(metrics), 200
+
+
 @app.route("/", methods=["GET"])
 def annotator_webhook():
 
     return ("Annotator webhook; POST job to /process-job-request"), 200
 
 
-def process_annotation_job(message_data):
+def process_annotation_job(message_data, request_message):
     # This function contains the core job processing logic from the original script
     try:
         print("process_annotation_job")
@@ -130,6 +269,9 @@ def process_annotation_job(message_data):
     except Exception as e:
         print(f"Unexpected error when processing message: {e}")
 
+    if not claim_job(job_id, request_message):
+        return
+
     # Get the input file S3 object and copy it to a local file
     try:
         job_dir = f'{job_path}/{job_id}'
@@ -139,39 +281,33 @@ def process_annotation_job(message_data):
         s3.download_file(s3_inputs_bucket, s3_key_input_file, download_path)
     except NoCredentialsError:
         print("AWS credentials not found.")
+        finish_job(job_id, request_message, False)
+        return
     except (BotoCoreError, ClientError) as e:
         print(f"Error downloading file from S3: {e}")
+        finish_job(job_id, request_message, False)
+        return
     except Exception as e:
         print(f"Unexpected error downloading file: {e}")
+        finish_job(job_id, request_message, False)
+        return
 
     try:
         # Launch the AnnTools pipeline
-        command = f'python {base_path}/run.py {download_path} {job_id} {user_id} {input_file_name}'
-        subprocess.Popen(command, shell=True, cwd=job_dir)
+        if pool is not None:
+            job = pool.submit(download_path, job_id, user_id, input_file_name, job_dir)
+        else:
+            command = f'python {base_path}/run.py {download_path} {job_id} {user_id} {input_file_name}'
+            job = subprocess.Popen(command, shell=True, cwd=job_dir)
+        slots.add(job_id, job, request_message)
     except subprocess.CalledProcessError as e:
         print(f"Subprocess failed with exit status {e.returncode}")
+        finish_job(job_id, request_message, False)
+        return
     except Exception as e:
         print(f"Unexpected error launching subprocess: {e}")
-
-    try:
-        # Update job status to RUNNING
-        response = annotations_table.update_item(
-            Key={'job_id': job_id},
-            UpdateExpression='SET job_status = :status',
-            ConditionExpression='job_status = :pending_status',
-            ExpressionAttributeValues={
-                ':status': 'RUNNING',
-                ':pending_status': 'PENDING'
-            },
-            ReturnValues='UPDATED_NEW'
-        )
-    # check if the update was successful (the condition was met)
-        if 'Attributes' not in response:
-            print('Job status is not PENDING, cannot start processing.')
-    except (BotoCoreError, ClientError) as e:
-        print(f"Error updating DynamoDB: {e}")
-    except Exception as e:
-        print(f"Unexpected error updating DynamoDB: {e}")
+        finish_job(job_id, request_message, False)
+        return
 
 # EOF
 
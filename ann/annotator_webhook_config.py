@@ -29,6 +29,12 @@ class Ann_Config(object):
 
     ANNOTATOR_BASE_DIR = "/home/ubuntu/gas/ann"
     ANNOTATOR_JOBS_DIR = f"{ANNOTATOR_BASE_DIR}/outputs"
+    # Warm worker processes kept between jobs; 0 starts run.py per job
+    ANNOTATOR_POOL_WORKERS = 0
+    # Jobs run at once (0 sets it from the cores, and the memory at
+    # ANNOTATOR_JOB_MEMORY_MB per job)
+    ANNOTATOR_JOB_SLOTS = 0
+    ANNOTATOR_JOB_MEMORY_MB = 2048
 
     AWS_REGION_NAME = (
         os.environ["AWS_REGION_NAME"]
@@ -47,6 +53,20 @@ class Ann_Config(object):
     AWS_SQS_WAIT_TIME = 10
     AWS_SQS_MAX_MESSAGES = 1
     AWS_SQS_URL="https://sqs.us-east-1.amazonaws.com/127134666975/chenhui1_a14_job_requests"
+    # Seconds a request stays hidden while its job runs, pushed back every
+    # AWS_SQS_HEARTBEAT_INTERVAL seconds; it is deleted once the job succeeds
+    AWS_SQS_VISIBILITY_TIMEOUT = 300
+    AWS_SQS_HEARTBEAT_INTERVAL = 60
+    # Times a request is received (its job attempted) before the job is
+    # marked FAILED and the request deleted
+    AWS_SQS_MAX_ATTEMPTS = 3
+    # Queue of premium user requests (None: all come in on AWS_SQS_URL) and
+    # the share of the free slots of each queue; a queue whose requests
+    # have waited more than AWS_SQS_MAX_QUEUE_WAIT seconds is served first
+    AWS_SQS_PREMIUM_URL = None
+    AWS_SQS_PREMIUM_WEIGHT = 3
+    AWS_SQS_FREE_WEIGHT = 1
+    AWS_SQS_MAX_QUEUE_WAIT = 120
 
     # AWS DynamoDB
     AWS_DYNAMODB_ANNOTATIONS_TABLE = f"{iam_username}_annotations"
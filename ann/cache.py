@@ -0,0 +1,198 @@
+# cache.py
+#
+# Caches of reference lookups
+#
+# ResultCache stores what each stage's lookup (fetch) returned for a
+# variant, keyed by the version of the reference data, the stage and the
+# record columns the lookup reads. It is backed by an SQLite file shared by
+# all jobs on an annotator and trimmed least recently used first once it
+# grows past its size cap. SiteMemo remembers the lookups of one job so
+# that sites repeated in the input are looked up once.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Trim to this fraction of the cap when the cap is exceeded
+LOW_WATER = 0.9
+
+# SQLite limits the number of parameters of a statement
+CHUNK_SIZE = 500
+
+
+"""Cache of lookup results in the SQLite file at path, up to max_bytes
+   Keys are prefixed with version by the stages that use the cache, so
+   processes on different reference versions share the file without
+   seeing each other's entries; those of an old version are no longer
+   read and go first when the cache is trimmed. The total size of the
+   entries is kept in the file by triggers, so that every process
+   sharing it sees the same, also when an entry is replaced
+"""
+
+
+class ResultCache(object):
+    def __init__(self, path, version, max_bytes=1024 * 1024 * 1024):
+        self.path = path
+        self.version = str(version)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("pragma journal_mode=wal;")
+        # The rows insert or replace overwrites go through the delete trigger
+        self.conn.execute("pragma recursive_triggers=on;")
+        self.conn.execute("begin immediate;")
+        self.conn.execute(
+            "create table if not exists entries ("
+            "key text primary key, value blob, size integer, used real);"
+        )
+        self.conn.execute("create index if not exists entries_used on entries(used);")
+        self.conn.execute("create table if not exists total (size integer);")
+        self.conn.execute(
+            "insert into total select coalesce(sum(size), 0) from entries "
+            "where not exists (select 1 from total);"
+        )
+        self.conn.execute(
+            "create trigger if not exists entries_insert after insert on entries "
+            "begin update total set size = size + new.size; end;"
+        )
+        self.conn.execute(
+            "create trigger if not exists entries_delete after delete on entries "
+            "begin update total set size = size - old.size; end;"
+        )
+        self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    # A copy sent to another process opens the file again
+    def __getstate__(self):
+        return (self.path, self.version, self.max_bytes)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    # Results for keys; keys that are not cached are left out
+    def get(self, keys):
+        found = {}
+        with self.lock:
+            for first in range(0, len(keys), CHUNK_SIZE):
+                chunk = list(keys[first : first + CHUNK_SIZE])
+                rows = self.conn.execute(
+                    "select key, value from entries where key in ("
+                    + ",".join("?" * len(chunk))
+                    + ");",
+                    chunk,
+                ).fetchall()
+                for key, value in rows:
+                    found[key] = pickle.loads(value)
+
+            if len(found) > 0:
+                now = time.time()
+                self.conn.executemany(
+                    "update entries set used = ? where key = ?;",
+                    [(now, key) for key in found],
+                )
+                self.conn.commit()
+        return found
+
+    def put(self, items):
+        now = time.time()
+        entries = []
+        for key, result in items:
+            value = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+            entries.append((key, value, len(value), now))
+
+        with self.lock:
+            self.conn.executemany(
+                "insert or replace into entries values (?, ?, ?, ?);", entries
+            )
+            if self.size() > self.max_bytes:
+                self.evict()
+            self.conn.commit()
+
+    # Bytes of all the entries in the file, by whichever process
+    def size(self):
+        return self.conn.execute("select size from total;").fetchone()[0]
+
+    # Drop the least recently used entries down to LOW_WATER of the cap
+    def evict(self):
+        size = self.size()
+        target = self.max_bytes * LOW_WATER
+
+        while size > target:
+            rows = self.conn.execute(
+                "select key, size from entries order by used limit ?;", (CHUNK_SIZE,)
+            ).fetchall()
+            if len(rows) == 0:
+                break
+
+            drop = []
+            for key, entrySize in rows:
+                drop.append((key,))
+                size = size - entrySize
+                if size <= target:
+                    break
+            self.conn.executemany("delete from entries where key = ?;", drop)
+
+
+"""Lookup results of the sites of one job, for records repeating a site
+
+   While the input is position sorted, repeats of a site are adjacent,
+   so only the results for the current site are kept. Once a record goes
+   back (unsorted input) the memo keeps every site, dropping the least
+   recently used beyond maxsize.
+"""
+
+
+class SiteMemo(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        # key -> (site, result), least recently used first
+        self.entries = OrderedDict()
+        self.site = None
+        self.chroms = set()
+        self.sorted = True
+
+    # Move to the site (chrom, pos) of the next record
+    def advance(self, chrom, pos):
+        site = (chrom, pos)
+        if self.sorted and site != self.site:
+            if self.site is not None and (
+                (chrom == self.site[0] and pos < self.site[1])
+                or (chrom != self.site[0] and chrom in self.chroms)
+            ):
+                self.sorted = False
+            else:
+                self.entries.clear()
+            self.chroms.add(chrom)
+        self.site = site
+
+    def get(self, key):
+        if key not in self.entries:
+            return (False, None)
+        self.entries.move_to_end(key)
+        return (True, self.entries[key][1])
+
+    def put(self, key, site, result):
+        if self.sorted and site != self.site:
+            return
+        self.entries[key] = (site, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+### EOF
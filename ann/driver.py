@@ -12,166 +12,245 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import sys
 import os
+import functools
 import file_utils as fu
 import annotate as ann
+import pipeline
+import snapshot as snap
+import cache as rc
+import planner
+import lookup
 
 
-def run(infile, format):
+"""The annotation stages, in the order they are applied
+   interval_mode picks the lookup used by the interval overlap stages,
+   dbsnp_mode the one used by dbSNP ("query", "index", "window" or
+   "batch") and genes_mode the one used for refGene transcripts ("query",
+   "window" or "batch"). A mode of "auto" takes the plan for the table
+   from plans (see planLookups), or "query" if there is none
+"""
 
-    print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format="vcf", tmpextin="", tmpextout=".1")
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
+def stages(
+    format="vcf",
+    interval_mode="query",
+    dbsnp_mode="query",
+    genes_mode="query",
+    plans=None,
+):
+    plans = plans or {}
 
-    ann.getBigRefGene(
-        vcf=infile,
-        format="vcf",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    def planned(mode, table):
+        if mode == "auto":
+            return plans.get(table, "query")
+        return mode
 
-    ann.getGenes(
-        vcf=infile,
-        format="vcf",
-        table="refGene",
-        promoter_offset=500,
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    interval_stages = [
+        ann.CytobandStage(
+            format=format, table="cytoBand", mode=planned(interval_mode, "cytoBand")
+        ),
+        ann.GadAllStage(
+            format=format, table="gadAll", mode=planned(interval_mode, "gadAll")
+        ),
+        ann.GwasCatalogStage(
+            format=format,
+            table="gwasCatalog",
+            mode=planned(interval_mode, "gwasCatalog"),
+        ),
+        ann.MiRNAStage(
+            format=format,
+            table="targetScanS",
+            mode=planned(interval_mode, "targetScanS"),
+        ),
+        ann.HugoGeneNomenclatureStage(
+            format=format, table="hugo", mode=planned(interval_mode, "hugo")
+        ),
+    ]
+    for table in [
+        "dgv_Cnv",
+        "abParts_IG_T_CelReceptors",
+        "mcCarroll_Cnv",
+        "conrad_Cnv",
+    ]:
+        interval_stages.append(
+            ann.CnvDatabaseStage(
+                format=format, table=table, mode=planned(interval_mode, table)
+            )
+        )
+    interval_stages.append(
+        ann.GenomicSuperDupsStage(
+            format=format,
+            table="genomicSuperDups",
+            mode=planned(interval_mode, "genomicSuperDups"),
+        )
     )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
 
-    ann.addOverlapWithCytoband(
-        vcf=infile,
-        format="vcf",
-        table="cytoBand",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    return (
+        [
+            ann.DbSnpStage(format=format, mode=planned(dbsnp_mode, "dbSNP")),
+            ann.BigRefGeneStage(format=format),
+            ann.GenesStage(
+                format=format,
+                table="refGene",
+                promoter_offset=500,
+                mode=planned(genes_mode, "refGene"),
+            ),
+        ]
+        + interval_stages
+        + [ann.TfbsConsSitesStage(format=format, table="tfbsConsSites")]
     )
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
 
-    ann.addOverlapWithGadAll(
-        vcf=infile,
-        format="vcf",
-        table="gadAll",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
 
-    ann.addOverlapWithGwasCatalog(
-        vcf=infile,
-        format="vcf",
-        table="gwasCatalog",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+"""Plan the lookups of the stages whose mode is "auto" for infile
+   Returns table -> planner.StagePlan
+"""
 
-    ann.addOverlapWithMiRNA(
-        vcf=infile,
-        format="vcf",
-        table="targetScanS",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
 
-    ann.addOverlapWitHUGOGeneNomenclature(
-        vcf=infile,
-        format="vcf",
-        table="hugo",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+def planLookups(infile, interval_mode, dbsnp_mode, genes_mode, stats=None):
+    auto = []
+    for stage in stages():
+        if isinstance(stage, ann.IntervalStage):
+            mode = interval_mode
+        elif isinstance(stage, ann.DbSnpStage):
+            mode = dbsnp_mode
+        elif isinstance(stage, ann.GenesStage):
+            mode = genes_mode
+        else:
+            continue
+        if mode == "auto":
+            auto.append(stage)
+    return planner.planStages(infile, auto, stats=stats)
 
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="dgv_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
 
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="abParts_IG_T_CelReceptors",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+"""Where the staged engine keeps the checkpoints of a job on infile
+"""
 
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="mcCarroll_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
 
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="conrad_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+def checkpointDir(infile):
+    return infile + ".stages"
+
 
-    ann.addOverlapWithGenomicSuperDups(
-        vcf=infile,
+def run(
+    infile,
+    format,
+    interval_mode="query",
+    snapshot=None,
+    dbsnp_mode="query",
+    workers=1,
+    threads=1,
+    cache=None,
+    reference_version="",
+    cache_max_mb=1024,
+    dedup=0,
+    genes_mode="query",
+    engine="sync",
+    window=pipeline.WINDOW,
+    on_checkpoint=None,
+    table_stats=None,
+):
+
+    print("Running . . .")
+    if engine not in ("sync", "async", "staged"):
+        raise ValueError(f"Unknown annotation engine '{engine}'")
+
+    # Read the reference tables from a local snapshot instead of the database
+    reference = None
+    if snapshot:
+        reference = snap.Snapshot(snapshot)
+        print(f"Using reference snapshot {reference.version}")
+
+    # Indexes and row counts kept by a long-lived worker from earlier jobs
+    # are only good for the reference data they were read from
+    version = reference.version if reference is not None else reference_version
+    if lookup.useReferenceVersion(version):
+        planner.rowCounts.clear()
+
+    # Lookups cached by earlier jobs stay valid for the same reference data
+    lookup_cache = None
+    if cache:
+        lookup_cache = rc.ResultCache(
+            cache, version, max_bytes=int(cache_max_mb) * 1024 * 1024
+        )
+
+    # Lookups left to the planner are picked for this input; a snapshot
+    # answers every lookup locally, so there is nothing to plan
+    plans = {}
+    if reference is None:
+        stats = None
+        if table_stats:
+            stats = planner.TableStats(table_stats, version)
+        plans = planLookups(infile, interval_mode, dbsnp_mode, genes_mode, stats=stats)
+
+    make_stages = functools.partial(
+        stages,
         format="vcf",
-        table="genomicSuperDups",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(
-        vcf=infile,
-        table="tfbsConsSites",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+        interval_mode=interval_mode,
+        dbsnp_mode=dbsnp_mode,
+        genes_mode=genes_mode,
+        plans=plans,
     )
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + "." + str(i))
+    if workers > 1:
+        # Shards of the input are annotated in worker processes
+        pipeline_stages = pipeline.runParallel(
+            infile,
+            infile + ".annot",
+            make_stages,
+            workers,
+            logfile=infile + ".count.log",
+            snapshot=reference,
+            threads=threads,
+            cache=lookup_cache,
+            dedup=dedup,
+        )
+    elif engine == "staged":
+        # One stage at a time over the whole input, records handed on in
+        # binary record files; an interrupted job resumes from the last
+        # stage it completed
+        pipeline_stages = make_stages()
+        resumed = pipeline.runStaged(
+            infile,
+            infile + ".annot",
+            pipeline_stages,
+            checkpointDir(infile),
+            logfile=infile + ".count.log",
+            snapshot=reference,
+            cache=lookup_cache,
+            dedup=dedup,
+            on_checkpoint=on_checkpoint,
+        )
+        if resumed > 0:
+            print(f"Resumed after {resumed} of {len(pipeline_stages)} stages")
+    elif engine == "async":
+        # Batches are pipelined through the stages, window at a time
+        pipeline_stages = make_stages()
+        pipeline.runAsync(
+            infile,
+            infile + ".annot",
+            pipeline_stages,
+            logfile=infile + ".count.log",
+            snapshot=reference,
+            window=window,
+            cache=lookup_cache,
+            dedup=dedup,
+        )
+    else:
+        # All stages run in a single pass over the input; no temp files
+        pipeline_stages = make_stages()
+        pipeline.run(
+            infile,
+            infile + ".annot",
+            pipeline_stages,
+            logfile=infile + ".count.log",
+            snapshot=reference,
+            threads=threads,
+            cache=lookup_cache,
+            dedup=dedup,
+        )
+    if lookup_cache is not None:
+        lookup_cache.close()
+    for stage in pipeline_stages:
+        print(f"{stage.label} - done.")
 
-    os.rename(infile + "." + str(tmpextin), infile + ".annot")
     finalout = (infile + ".annot").replace(".vcf.annot", ".annot.vcf")
     os.rename(infile + ".annot", finalout)
 
@@ -0,0 +1,424 @@
+# lookup.py
+#
+# Reference table lookups for the interval annotation stages
+#
+# A lookup answers "which rows of this table overlap chrom:pos" and
+# returns them in the order the reference database returns them
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import heapq
+
+import utils as u
+
+# Indexes kept for the life of the process, once keepIndexes has been
+# called, and the reference version they were loaded from; until then
+# each lookup loads its own
+sharedIndexes = None
+sharedVersion = None
+
+
+"""Keep the indexes loaded by lookups (and the dbSNP stage) for the life
+   of the process, so that the next job in a long-lived worker (see
+   annotator_pool.py) finds the chromosomes already loaded
+"""
+
+
+def keepIndexes():
+    global sharedIndexes
+    if sharedIndexes is None:
+        sharedIndexes = {}
+
+
+"""Note the reference version of the job about to run; the kept indexes
+   are dropped when it is not the one they were loaded from. Returns True
+   if they were dropped
+"""
+
+
+def useReferenceVersion(version):
+    global sharedVersion
+    if sharedIndexes is None or version == sharedVersion:
+        return False
+    stale = sharedVersion is not None
+    sharedIndexes.clear()
+    sharedVersion = version
+    return stale
+
+
+"""The index for key: a new one made by factory, or the one kept for the
+   process under key
+"""
+
+
+def sharedIndex(key, factory):
+    if sharedIndexes is None:
+        return factory()
+    if key not in sharedIndexes:
+        sharedIndexes[key] = factory()
+    return sharedIndexes[key]
+
+
+"""One SELECT per variant against the reference database
+"""
+
+
+class PointLookup(object):
+    def __init__(self, cursor, table, chromColumn, startName, endName):
+        self.cursor = cursor
+        self.table = table
+        self.chromColumn = chromColumn
+        self.startName = startName
+        self.endName = endName
+
+    def find(self, chr, pos):
+        sql = (
+            "select * from "
+            + self.table
+            + " where "
+            + self.chromColumn
+            + " = %s AND ("
+            + self.startName
+            + " <= %s AND %s <= "
+            + self.endName
+            + ");"
+        )
+        pos = int(pos)
+        return u.execute(self.cursor, sql, (str(chr), pos, pos)).fetchall()
+
+
+"""Sends the variants of a batch as probes of one SELECT (utils.probeRows)
+   and hands each variant the rows overlapping it
+"""
+
+
+class BatchLookup(object):
+    def __init__(self, cursor, table, chromColumn, startName, endName):
+        self.cursor = cursor
+        self.table = table
+        self.condition = (
+            "t."
+            + chromColumn
+            + " = p.chrom AND t."
+            + startName
+            + " <= p.pos AND p.pos <= t."
+            + endName
+        )
+
+    # Rows overlapping each (chr, pos) of sites
+    def findBatch(self, sites):
+        probes = [(str(chr), int(pos)) for chr, pos in sites]
+        matches = u.probeRows(
+            self.cursor, self.table, ("chrom", "pos"), probes, self.condition
+        )
+        return [tuple(rows) for rows in matches]
+
+    def find(self, chr, pos):
+        return self.findBatch([(chr, pos)])[0]
+
+
+"""Loads all rows of a table for a chromosome once, sorted by start, and
+   answers overlaps with a sweep line over the variant positions
+
+   Intervals whose start has been passed sit in a heap keyed by end and
+   drop out once the sweep moves beyond them, so position-sorted input
+   costs a few comparisons per variant. findBatch sweeps the sites of a
+   batch in position order, whatever their order in the input. Once the
+   input goes back (to an earlier position, or a chromosome the sweep has
+   left) it is not sorted, and an IndexLookup answers from then on
+"""
+
+
+class SweepLookup(object):
+    def __init__(self, cursor, table, chromColumn, startName, endName):
+        self.cursor = cursor
+        self.table = table
+        self.chromColumn = chromColumn
+        self.startName = startName
+        self.endName = endName
+
+        # [(start, end, order, row)] of the current chromosome, by start
+        self.intervals = []
+        self.chrom = None
+        self.lastpos = None
+        self.next = 0
+        self.active = []
+        # Chromosomes the sweep has left
+        self.passed = set()
+        # The lookup used once the input is found not to be sorted
+        self.fallback = None
+
+    def loadChrom(self, chr):
+        sql = "select * from " + self.table + " where " + self.chromColumn + " = %s;"
+        rows = u.execute(self.cursor, sql, (str(chr),)).fetchall()
+        names = [d[0] for d in self.cursor.description]
+        startIndex = names.index(self.startName)
+        endIndex = names.index(self.endName)
+
+        # Keep the database order so overlaps come back as a point query would
+        intervals = [
+            (int(row[startIndex]), int(row[endIndex]), order, row)
+            for order, row in enumerate(rows)
+        ]
+        intervals.sort(key=lambda interval: interval[0])
+        return intervals
+
+    def restart(self, chr):
+        if self.chrom is not None:
+            self.passed.add(self.chrom)
+        self.intervals = self.loadChrom(chr)
+        self.chrom = chr
+        self.next = 0
+        self.active = []
+
+    def find(self, chr, pos):
+        pos = int(pos)
+        if self.fallback is None and (
+            chr in self.passed or (chr == self.chrom and pos < self.lastpos)
+        ):
+            self.fallback = IndexLookup(
+                self.cursor, self.table, self.chromColumn, self.startName, self.endName
+            )
+            self.intervals = []
+            self.active = []
+        if self.fallback is not None:
+            return self.fallback.find(chr, pos)
+
+        if chr != self.chrom:
+            self.restart(chr)
+        self.lastpos = pos
+
+        intervals = self.intervals
+        while self.next < len(intervals) and intervals[self.next][0] <= pos:
+            start, end, order, row = intervals[self.next]
+            heapq.heappush(self.active, (end, order, row))
+            self.next = self.next + 1
+
+        while len(self.active) > 0 and self.active[0][0] < pos:
+            heapq.heappop(self.active)
+
+        hits = sorted(self.active, key=lambda interval: interval[1])
+        return tuple(row for end, order, row in hits)
+
+    # The chromosomes of a batch are swept in the order they first appear
+    # in it, the positions of each in ascending order
+    def findBatch(self, sites):
+        chroms = {}
+        for i, (chr, pos) in enumerate(sites):
+            chroms.setdefault(chr, []).append((int(pos), i))
+
+        results = [None] * len(sites)
+        for chr, group in chroms.items():
+            group.sort()
+            for pos, i in group:
+                results[i] = self.find(chr, pos)
+        return results
+
+
+"""Loads each chromosome once into an in-memory interval index
+   (utils.IntervalIndex); answers any position in any order locally
+   columns limits the columns of the rows returned, as in a SELECT
+"""
+
+
+class IndexLookup(object):
+    def __init__(self, cursor, table, chromColumn, startName, endName, columns="*"):
+        self.cursor = cursor
+        self.table = table
+        self.chromColumn = chromColumn
+        self.startName = startName
+        self.endName = endName
+        self.columns = columns
+        self.index = sharedIndex(
+            ("interval", table, chromColumn, startName, endName, columns),
+            u.IntervalIndex,
+        )
+
+    def find(self, chr, pos):
+        if chr not in self.index:
+            u.loadIntervalIndex(
+                self.cursor,
+                self.table,
+                chromColumn=self.chromColumn,
+                startName=self.startName,
+                endName=self.endName,
+                chrom=chr,
+                index=self.index,
+                columns=self.columns,
+            )
+        return self.index.query(chr, int(pos))
+
+
+"""Fetches all rows overlapping a window [pos, pos + width] with one
+   SELECT and answers the following variants locally until one falls
+   outside the window; suited to position-sorted input
+
+   The width adapts to the density of the input: it doubles while a
+   window serves few variants before the next one lands just past it,
+   and halves while it serves many, holds too many rows, or the input
+   jumps back (unsorted input)
+"""
+
+
+class WindowLookup(object):
+    MIN_WIDTH = 1000
+    MAX_WIDTH = 10000000
+    # Variants a window should serve, and rows it may hold
+    TARGET = 64
+    MAX_ROWS = 50000
+
+    def __init__(self, cursor, table, chromColumn, startName, endName, width=100000):
+        self.cursor = cursor
+        self.table = table
+        self.chromColumn = chromColumn
+        self.startName = startName
+        self.endName = endName
+        self.width = width
+        self.columns = None
+
+        self.chrom = None
+        self.start = None
+        self.end = None
+        self.rows = 0
+        self.served = 0
+        self.index = None
+
+    def adapt(self, chr, start):
+        if self.chrom is None:
+            return
+        if self.rows > self.MAX_ROWS or (chr == self.chrom and start < self.start):
+            self.width = self.width // 2
+        elif (
+            self.served < self.TARGET // 2
+            and chr == self.chrom
+            and start <= self.end + self.width
+        ):
+            self.width = self.width * 2
+        elif self.served > self.TARGET * 2:
+            self.width = self.width // 2
+        self.width = min(max(self.width, self.MIN_WIDTH), self.MAX_WIDTH)
+
+    def load(self, chr, start, end):
+        self.adapt(chr, start)
+        self.chrom = chr
+        self.start = start
+        self.end = max(end, start + self.width)
+
+        sql = (
+            "select * from "
+            + self.table
+            + " where "
+            + self.chromColumn
+            + " = %s AND "
+            + self.startName
+            + " <= %s AND "
+            + self.endName
+            + " >= %s;"
+        )
+        args = (str(chr), int(self.end), int(self.start))
+        rows = u.execute(self.cursor, sql, args).fetchall()
+        self.columns = [d[0] for d in self.cursor.description]
+        startIndex = self.columns.index(self.startName)
+        endIndex = self.columns.index(self.endName)
+
+        self.index = u.IntervalIndex()
+        self.index.add(
+            chr,
+            [int(row[startIndex]) for row in rows],
+            [int(row[endIndex]) for row in rows],
+            rows,
+        )
+        self.rows = len(rows)
+        self.served = 0
+
+    # All rows overlapping [start, end]
+    def findRange(self, chr, start, end):
+        if chr != self.chrom or start < self.start or end > self.end:
+            self.load(chr, start, end)
+        self.served = self.served + 1
+        return self.index.queryRange(chr, start, end)
+
+    def find(self, chr, pos):
+        pos = int(pos)
+        return self.findRange(chr, pos, pos)
+
+
+"""Answers from a table of an exported reference snapshot (see snapshot.py)
+"""
+
+
+class SnapshotLookup(object):
+    def __init__(self, table, startName, endName):
+        if (table.startName, table.endName) != (startName, endName):
+            raise ValueError(
+                f"Snapshot table '{table.name}' is indexed on "
+                f"{table.startName}/{table.endName}, not {startName}/{endName}"
+            )
+        self.table = table
+
+    def find(self, chr, pos):
+        return self.table.query(chr, int(pos))
+
+
+"""Picks the lookup for each chromosome from a plan (planner.StagePlan);
+   the lookup of each mode in the plan is created on first use
+"""
+
+
+class PlannedLookup(object):
+    def __init__(self, plan, cursor, table, chromColumn, startName, endName):
+        self.plan = plan
+        self.args = (cursor, table, chromColumn, startName, endName)
+        self.lookups = {}
+
+    def lookupFor(self, chr):
+        mode = self.plan.mode(chr)
+        if mode not in self.lookups:
+            self.lookups[mode] = create(mode, *self.args)
+        return self.lookups[mode]
+
+    def find(self, chr, pos):
+        return self.lookupFor(chr).find(chr, pos)
+
+    # The sites of chromosomes planned for a lookup that takes batches
+    # ("batch", "sweep") go to it together
+    def findBatch(self, sites):
+        results = [None] * len(sites)
+        batched = {}
+        for i, (chr, pos) in enumerate(sites):
+            found = self.lookupFor(chr)
+            if hasattr(found, "findBatch"):
+                batched.setdefault(self.plan.mode(chr), []).append(i)
+            else:
+                results[i] = found.find(chr, pos)
+        for mode, indices in batched.items():
+            hits = self.lookups[mode].findBatch([sites[i] for i in indices])
+            for i, rows in zip(indices, hits):
+                results[i] = rows
+        return results
+
+
+lookups = {
+    "query": PointLookup,
+    "sweep": SweepLookup,
+    "index": IndexLookup,
+    "window": WindowLookup,
+    "batch": BatchLookup,
+}
+
+
+"""Create the lookup for the given mode ("query", "sweep", "index",
+   "window" or "batch")
+"""
+
+
+def create(mode, cursor, table, chromColumn, startName, endName):
+    if mode not in lookups:
+        raise ValueError(f"Unknown lookup mode '{mode}'")
+    return lookups[mode](cursor, table, chromColumn, startName, endName)
+
+
+### EOF
@@ -0,0 +1,723 @@
+# pipeline.py
+#
+# Single-pass annotation engine
+#
+# Reads the input VCF once, splits each record once and hands the
+# fields to every stage in turn; the annotated record is written once
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import asyncio
+import hashlib
+import json
+import math
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import record
+import utils as u
+
+"""Run the stages over infile and write the annotated file to outfile
+   Stages are applied in list order; the count log is written at the end.
+   Stages read from snapshot (a snapshot.Snapshot) when one is given.
+   Records are annotated batch_size at a time, so stages can look up a
+   whole batch at once (see Stage.fetchBatch). With threads > 1 the
+   lookups of independent stages run concurrently (see annotateBatch).
+   With a cache (a cache.ResultCache) lookups are kept across jobs, and
+   with dedup > 0 records repeating a site reuse its lookup (up to dedup
+   sites are remembered)
+"""
+
+BATCH_SIZE = 1000
+
+
+def run(
+    infile,
+    outfile,
+    stages,
+    logfile=None,
+    sep="\t",
+    snapshot=None,
+    batch_size=BATCH_SIZE,
+    threads=1,
+    cache=None,
+    dedup=0,
+):
+    for stage in stages:
+        stage.open(snapshot=snapshot, cache=cache, dedup=dedup)
+
+    executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+    try:
+        with open(infile) as fh, open(outfile, "w") as fh_out:
+            batch = []
+            for line in fh:
+                batch.append(line)
+                if len(batch) >= batch_size:
+                    writeBatch(
+                        fh_out, annotateBatch(batch, stages, sep=sep, executor=executor)
+                    )
+                    batch = []
+            writeBatch(fh_out, annotateBatch(batch, stages, sep=sep, executor=executor))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        for stage in stages:
+            stage.close()
+
+    if logfile is not None:
+        writeLog(logfile, stages)
+
+
+def writeBatch(fh_out, lines):
+    for line in lines:
+        fh_out.write(line + "\n")
+
+
+"""Annotate a single line of input with every stage
+"""
+
+
+def annotateLine(line, stages, sep="\t"):
+    return annotateBatch([line], stages, sep=sep)[0]
+
+
+"""Annotate a batch of lines with every stage
+   Each stage decides for itself whether a line is a header it passes
+   through untouched; a line is only split if some stage needs fields.
+   Stages see the batch one after the other, which gives the same result
+   as running every stage over each line in turn: a stage only changes
+   the fields of the record it is given.
+
+   Results are always applied in stage order, so INFO keys come out in
+   the canonical order. With an executor, the lookup (lookupBatch) of a
+   stage is started as soon as the stages it depends on (see schedule)
+   have been applied, and runs alongside the lookups of the others
+"""
+
+
+def annotateBatch(lines, stages, sep="\t", executor=None):
+    lines, records, batches = splitBatch(lines, stages, sep=sep)
+
+    if executor is None:
+        for stage, batch in zip(stages, batches):
+            if len(batch) > 0:
+                stage.annotateBatch(batch)
+    else:
+        dependencies = schedule(stages)
+        futures = {}
+        applied = set()
+        for k, stage in enumerate(stages):
+            for j, other in enumerate(stages):
+                if j not in futures and dependencies[j] <= applied:
+                    futures[j] = executor.submit(other.lookupBatch, batches[j])
+            for fields, result in zip(batches[k], futures[k].result()):
+                stage.apply(fields, result)
+            applied.add(k)
+
+    return joinBatch(lines, records)
+
+
+"""Split the lines of a batch into the records each stage sees
+   Returns the stripped lines, their fields (None for lines no stage
+   needs) and, for every stage, the fields of the records it annotates.
+   The INFO column of a record is a record.Info until joinBatch writes
+   it back out
+"""
+
+
+def splitBatch(lines, stages, sep="\t"):
+    lines = [line.strip() for line in lines]
+    records = [None] * len(lines)
+
+    batches = []
+    for stage in stages:
+        batch = []
+        for i, line in enumerate(lines):
+            if stage.isHeader(line):
+                continue
+            if records[i] is None:
+                records[i] = record.split(line, sep=sep)
+            batch.append(records[i])
+        batches.append(batch)
+    return lines, records, batches
+
+
+def joinBatch(lines, records):
+    return [
+        line if fields is None else record.join(fields)
+        for line, fields in zip(lines, records)
+    ]
+
+
+"""The stages each stage depends on, as sets of positions in stages
+   A stage depends on an earlier stage that writes a column it reads;
+   stages that only append to INFO are independent of one another
+"""
+
+
+def schedule(stages):
+    dependencies = []
+    for k, stage in enumerate(stages):
+        reads = set(stage.inputs)
+        dependencies.append(set(j for j in range(k) if reads & set(stages[j].outputs)))
+    return dependencies
+
+
+"""Run the stages over infile with the batches pipelined on an event loop
+   Up to window batches are in flight at once. Every stage works through
+   the batches in input order on its own connection; its lookup for a
+   batch is started as soon as it has looked up the batch before and the
+   stages it depends on (see schedule) have been applied to this one, so
+   while one stage waits on the database for a batch the others do so for
+   the next ones. Lookups run in worker threads (the stages and the
+   database driver are synchronous); results are applied on the event
+   loop in stage order and batches are written in input order, so the
+   output is the one run writes
+"""
+
+WINDOW = 4
+
+
+def runAsync(
+    infile,
+    outfile,
+    stages,
+    logfile=None,
+    sep="\t",
+    snapshot=None,
+    batch_size=BATCH_SIZE,
+    window=WINDOW,
+    cache=None,
+    dedup=0,
+):
+    for stage in stages:
+        stage.open(snapshot=snapshot, cache=cache, dedup=dedup)
+
+    try:
+        with open(infile) as fh, open(outfile, "w") as fh_out:
+            asyncio.run(
+                annotateAsync(
+                    readBatches(fh, batch_size), fh_out, stages, sep=sep, window=window
+                )
+            )
+    finally:
+        for stage in stages:
+            stage.close()
+
+    if logfile is not None:
+        writeLog(logfile, stages)
+
+
+def readBatches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    yield batch
+
+
+"""Progress of one batch through the stages, for annotateAsync
+"""
+
+
+class BatchState(object):
+    def __init__(self, lines, stages, sep="\t"):
+        self.lines, self.records, self.batches = splitBatch(lines, stages, sep=sep)
+        # Set once a stage has looked up, and once it has applied, the batch
+        self.looked = [asyncio.Event() for stage in stages]
+        self.applied = [asyncio.Event() for stage in stages]
+
+
+async def annotateAsync(batches, fh_out, stages, sep="\t", window=WINDOW):
+    loop = asyncio.get_running_loop()
+    dependencies = schedule(stages)
+    # A stage has at most one lookup in flight, so one thread per stage
+    executor = ThreadPoolExecutor(max_workers=max(1, len(stages)))
+    slots = asyncio.Semaphore(max(1, window))
+
+    async def annotateStage(k, state, previous):
+        stage = stages[k]
+        batch = state.batches[k]
+        # The stage's lookups (and its memo) see the batches in input order
+        if previous is not None:
+            await previous.looked[k].wait()
+        for j in dependencies[k]:
+            await state.applied[j].wait()
+        results = []
+        if len(batch) > 0:
+            results = await loop.run_in_executor(executor, stage.lookupBatch, batch)
+        state.looked[k].set()
+
+        if k > 0:
+            await state.applied[k - 1].wait()
+        for fields, result in zip(batch, results):
+            stage.apply(fields, result)
+        state.applied[k].set()
+
+    async def annotate(state, previous):
+        try:
+            await asyncio.gather(
+                *[annotateStage(k, state, previous) for k in range(len(stages))]
+            )
+            return joinBatch(state.lines, state.records)
+        finally:
+            slots.release()
+
+    pending = []
+    try:
+        previous = None
+        for lines in batches:
+            await slots.acquire()
+            state = BatchState(lines, stages, sep=sep)
+            pending.append(asyncio.ensure_future(annotate(state, previous)))
+            previous = state
+
+            # Write out the batches that are done, in input order
+            while len(pending) > 0 and pending[0].done():
+                writeBatch(fh_out, pending.pop(0).result())
+
+        for task in pending:
+            writeBatch(fh_out, await task)
+    finally:
+        for task in pending:
+            task.cancel()
+        executor.shutdown()
+
+
+"""Run the stages over infile one after the other, each over all of it
+   The records are handed from stage to stage in binary record files (see
+   record.py) in workdir, so a record is split from text once, when infile
+   is read, and joined once, when outfile is written. A stage holds its
+   database connection only while it runs.
+
+   Every stage output is a checkpoint: it is written under a temporary
+   name, renamed, and then described by a marker (see writeMarker) naming
+   the stage and the checksums of its input and output. A run finding
+   valid checkpoints in workdir (e.g. after the node running the job was
+   reclaimed) resumes after the last one. on_checkpoint, if given, is
+   called with the files of each new checkpoint and those no longer
+   needed, so that they can be kept elsewhere (see run.py). Returns the
+   number of stages the run resumed after
+"""
+
+
+def runStaged(
+    infile,
+    outfile,
+    stages,
+    workdir,
+    logfile=None,
+    sep="\t",
+    snapshot=None,
+    batch_size=BATCH_SIZE,
+    cache=None,
+    dedup=0,
+    on_checkpoint=None,
+):
+    os.makedirs(workdir, exist_ok=True)
+    resumed = resumePoint(infile, stages, workdir)
+
+    if resumed < 0:
+        # Lines every stage passes through are kept as they are
+        with open(infile) as fh, record.RecordWriter(
+            stagePath(workdir, 0) + ".tmp"
+        ) as writer:
+            for line in fh:
+                line = line.strip()
+                if all(stage.isHeader(line) for stage in stages):
+                    writer.write(line)
+                else:
+                    writer.write(record.split(line, sep=sep))
+        checkpoint(
+            workdir, 0, None, fileChecksum(infile), writer.checksum(), on_checkpoint
+        )
+
+    for k in range(max(resumed, 0), len(stages)):
+        stage = stages[k]
+        stage.open(snapshot=snapshot, cache=cache, dedup=dedup)
+        try:
+            with record.RecordReader(stagePath(workdir, k)) as reader:
+                with record.RecordWriter(stagePath(workdir, k + 1) + ".tmp") as writer:
+                    annotateStage(stage, reader, writer, batch_size)
+        finally:
+            stage.close()
+        checkpoint(
+            workdir,
+            k + 1,
+            stage,
+            readMarker(workdir, k)["output"],
+            writer.checksum(),
+            on_checkpoint,
+        )
+
+    with record.RecordReader(stagePath(workdir, len(stages))) as reader, open(
+        outfile, "w"
+    ) as fh_out:
+        for item in reader:
+            if not isinstance(item, str):
+                item = record.join(item)
+            fh_out.write(item + "\n")
+    shutil.rmtree(workdir)
+
+    if logfile is not None:
+        writeLog(logfile, stages)
+    return max(resumed, 0)
+
+
+def stagePath(workdir, k):
+    return os.path.join(workdir, f"stage-{k:02d}.rec")
+
+
+def markerPath(workdir, k):
+    return os.path.join(workdir, f"stage-{k:02d}.json")
+
+
+def fileChecksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# What a checkpoint was made by: the input conversion or a stage and the
+# settings its results depend on
+def stageName(stage):
+    if stage is None:
+        return "input"
+    return "\t".join(stage.cacheKey())
+
+
+"""Complete checkpoint k: move its output in place, write its marker and
+   drop the output of checkpoint k - 1, which is no longer needed
+"""
+
+
+def checkpoint(workdir, k, stage, inputChecksum, outputChecksum, on_checkpoint):
+    path = stagePath(workdir, k)
+    os.replace(path + ".tmp", path)
+    writeMarker(
+        workdir,
+        k,
+        {
+            "stage": stageName(stage),
+            "input": inputChecksum,
+            "output": outputChecksum,
+            "counts": stage.counts if stage is not None else {},
+        },
+    )
+
+    stale = []
+    if k > 0 and os.path.exists(stagePath(workdir, k - 1)):
+        os.remove(stagePath(workdir, k - 1))
+        stale.append(stagePath(workdir, k - 1))
+    if on_checkpoint is not None:
+        on_checkpoint([path, markerPath(workdir, k)], stale)
+
+
+def writeMarker(workdir, k, marker):
+    path = markerPath(workdir, k)
+    with open(path + ".tmp", "w") as fh:
+        json.dump(marker, fh)
+    os.replace(path + ".tmp", path)
+
+
+def readMarker(workdir, k):
+    try:
+        with open(markerPath(workdir, k)) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+"""The last checkpoint in workdir a run over infile can resume after
+   The markers must chain from the checksum of infile through the stages
+   in order, and the output of the last one must be intact. The counts of
+   the stages done are restored from their markers. Returns the number of
+   stages done, or -1 if not even the input conversion can be reused
+"""
+
+
+def resumePoint(infile, stages, workdir):
+    if readMarker(workdir, 0) is None:
+        return -1
+
+    checksum = fileChecksum(infile)
+    chain = []
+    for k in range(len(stages) + 1):
+        marker = readMarker(workdir, k)
+        stage = stages[k - 1] if k > 0 else None
+        if (
+            marker is None
+            or marker["stage"] != stageName(stage)
+            or marker["input"] != checksum
+        ):
+            break
+        chain.append(marker)
+        checksum = marker["output"]
+
+    for k in reversed(range(len(chain))):
+        path = stagePath(workdir, k)
+        if os.path.exists(path) and fileChecksum(path) == chain[k]["output"]:
+            for stage, marker in zip(stages, chain[1 : k + 1]):
+                stage.counts = dict(marker["counts"])
+            return k
+    return -1
+
+
+"""Annotate the records read from reader with one stage and write them,
+   along with the lines passed through, to writer
+"""
+
+
+def annotateStage(stage, reader, writer, batch_size=BATCH_SIZE):
+    for items in readBatches(reader, batch_size):
+        batch = [
+            item
+            for item in items
+            if not isinstance(item, str) and not stage.isHeader(item[0])
+        ]
+        if len(batch) > 0:
+            stage.annotateBatch(batch)
+        for item in items:
+            writer.write(item)
+
+
+"""Run the stages over infile in parallel worker processes
+   Records are split into shards by chromosome (see shardPlan) and each
+   shard is annotated by a fresh set of stages from makeStages, which must
+   be picklable (e.g. a functools.partial of a module-level function).
+   Nothing of the input is held in memory: it is streamed once to count
+   the records of each chromosome and once into a file per shard, each
+   worker streams its shard file into an annotated one, and the output is
+   streamed together line by line in input order. The counts of every
+   shard are added up into the stages returned, which also hold the
+   lookup plans, so that their log is the one a single pass would write
+"""
+
+
+def runParallel(
+    infile,
+    outfile,
+    makeStages,
+    workers,
+    logfile=None,
+    sep="\t",
+    snapshot=None,
+    batch_size=BATCH_SIZE,
+    threads=1,
+    cache=None,
+    dedup=0,
+):
+    stages = makeStages()
+
+    # Lines every stage passes through stay where they are; the rest are
+    # records, each sent to the shard owning it
+    def isRecord(line):
+        return not all(stage.isHeader(line) for stage in stages)
+
+    chromCounts = {}
+    with open(infile) as fh:
+        for line in fh:
+            line = line.strip()
+            if isRecord(line):
+                chrom = line.split(sep, 1)[0]
+                chromCounts[chrom] = chromCounts.get(chrom, 0) + 1
+    share, owners = shardPlan(chromCounts, workers)
+    shards = len(set(shard for pieces in owners.values() for shard in pieces))
+
+    def shardLines(fh):
+        seen = {}
+        for line in fh:
+            line = line.strip()
+            if not isRecord(line):
+                yield None, line
+                continue
+            chrom = line.split(sep, 1)[0]
+            k = seen.get(chrom, 0)
+            seen[chrom] = k + 1
+            yield owners[chrom][k // share], line
+
+    workdir = tempfile.mkdtemp(
+        prefix=".shards-", dir=os.path.dirname(os.path.abspath(outfile))
+    )
+    try:
+        inPaths = [os.path.join(workdir, f"shard-{k:02d}.in") for k in range(shards)]
+        outPaths = [os.path.join(workdir, f"shard-{k:02d}.out") for k in range(shards)]
+        shardFiles = [open(path, "w") for path in inPaths]
+        try:
+            with open(infile) as fh:
+                for shard, line in shardLines(fh):
+                    if shard is not None:
+                        shardFiles[shard].write(line + "\n")
+        finally:
+            for fh_shard in shardFiles:
+                fh_shard.close()
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=u.resetPool) as pool:
+            futures = [
+                pool.submit(
+                    annotateShard,
+                    makeStages,
+                    inPath,
+                    outPath,
+                    sep,
+                    snapshot,
+                    batch_size,
+                    threads,
+                    cache,
+                    dedup,
+                )
+                for inPath, outPath in zip(inPaths, outPaths)
+            ]
+            for future in futures:
+                mergeCounts(stages, future.result())
+
+        # Each shard file is in input order, so the next line of the shard
+        # owning a record is its annotation
+        annotated = [open(path) for path in outPaths]
+        try:
+            with open(infile) as fh, open(outfile, "w") as fh_out:
+                for shard, line in shardLines(fh):
+                    if shard is not None:
+                        line = annotated[shard].readline().rstrip("\n")
+                    fh_out.write(line + "\n")
+        finally:
+            for fh_shard in annotated:
+                fh_shard.close()
+    finally:
+        shutil.rmtree(workdir)
+
+    if logfile is not None:
+        writeLog(logfile, stages)
+    return stages
+
+
+"""Annotate the lines of the shard file inpath in a worker process
+   The annotated lines are written to outpath, in the same order.
+   Returns the counts of every stage
+"""
+
+
+def annotateShard(
+    makeStages,
+    inpath,
+    outpath,
+    sep="\t",
+    snapshot=None,
+    batch_size=BATCH_SIZE,
+    threads=1,
+    cache=None,
+    dedup=0,
+):
+    stages = makeStages()
+    for stage in stages:
+        stage.open(snapshot=snapshot, cache=cache, dedup=dedup)
+
+    executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+    try:
+        with open(inpath) as fh, open(outpath, "w") as fh_out:
+            lines = (line.rstrip("\n") for line in fh)
+            for batch in readBatches(lines, batch_size):
+                writeBatch(
+                    fh_out, annotateBatch(batch, stages, sep=sep, executor=executor)
+                )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        for stage in stages:
+            stage.close()
+
+    return [stage.counts for stage in stages]
+
+
+def mergeCounts(stages, counts):
+    for stage, shardCounts in zip(stages, counts):
+        for key, count in shardCounts.items():
+            stage.counts[key] = stage.counts.get(key, 0) + count
+
+
+"""Split the records of each chromosome (chrom -> count) into at most
+   shards shards
+   A chromosome with more than its share of the records is cut into runs
+   of consecutive records (position ranges, for a sorted file). The
+   pieces are then dealt out largest first to the least loaded shard.
+   Returns the share and chrom -> the shard of each of its pieces: the
+   k-th record of a chromosome goes to shard owners[chrom][k // share]
+"""
+
+
+def shardPlan(chromCounts, shards):
+    share = max(1, math.ceil(sum(chromCounts.values()) / max(1, shards)))
+    pieces = []
+    for chrom, count in chromCounts.items():
+        for first in range(0, count, share):
+            pieces.append((min(share, count - first), chrom, first // share))
+
+    pieces.sort(key=lambda piece: piece[0], reverse=True)
+    loads = [0] * min(shards, len(pieces))
+    owners = dict(
+        (chrom, [0] * math.ceil(count / share)) for chrom, count in chromCounts.items()
+    )
+    for size, chrom, k in pieces:
+        shard = loads.index(min(loads))
+        loads[shard] = loads[shard] + size
+        owners[chrom][k] = shard
+
+    return share, owners
+
+
+"""Write the per-stage counts to the count log, in stage order
+   followed by the share of records that reused the lookup of a repeated
+   site, the cache hit rates and the lookups the planner picked, when
+   those were used
+"""
+
+
+def writeLog(logfile, stages):
+    mode = "a"
+    if any(stage.logmode == "w" for stage in stages):
+        mode = "w"
+
+    with open(logfile, mode) as fh_log:
+        for stage in stages:
+            stage.writeLog(fh_log)
+
+        deduped = [stage for stage in stages if "dedup_records" in stage.counts]
+        if len(deduped) > 0:
+            fh_log.write("Repeated sites:\n")
+        for stage in deduped:
+            reused = stage.counts["dedup_reused"]
+            records = stage.counts["dedup_records"]
+            ratio = (reused / float(records)) * 100 if records > 0 else 0.0
+            fh_log.write(
+                f"In {stage.label}: {reused} of {records} records "
+                + f"reused ({ratio:.1f}%)\n"
+            )
+
+        cached = [stage for stage in stages if "cache_hits" in stage.counts]
+        if len(cached) > 0:
+            fh_log.write("Lookup cache:\n")
+        for stage in cached:
+            hits = stage.counts["cache_hits"]
+            lookups = hits + stage.counts["cache_misses"]
+            rate = (hits / float(lookups)) * 100 if lookups > 0 else 0.0
+            fh_log.write(
+                f"In {stage.label}: {hits} hits in {lookups} lookups ({rate:.1f}%)\n"
+            )
+
+        planned = [stage for stage in stages if stage.plan is not None]
+        if len(planned) > 0:
+            fh_log.write("Lookup plan:\n")
+        for stage in planned:
+            fh_log.write(stage.plan.describe() + "\n")
+
+
+### EOF
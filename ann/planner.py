@@ -0,0 +1,287 @@
+# planner.py
+#
+# Picks the reference lookup of each stage (and chromosome) for a job
+#
+# Which lookup is cheapest depends on how many variants there are on a
+# chromosome and how many reference rows they are looked up in: a few
+# variants are best sent to the database, many are best served from the
+# chromosome loaded once. The planner counts the variants of the input
+# in a quick pre-scan, reads the row counts of the reference tables
+# (counted once for each reference version and kept in a file, see
+# TableStats) and estimates the cost of every lookup the stage supports
+# with the model below.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import json
+import math
+import os
+
+import utils as u
+import lookup
+
+# Cost model, in estimated milliseconds
+# A statement sent to the database and waited for
+ROUND_TRIP = 1.0
+# The database finding the rows of one variant with its index
+SEEK = 0.02
+# A reference row sent over and loaded into memory
+ROW = 0.002
+
+# Row counts of the tables read in this process
+rowCounts = {}
+
+
+"""Variants on each chromosome of a VCF
+   Returns chrom -> (variants, first position, last position, sorted),
+   where sorted means the records of the chromosome are in one run, in
+   position order
+"""
+
+
+def scanInput(infile, sep="\t"):
+    chroms = {}
+    last = None
+    with open(infile) as fh:
+        for line in fh:
+            if line.startswith("#") or line.startswith("CHROM"):
+                continue
+            columns = line.split(sep, 2)
+            if len(columns) < 2:
+                continue
+            chrom = columns[0].strip()
+            pos = int(columns[1].strip())
+
+            if chrom not in chroms:
+                chroms[chrom] = [0, pos, pos, True]
+            scan = chroms[chrom]
+            if chrom != last and scan[0] > 0:
+                # The chromosome was left and comes back
+                scan[3] = False
+            elif pos < scan[2]:
+                scan[3] = False
+            scan[0] = scan[0] + 1
+            scan[1] = min(scan[1], pos)
+            scan[2] = max(scan[2], pos)
+            last = chrom
+
+    return dict((chrom, tuple(scan)) for chrom, scan in chroms.items())
+
+
+"""Row counts of the reference tables, kept in a JSON file across jobs
+   Counting a large table (dbSNP) takes a while, so each table is counted
+   once for a reference version, by the first job that plans it; the file
+   holds the counts of the current version only
+"""
+
+
+class TableStats(object):
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.counts = self.load().get(version, {})
+
+    def load(self):
+        try:
+            with open(self.path) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, name):
+        if name not in self.counts:
+            return None
+        return dict((chrom, tuple(entry)) for chrom, entry in self.counts[name].items())
+
+    def put(self, name, counts):
+        self.counts[name] = counts
+        # Keep the counts other jobs stored since this one read the file
+        stored = self.load().get(self.version, {})
+        stored[name] = counts
+        temp = f"{self.path}.{os.getpid()}"
+        with open(temp, "w") as fh:
+            json.dump({self.version: stored}, fh)
+        os.replace(temp, self.path)
+
+
+"""Rows of table on each chromosome, with the extent of their intervals
+   Returns chrom -> (rows, lowest start, highest end). The counts are
+   kept in stats (a TableStats) when one is given
+"""
+
+
+def tableRows(cursor, table, chromColumn, startName, endName, stats=None):
+    name = "\t".join(["rows", table, chromColumn, startName, endName])
+    if name in rowCounts:
+        return rowCounts[name]
+    if stats is not None:
+        counts = stats.get(name)
+        if counts is not None:
+            rowCounts[name] = counts
+            return counts
+
+    sql = (
+        "select "
+        + ", ".join(
+            [chromColumn, "count(*)", "min(" + startName + ")", "max(" + endName + ")"]
+        )
+        + " from "
+        + table
+        + " group by "
+        + chromColumn
+        + ";"
+    )
+    counts = dict(
+        (str(chrom), (int(rows), int(start), int(end)))
+        for chrom, rows, start, end in u.execute(cursor, sql).fetchall()
+    )
+    if stats is not None:
+        stats.put(name, counts)
+    rowCounts[name] = counts
+    return counts
+
+
+"""Estimated cost of looking up variants (a pre-scan entry) in rows (a
+   tableRows entry) with each mode
+"""
+
+
+def estimate(mode, variants, rows):
+    count, first, last, inOrder = variants
+    tableRows, start, end = rows
+
+    if mode == "query":
+        return count * (ROUND_TRIP + SEEK)
+    if mode == "batch":
+        return math.ceil(count / u.PROBE_CHUNK) * ROUND_TRIP + count * SEEK
+    if mode in ("index", "sweep"):
+        return ROUND_TRIP + tableRows * ROW
+    if mode == "window":
+        if not inOrder:
+            return None
+        # Windows laid end to end over the variants, each holding its
+        # share of the rows of the chromosome
+        width = lookup.WindowLookup.MIN_WIDTH
+        loads = min(count, (last - first) // width + 1)
+        share = min(1.0, loads * width / float(max(1, end - start + 1)))
+        return loads * (ROUND_TRIP + SEEK) + tableRows * share * ROW
+    return None
+
+
+"""The lookup mode of one stage for each chromosome
+   A plan is given to a stage in place of its mode; chromosomes the plan
+   does not know use the default, the mode cheapest overall
+"""
+
+
+class StagePlan(object):
+    def __init__(self, table, modes, costs, default):
+        self.table = table
+        self.modes = modes
+        self.costs = costs
+        self.default = default
+
+    def mode(self, chrom):
+        return self.modes.get(chrom, self.default)
+
+    def cost(self):
+        return sum(self.costs.values())
+
+    # One line for the count log, e.g.
+    # "In cytoBand: index on chr1, chr2; query on chrM (est. 3.2 ms)"
+    def describe(self):
+        byMode = {}
+        for chrom in sorted(self.modes):
+            byMode.setdefault(self.modes[chrom], []).append(chrom)
+        if len(byMode) == 0:
+            byMode[self.default] = []
+        return (
+            f"In {self.table}: "
+            + "; ".join(
+                mode + " on " + (", ".join(chroms) if chroms else "no chromosomes")
+                for mode, chroms in byMode.items()
+            )
+            + f" (est. {self.cost():.1f} ms)"
+        )
+
+
+"""Plan the lookups of a stage from the pre-scan of the input (scan)
+   Stages with planChroms pick a mode for each chromosome, the others
+   one mode for all of them
+"""
+
+
+def planStage(stage, scan, cursor, stats=None):
+    counts = tableRows(
+        cursor,
+        stage.table,
+        stage.chromColumn,
+        stage.startName,
+        stage.endName,
+        stats=stats,
+    )
+
+    # The variants of each chromosome, named as in the table
+    variants = {}
+    for chrom, entry in scan.items():
+        variants[stage.chromName(chrom)] = entry
+
+    # costs[mode][chrom]; modes that do not suit a chromosome are left out
+    costs = {}
+    for mode in stage.modes:
+        costs[mode] = {}
+        for chrom, entry in variants.items():
+            cost = estimate(mode, entry, counts.get(chrom, (0, 0, 0)))
+            if cost is not None:
+                costs[mode][chrom] = cost
+
+    # The cheapest mode that suits every chromosome; the first on a tie
+    default = stage.modes[0]
+    usable = [mode for mode in stage.modes if len(costs[mode]) == len(variants)]
+    if len(usable) > 0:
+        default = min(usable, key=lambda mode: sum(costs[mode].values()))
+
+    modes = {}
+    for chrom in variants:
+        if stage.planChroms:
+            modes[chrom] = min(
+                [mode for mode in stage.modes if chrom in costs[mode]],
+                key=lambda mode: costs[mode][chrom],
+            )
+        else:
+            modes[chrom] = default
+    return StagePlan(
+        stage.table,
+        modes,
+        dict((chrom, costs[mode][chrom]) for chrom, mode in modes.items()),
+        default,
+    )
+
+
+"""Plan the lookups of stages for the records of infile
+   Returns table -> StagePlan; the counts are read through a connection
+   borrowed from the process-wide pool
+"""
+
+
+def planStages(infile, stages, stats=None, sep="\t"):
+    if len(stages) == 0:
+        return {}
+
+    scan = scanInput(infile, sep=sep)
+    conn = u.getPool().acquire()
+    cursor = conn.cursor()
+    try:
+        return dict(
+            (stage.table, planStage(stage, scan, cursor, stats=stats))
+            for stage in stages
+        )
+    finally:
+        cursor.close()
+        u.getPool().release(conn)
+
+
+### EOF
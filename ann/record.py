@@ -0,0 +1,286 @@
+# record.py
+#
+# Records being annotated
+#
+# A record is the list of its columns, as split from the input line.
+# While the stages run, the INFO column is held as an Info, which keeps
+# what the stages append as a list of fragments; the column is turned
+# back into text once, when the record is written.
+#
+# Between stages run one after the other (see pipeline.runStaged) the
+# records are kept in a binary record file: a magic string and version,
+# then length-prefixed frames. A frame is a line passed through as is, a
+# chromosome name (given a number the first time it appears), or a
+# record as its chromosome number, its position as an int32 and its
+# other columns as length-prefixed UTF-8 strings. Records whose position
+# does not fit are kept with all their columns as strings.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import hashlib
+import struct
+
+# Position of the INFO column in a VCF record
+INFO = 7
+
+
+"""INFO column of a record, built up from fragments
+   The text the record came with is the first fragment; separators are
+   fragments of their own. The key=value pairs are parsed on first use
+   of get and again only after the column has changed
+"""
+
+
+class Info(object):
+    def __init__(self, text):
+        self.fragments = [text]
+        self.values = None
+
+    def __str__(self):
+        return "".join(self.fragments)
+
+    # The first n characters of the column
+    def head(self, n):
+        text = ""
+        for fragment in self.fragments:
+            text = text + fragment
+            if len(text) >= n:
+                break
+        return text[:n]
+
+    def endsWith(self, suffix):
+        text = ""
+        for fragment in reversed(self.fragments):
+            text = fragment + text
+            if len(text) >= len(suffix):
+                break
+        return text.endswith(suffix)
+
+    # True for a column that holds nothing but the VCF missing value "."
+    def isMissing(self):
+        return [fragment for fragment in self.fragments if fragment] == ["."]
+
+    def set(self, text):
+        self.fragments = [text]
+        self.values = None
+
+    # Adds text after a ";", unless the column already ends with one
+    def append(self, text):
+        if not self.endsWith(";"):
+            self.fragments.append(";")
+        self.fragments.append(text)
+        self.values = None
+
+    # Adds text after a ";", whatever the column ends with
+    def extend(self, text):
+        self.fragments.append(";")
+        self.fragments.append(text)
+        self.values = None
+
+    # Drops prefix from the start of the column, if it starts with it
+    def dropPrefix(self, prefix):
+        if self.head(len(prefix)) != prefix:
+            return
+        n = len(prefix)
+        while n > 0:
+            fragment = self.fragments[0]
+            if len(fragment) > n:
+                self.fragments[0] = fragment[n:]
+                break
+            n = n - len(fragment)
+            self.fragments.pop(0)
+        if len(self.fragments) == 0:
+            self.fragments.append("")
+        self.values = None
+
+    # The value of the first key=value pair whose name contains key, or
+    # "."; the rule of utils.parse_field, which this replaces
+    def get(self, key):
+        if self.values is None:
+            self.values = []
+            for pair in str(self).strip().split(";"):
+                parts = pair.split("=")
+                if len(parts) > 1:
+                    self.values.append((parts[0], parts[1]))
+        for name, value in self.values:
+            if key in name:
+                return value
+        return "."
+
+
+"""Split a line into a record; the INFO column, if any, becomes an Info
+"""
+
+
+def split(line, sep="\t"):
+    return wrap(line.split(sep))
+
+
+def wrap(fields):
+    if len(fields) > INFO:
+        fields[INFO] = Info(fields[INFO])
+    return fields
+
+
+def join(fields):
+    if len(fields) > INFO:
+        fields[INFO] = str(fields[INFO])
+    return "\t".join(fields)
+
+
+"""Binary record files, see the top of this file
+"""
+
+MAGIC = b"ANNREC"
+VERSION = 1
+
+# Frame kinds
+LINE = 0
+CHROM = 1
+RECORD = 2
+FIELDS = 3
+
+FRAME = struct.Struct("<I")
+RECORD_HEAD = struct.Struct("<BHiH")
+FIELDS_HEAD = struct.Struct("<BH")
+CHROM_HEAD = struct.Struct("<BH")
+COLUMN = struct.Struct("<I")
+
+INT32_MAX = 2**31 - 1
+
+
+def packColumns(columns):
+    data = []
+    for column in columns:
+        column = str(column).encode("utf-8")
+        data.append(COLUMN.pack(len(column)))
+        data.append(column)
+    return b"".join(data)
+
+
+def unpackColumns(payload, offset, count):
+    columns = []
+    for i in range(count):
+        (size,) = COLUMN.unpack_from(payload, offset)
+        offset = offset + COLUMN.size
+        columns.append(payload[offset : offset + size].decode("utf-8"))
+        offset = offset + size
+    return columns
+
+
+"""Writes lines (str) and records (lists of columns) to a record file
+   checksum gives the SHA-256 of what has been written so far
+"""
+
+
+class RecordWriter(object):
+    def __init__(self, path):
+        self.fh = open(path, "wb")
+        self.digest = hashlib.sha256()
+        self.chroms = {}
+        self.fh.write(MAGIC + bytes([VERSION]))
+        self.digest.update(MAGIC + bytes([VERSION]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.fh.close()
+
+    def checksum(self):
+        return self.digest.hexdigest()
+
+    def frame(self, payload):
+        head = FRAME.pack(len(payload))
+        self.fh.write(head)
+        self.fh.write(payload)
+        self.digest.update(head)
+        self.digest.update(payload)
+
+    def write(self, item):
+        if isinstance(item, str):
+            self.frame(bytes([LINE]) + item.encode("utf-8"))
+            return
+
+        chrom, pos = str(item[0]), str(item[1])
+        compact = pos.isdigit() and str(int(pos)) == pos and int(pos) <= INT32_MAX
+        if not compact or len(item) > 0xFFFF:
+            self.frame(FIELDS_HEAD.pack(FIELDS, len(item)) + packColumns(item))
+            return
+
+        if chrom not in self.chroms:
+            if len(self.chroms) > 0xFFFF:
+                self.frame(FIELDS_HEAD.pack(FIELDS, len(item)) + packColumns(item))
+                return
+            self.chroms[chrom] = len(self.chroms)
+            self.frame(
+                CHROM_HEAD.pack(CHROM, self.chroms[chrom]) + chrom.encode("utf-8")
+            )
+        self.frame(
+            RECORD_HEAD.pack(RECORD, self.chroms[chrom], int(pos), len(item) - 2)
+            + packColumns(item[2:])
+        )
+
+
+"""Reads back the lines (str) and records of a record file; the INFO
+   column of a record comes back as an Info
+"""
+
+
+class RecordReader(object):
+    def __init__(self, path):
+        self.fh = open(path, "rb")
+        magic = self.fh.read(len(MAGIC) + 1)
+        if magic[: len(MAGIC)] != MAGIC or magic[len(MAGIC) :] != bytes([VERSION]):
+            self.fh.close()
+            raise ValueError(f"{path} is not a version {VERSION} record file")
+        self.chroms = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.fh.close()
+
+    def __iter__(self):
+        while True:
+            head = self.fh.read(FRAME.size)
+            if len(head) == 0:
+                return
+            if len(head) < FRAME.size:
+                raise ValueError(f"Truncated record file {self.fh.name}")
+            (size,) = FRAME.unpack(head)
+            payload = self.fh.read(size)
+            if len(payload) < size:
+                raise ValueError(f"Truncated record file {self.fh.name}")
+
+            kind = payload[0]
+            if kind == LINE:
+                yield payload[1:].decode("utf-8")
+            elif kind == CHROM:
+                (kind, number) = CHROM_HEAD.unpack_from(payload)
+                if number != len(self.chroms):
+                    raise ValueError(f"Corrupt record file {self.fh.name}")
+                self.chroms.append(payload[CHROM_HEAD.size :].decode("utf-8"))
+            elif kind == RECORD:
+                (kind, number, pos, count) = RECORD_HEAD.unpack_from(payload)
+                fields = [self.chroms[number], str(pos)]
+                fields.extend(unpackColumns(payload, RECORD_HEAD.size, count))
+                yield wrap(fields)
+            elif kind == FIELDS:
+                (kind, count) = FIELDS_HEAD.unpack_from(payload)
+                yield wrap(unpackColumns(payload, FIELDS_HEAD.size, count))
+            else:
+                raise ValueError(f"Corrupt record file {self.fh.name}")
+
+
+### EOF
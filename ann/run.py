@@ -13,6 +13,7 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 import sys
 import time
 import driver
+import utils
 import os
 import shutil
 import boto3
@@ -32,6 +33,26 @@ bucket = config.get('s3', 'ResultsBucketName')
 keyPrefix = config.get('s3', 'KeyPrefix')
 CnetId = config.get('DEFAULT', 'CnetId')
 sns_topic_arn = config.get('sqs', 'SnsTopicArn')
+interval_mode = config.get('ann', 'IntervalMode', fallback='query')
+snapshot_path = config.get('ann', 'SnapshotPath', fallback='')
+dbsnp_mode = config.get('ann', 'DbSnpMode', fallback='query')
+genes_mode = config.get('ann', 'GenesMode', fallback='query')
+workers = config.getint('ann', 'Workers', fallback=1)
+stage_threads = config.getint('ann', 'StageThreads', fallback=1)
+cache_path = config.get('ann', 'CachePath', fallback='')
+cache_max_mb = config.getint('ann', 'CacheMaxMB', fallback=1024)
+table_stats = config.get('ann', 'TableStatsPath', fallback='')
+reference_version = config.get('ann', 'ReferenceVersion', fallback='')
+dedup = config.getint('ann', 'DedupSites', fallback=0)
+engine = config.get('ann', 'Engine', fallback='sync')
+async_window = config.getint('ann', 'AsyncWindow', fallback=4)
+checkpoint_to_s3 = config.getboolean('ann', 'CheckpointToS3', fallback=False)
+
+# Pool of reference database connections shared by all stages
+utils.configurePool(
+    size=config.getint('ann', 'DbPoolSize', fallback=16),
+    overflow=config.getint('ann', 'DbPoolOverflow', fallback=16),
+    credential_ttl=config.getint('ann', 'DbCredentialTtl', fallback=3600))
 
 
 # general static connection to boto3
@@ -63,17 +84,101 @@ class Timer(object):
             print(f"Approximate runtime: {self.secs:.2f} seconds")
 
 
-def main():
+"""Stage checkpoints kept in S3 (see pipeline.runStaged), so that a job
+   that is started again on another annotator resumes where it stopped
+"""
+
+
+class S3Checkpoints(object):
+    def __init__(self, prefix, workdir):
+        self.prefix = prefix
+        self.workdir = workdir
+
+    # Fetch the checkpoints of an earlier attempt at the job, if any
+    def restore(self):
+        try:
+            paginator = s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket, Prefix=self.prefix):
+                for item in page.get('Contents', []):
+                    name = item['Key'][len(self.prefix):]
+                    os.makedirs(self.workdir, exist_ok=True)
+                    s3.download_file(bucket, item['Key'],
+                                     os.path.join(self.workdir, name))
+                    print(f"Restored checkpoint {name}")
+        except (BotoCoreError, ClientError) as e:
+            # Without them the job simply starts from the beginning
+            print(f"Error restoring checkpoints from S3 {bucket} bucket: {e}")
+
+    # Passed to driver.run as on_checkpoint; the record file goes up
+    # before its marker, so a marker is never ahead of its output
+    def sync(self, paths, stale):
+        try:
+            for path in paths:
+                s3.upload_file(path, bucket,
+                               self.prefix + os.path.basename(path))
+            for path in stale:
+                s3.delete_object(Bucket=bucket,
+                                 Key=self.prefix + os.path.basename(path))
+        except (BotoCoreError, ClientError) as e:
+            print(f"Error saving checkpoint to S3 {bucket} bucket: {e}")
+
+    def clear(self):
+        try:
+            paginator = s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket, Prefix=self.prefix):
+                for item in page.get('Contents', []):
+                    s3.delete_object(Bucket=bucket, Key=item['Key'])
+        except (BotoCoreError, ClientError) as e:
+            print(f"Error deleting checkpoints from S3 {bucket} bucket: {e}")
+
+
+"""The reference version in the config file as it is now; a warm worker
+   (annotator_pool.py) reads it for every job, so that the indexes it
+   keeps are dropped once the reference database has been refreshed
+"""
+
+
+def current_reference_version():
+    current = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+    current.read("/home/ubuntu/gas/ann/annotator_config.ini")
+    return current.get('ann', 'ReferenceVersion', fallback=reference_version)
+
+
+"""Runs one job: annotates input_file_name, uploads the results and log,
+   marks the job COMPLETED and publishes the results notification
+   Returns True if the results were uploaded and the job marked COMPLETED
+
+   Called by main() when run.py is started for a job, and by the warm
+   workers of annotator_pool.py, which keep the clients above between jobs
+"""
+
+
+def run_job(input_file_name, job_id, user_id, input_name):
 
     # Get job parameters
-    input_file_name = sys.argv[1]
-    job_id = sys.argv[2]
-    user_id = sys.argv[3]
-    filename = sys.argv[4].split('.')[0]
+    filename = input_name.split('.')[0]
+
+    checkpoints = None
+    if engine == 'staged' and checkpoint_to_s3:
+        checkpoints = S3Checkpoints(
+            f'{keyPrefix}{user_id}/{job_id}~checkpoints/',
+            driver.checkpointDir(input_file_name))
+        checkpoints.restore()
 
     # Run the AnnTools pipeline
     with Timer():
-        driver.run(input_file_name, "vcf")
+        driver.run(input_file_name, "vcf", interval_mode=interval_mode,
+                   snapshot=snapshot_path, dbsnp_mode=dbsnp_mode,
+                   workers=workers, threads=stage_threads,
+                   cache=cache_path,
+                   reference_version=current_reference_version(),
+                   cache_max_mb=cache_max_mb, dedup=dedup,
+                   genes_mode=genes_mode, engine=engine,
+                   window=async_window,
+                   on_checkpoint=checkpoints.sync if checkpoints else None,
+                   table_stats=table_stats)
+    if checkpoints is not None:
+        checkpoints.clear()
 
     success = True 
     # 1. Upload the results file to S3 results bucket
@@ -130,12 +235,16 @@ def main():
             "link": job_url,
             "result_file": result_file # A14 new inserted
         }
-        # Send message to request queue
-        topic = sns.Topic(arn=sns_topic_arn)
-        topic.publish(
-            Message=json.dumps(data)
-        )
-        print("message sent")
+        # Send message to request queue; the job is COMPLETED already, so
+        # a lost notification must not fail it (and have it run again)
+        try:
+            topic = sns.Topic(arn=sns_topic_arn)
+            topic.publish(
+                Message=json.dumps(data)
+            )
+            print("message sent")
+        except (BotoCoreError, ClientError) as e:
+            print(f"Error publishing results notification: {str(e)}")
     
     # 4. Clean up (delete) local job files
     try:
@@ -145,7 +254,15 @@ def main():
     except OSError as e:
         print(f"Error deleting {folder_path}: {e}")
 
-    
+    return success
+
+
+def main():
+
+    # Get job parameters; the exit status tells the annotator whether the
+    # job succeeded, and so whether to delete its request message
+    if not run_job(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4]):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,339 @@
+# snapshot.py
+#
+# Offline reference snapshot of the annotator database
+#
+# A snapshot is a directory holding, for every table the pipeline uses
+# and every chromosome in it:
+#   starts.npy, ends.npy, maxends.npy, order.npy - int32 interval arrays
+#       sorted by start (see utils.sortIntervals)
+#   offsets.npy - int64 offsets of each row in the heap, in database order
+#   heap.bin - the rows one after the other, each column a type tag and
+#       a length-prefixed UTF-8 string (see packRow)
+# plus a MANIFEST.json naming the tables, columns and snapshot version.
+# The arrays are memory-mapped and the heap is read through mmap, so
+# nodes share the page cache; a row is decoded from a memoryview of the
+# heap, without copying it, only when it is hit.
+#
+# Usage: python snapshot.py <bundle_dir> [version]
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import sys
+import os
+import json
+import mmap
+import pickle
+import struct
+import time
+from array import array
+from decimal import Decimal
+
+import numpy as np
+import pymysql
+
+import utils as u
+
+# Bump when the on-disk layout changes
+FORMAT = 2
+
+MANIFEST = "MANIFEST.json"
+
+# table -> (chromosome column, interval start column, interval end column)
+TABLES = {
+    "dbSNP": ("CHR", "POS", "POS"),
+    "chrom_pos_equal_base": ("CHR", "start", "end"),
+    "chrom_pos_equal_nobase": ("CHR", "start", "end"),
+    "chrom_pos_unequal": ("CHR", "start", "end"),
+    "refGene": ("chrom", "txStart", "txEnd"),
+    "cpgIslandExt": ("chrom", "chromStart", "chromEnd"),
+    "cytoBand": ("chrom", "chromStart", "chromEnd"),
+    "gadAll": ("chromosome", "chromStart", "chromEnd"),
+    "gwasCatalog": ("chrom", "chromEnd", "chromEnd"),
+    "targetScanS": ("chrom", "chromStart", "chromEnd"),
+    "hugo": ("chrom", "chromStart", "chromEnd"),
+    "dgv_Cnv": ("chrom", "chromStart", "chromEnd"),
+    "abParts_IG_T_CelReceptors": ("chrom", "chromStart", "chromEnd"),
+    "mcCarroll_Cnv": ("chrom", "chromStart", "chromEnd"),
+    "conrad_Cnv": ("chrom", "chromStart", "chromEnd"),
+    "genomicSuperDups": ("chrom", "chromStart", "chromEnd"),
+}
+for c in [str(c) for c in range(1, 23)] + ["X", "Y"]:
+    TABLES["tfbsConsSites" + c] = ("chrom", "chromStart", "chromEnd")
+
+FETCH_SIZE = 10000
+
+# Heap rows: a column count, then for each column its type and length
+ROW_HEAD = struct.Struct("<H")
+COLUMN_HEAD = struct.Struct("<BI")
+
+# Column types; a value of any other type is stored pickled
+NULL = 0
+STR = 1
+INT = 2
+FLOAT = 3
+DECIMAL = 4
+BYTES = 5
+PICKLED = 6
+
+
+"""Encode a row for the heap; the values come back with their types
+"""
+
+
+def packRow(row):
+    data = [ROW_HEAD.pack(len(row))]
+    for value in row:
+        if value is None:
+            kind, text = NULL, b""
+        elif isinstance(value, str):
+            kind, text = STR, value.encode("utf-8")
+        elif isinstance(value, bool) or not isinstance(
+            value, (int, float, Decimal, bytes)
+        ):
+            kind, text = PICKLED, pickle.dumps(value)
+        elif isinstance(value, int):
+            kind, text = INT, str(value).encode("utf-8")
+        elif isinstance(value, float):
+            kind, text = FLOAT, repr(value).encode("utf-8")
+        elif isinstance(value, Decimal):
+            kind, text = DECIMAL, str(value).encode("utf-8")
+        else:
+            kind, text = BYTES, value
+        data.append(COLUMN_HEAD.pack(kind, len(text)))
+        data.append(text)
+    return b"".join(data)
+
+
+def unpackRow(view):
+    (count,) = ROW_HEAD.unpack_from(view, 0)
+    offset = ROW_HEAD.size
+    row = []
+    for i in range(count):
+        kind, size = COLUMN_HEAD.unpack_from(view, offset)
+        offset = offset + COLUMN_HEAD.size
+        text = view[offset : offset + size]
+        offset = offset + size
+        if kind == NULL:
+            row.append(None)
+        elif kind == STR:
+            row.append(str(text, "utf-8"))
+        elif kind == INT:
+            row.append(int(str(text, "utf-8")))
+        elif kind == FLOAT:
+            row.append(float(str(text, "utf-8")))
+        elif kind == DECIMAL:
+            row.append(Decimal(str(text, "utf-8")))
+        elif kind == BYTES:
+            row.append(bytes(text))
+        else:
+            row.append(pickle.loads(text))
+    return tuple(row)
+
+
+"""Dump the rows of one chromosome of a table into directory outdir
+   Rows are fetched from the database in batches and written to the heap
+   as they arrive; only the coordinates are held in memory. MySQL rows
+   are streamed with an unbuffered cursor
+"""
+
+
+def exportChrom(conn, table, chrom, chromColumn, startName, endName, outdir):
+    os.makedirs(outdir)
+
+    if isinstance(conn, pymysql.connections.Connection):
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+    else:
+        cursor = conn.cursor()
+    sql = "select * from " + table + " where " + chromColumn + " = %s;"
+    u.execute(cursor, sql, (str(chrom),))
+    columns = [d[0] for d in cursor.description]
+    startIndex = columns.index(startName)
+    endIndex = columns.index(endName)
+
+    offsets = array("q", [0])
+    starts = array("q")
+    ends = array("q")
+    with open(os.path.join(outdir, "heap.bin"), "wb") as fh_heap:
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                data = packRow(row)
+                fh_heap.write(data)
+                offsets.append(offsets[-1] + len(data))
+                starts.append(int(row[startIndex]))
+                ends.append(int(row[endIndex]))
+    cursor.close()
+
+    sortedStarts, sortedEnds, maxends, order = u.sortIntervals(starts, ends)
+    np.save(os.path.join(outdir, "starts.npy"), sortedStarts)
+    np.save(os.path.join(outdir, "ends.npy"), sortedEnds)
+    np.save(os.path.join(outdir, "maxends.npy"), maxends)
+    np.save(os.path.join(outdir, "order.npy"), order)
+    np.save(os.path.join(outdir, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+
+    return len(starts), columns
+
+
+"""Export the reference tables into a new snapshot directory
+   The manifest is written last, so an interrupted export never looks
+   like a usable snapshot
+"""
+
+
+def export(conn, path, version, tables=TABLES):
+    os.makedirs(path)
+    manifest = {
+        "format": FORMAT,
+        "version": str(version),
+        "created": int(time.time()),
+        "tables": {},
+    }
+
+    cursor = conn.cursor()
+    for table, (chromColumn, startName, endName) in tables.items():
+        u.execute(cursor, "select distinct " + chromColumn + " from " + table + ";")
+        chroms = sorted(str(row[0]) for row in cursor.fetchall())
+
+        entry = {
+            "chromColumn": chromColumn,
+            "startName": startName,
+            "endName": endName,
+            "columns": [],
+            "chroms": {},
+        }
+        for i, chrom in enumerate(chroms):
+            # Chromosome names are not always safe file names
+            chromdir = os.path.join(table, str(i))
+            rows, columns = exportChrom(
+                conn,
+                table,
+                chrom,
+                chromColumn,
+                startName,
+                endName,
+                os.path.join(path, chromdir),
+            )
+            entry["columns"] = columns
+            entry["chroms"][chrom] = {"path": chromdir, "rows": rows}
+
+        manifest["tables"][table] = entry
+        print(f"{table} - exported {len(chroms)} chromosomes")
+
+    cursor.close()
+    with open(os.path.join(path, MANIFEST), "w") as fh:
+        json.dump(manifest, fh, indent=1)
+
+
+"""Rows of one chromosome, decoded from the memory-mapped heap on access
+"""
+
+
+class HeapRows(object):
+    def __init__(self, heapfile, offsets):
+        self.offsets = offsets
+        self.heap = memoryview(b"")
+        if offsets[-1] > 0:
+            with open(heapfile, "rb") as fh:
+                self.heap = memoryview(
+                    mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return unpackRow(self.heap[self.offsets[i] : self.offsets[i + 1]])
+
+
+"""One table of a snapshot; chromosomes are mapped on first use
+"""
+
+
+class SnapshotTable(object):
+    def __init__(self, path, name, entry):
+        self.path = path
+        self.name = name
+        self.chromColumn = entry["chromColumn"]
+        self.startName = entry["startName"]
+        self.endName = entry["endName"]
+        self.columns = entry["columns"]
+        self.chroms = entry["chroms"]
+        self.index = u.IntervalIndex()
+
+    def columnIndex(self, name):
+        return self.columns.index(name)
+
+    def load(self, chrom):
+        chromdir = os.path.join(self.path, self.chroms[chrom]["path"])
+        arrays = [
+            np.load(os.path.join(chromdir, name + ".npy"), mmap_mode="r")
+            for name in ["starts", "ends", "maxends", "order", "offsets"]
+        ]
+        starts, ends, maxends, order, offsets = arrays
+        rows = HeapRows(os.path.join(chromdir, "heap.bin"), offsets)
+        self.index.addSorted(chrom, starts, ends, maxends, order, rows)
+
+    def query(self, chrom, pos):
+        return self.queryRange(chrom, pos, pos)
+
+    def queryRange(self, chrom, start, end):
+        if chrom not in self.chroms:
+            return ()
+        if chrom not in self.index:
+            self.load(chrom)
+        return self.index.queryRange(chrom, start, end)
+
+
+"""An exported reference snapshot
+"""
+
+
+class Snapshot(object):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as fh:
+            manifest = json.load(fh)
+
+        if manifest["format"] != FORMAT:
+            raise ValueError(
+                f"Snapshot {path} has format {manifest['format']}, expected {FORMAT}"
+            )
+        self.version = manifest["version"]
+        self.entries = manifest["tables"]
+        self.tables = {}
+
+    # Tables hold open memory maps; a copy sent to another process maps
+    # them again on first use
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["tables"] = {}
+        return state
+
+    def table(self, name):
+        if name not in self.tables:
+            if name not in self.entries:
+                raise KeyError(f"Table '{name}' is not in snapshot {self.path}")
+            self.tables[name] = SnapshotTable(self.path, name, self.entries[name])
+        return self.tables[name]
+
+
+def main():
+    path = sys.argv[1]
+    version = sys.argv[2] if len(sys.argv) > 2 else time.strftime("%Y%m%d")
+
+    conn = u.db_connect()
+    try:
+        export(conn, path, version)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
@@ -0,0 +1,327 @@
+# conftest.py
+#
+# Fixtures for the AnnTools tests
+#
+# The reference database is a small SQLite stand-in (see
+# utils.db_connect and ANNTOOLS_SQLITE_DB) with every table the stages
+# read, filled with random but reproducible rows; the input is a VCF of
+# records on the chromosomes of those tables and on some that have none
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import random
+import sqlite3
+import sys
+
+import pytest
+
+# The AnnTools modules import each other by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snapshot as snap
+import utils as u
+
+CHROMS = ["1", "2", "X"]
+LENGTH = 3000
+BASES = "ACGT"
+
+
+def intervals(rng, count, longest=200):
+    for i in range(count):
+        chrom = rng.choice(CHROMS)
+        start = rng.randint(1, LENGTH)
+        yield chrom, start, start + rng.randint(0, longest)
+
+
+def insert(cursor, table, rows):
+    for row in rows:
+        cursor.execute(f"insert into {table} values ({','.join('?' * len(row))})", row)
+
+
+"""Fill a new SQLite database at path with the reference tables
+"""
+
+
+def makeReferenceDb(path, seed=1):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+
+    cursor.execute("create table dbSNP (CHR, POS, REF, ID, ALT, QUAL, INFO, GMAF)")
+    insert(
+        cursor,
+        "dbSNP",
+        (
+            (
+                rng.choice(CHROMS),
+                rng.randint(1, LENGTH),
+                rng.choice(BASES),
+                f"rs{i}",
+                rng.choice(BASES),
+                ".",
+                rng.choice(["SNV", "SNV", "DIV"]),
+                rng.choice([".", "0.01", "0.2"]),
+            )
+            for i in range(1500)
+        ),
+    )
+
+    extra = [f"c{i}" for i in range(19)]
+    for table in [
+        "chrom_pos_equal_base",
+        "chrom_pos_equal_nobase",
+        "chrom_pos_unequal",
+    ]:
+        cursor.execute(
+            f"create table {table} (id, CHR, start, end, haplotypeReference, "
+            + f"haplotypeAlternate, {', '.join(extra)})"
+        )
+        rows = []
+        for i, (chrom, start, end) in enumerate(intervals(rng, 150, 30)):
+            if table != "chrom_pos_unequal":
+                end = start
+            rows.append(
+                [i, chrom, start, end, rng.choice(BASES), rng.choice(BASES)]
+                + [rng.choice(["", "0", f"x{rng.randint(0, 5)}"]) for c in extra]
+            )
+        insert(cursor, table, rows)
+
+    cursor.execute(
+        "create table refGene (bin, name, chrom, strand, txStart, txEnd, "
+        + "cdsStart, cdsEnd, exonCount, exonStarts, exonEnds, score, name2, "
+        + "cdsStartStat, cdsEndStat, exonFrames)"
+    )
+    rows = []
+    for i in range(80):
+        start = rng.randint(1, LENGTH)
+        end = start + rng.randint(50, 600)
+        exons = rng.randint(1, 6)
+        bounds = sorted(rng.sample(range(start, end), 2 * exons))
+        if rng.random() < 0.3:
+            cdsStart = cdsEnd = start
+        else:
+            cdsStart = rng.randint(start, end)
+            cdsEnd = rng.randint(cdsStart, end)
+        rows.append(
+            (
+                0,
+                f"NM_{i}",
+                "chr" + rng.choice(CHROMS),
+                rng.choice("+-"),
+                start,
+                end,
+                cdsStart,
+                cdsEnd,
+                exons,
+                (",".join(str(b) for b in bounds[0::2]) + ",").encode(),
+                (",".join(str(b) for b in bounds[1::2]) + ",").encode(),
+                0,
+                f"G{i % 40}",
+                "cmpl",
+                "cmpl",
+                "",
+            )
+        )
+    insert(cursor, "refGene", rows)
+
+    cursor.execute("create table cpgIslandExt (chrom, chromStart, chromEnd, name)")
+    insert(
+        cursor,
+        "cpgIslandExt",
+        (
+            ("chr" + chrom, start, end, f"CpG: {rng.randint(1, 90)}")
+            for chrom, start, end in intervals(rng, 40, 300)
+        ),
+    )
+
+    cursor.execute(
+        "create table cytoBand (chrom, chromStart, chromEnd, name, gieStain)"
+    )
+    insert(
+        cursor,
+        "cytoBand",
+        (
+            ("chr" + chrom, k, k + 250, f"p{k // 250}", "gneg")
+            for chrom in CHROMS
+            for k in range(0, LENGTH + 200, 250)
+        ),
+    )
+
+    cursor.execute(
+        "create table gadAll (id, chromosome, chromStart, geneSymbol, chromEnd)"
+    )
+    insert(
+        cursor,
+        "gadAll",
+        (
+            (i, chrom, start, f"GAD{i % 30}", end)
+            for i, (chrom, start, end) in enumerate(intervals(rng, 60))
+        ),
+    )
+
+    cursor.execute(
+        "create table gwasCatalog (bin, chrom, chromStart, chromEnd, name, "
+        + "pubMedID, c6, c7, c8, c9, trait)"
+    )
+    insert(
+        cursor,
+        "gwasCatalog",
+        (
+            (0, "chr" + chrom, start - 1, start, "rs", 1000 + i)
+            + (0, 0, 0, 0, f"trait {i}")
+            for i, (chrom, start, end) in enumerate(intervals(rng, 150, 1))
+        ),
+    )
+
+    cursor.execute(
+        "create table hugo (chrom, chromStart, chromEnd, c3, c4, sym, descr)"
+    )
+    insert(
+        cursor,
+        "hugo",
+        (
+            ("chr" + chrom, start, end, 0, 0, f"H{i % 20}", f"desc; {i % 7}")
+            for i, (chrom, start, end) in enumerate(intervals(rng, 50))
+        ),
+    )
+
+    cursor.execute(
+        "create table genomicSuperDups (bin, chrom, chromStart, chromEnd, name, "
+        + "score, strand, otherChrom, otherStart, otherEnd)"
+    )
+    insert(
+        cursor,
+        "genomicSuperDups",
+        (
+            (0, "chr" + chrom, start, end, "n", 0, "+", "chr9", i, i + 10)
+            for i, (chrom, start, end) in enumerate(intervals(rng, 50))
+        ),
+    )
+
+    for table in [
+        "dgv_Cnv",
+        "abParts_IG_T_CelReceptors",
+        "mcCarroll_Cnv",
+        "conrad_Cnv",
+    ]:
+        cursor.execute(f"create table {table} (chrom, chromStart, chromEnd, name)")
+        insert(
+            cursor,
+            table,
+            (
+                ("chr" + chrom, start, end, f"cnv{i}")
+                for i, (chrom, start, end) in enumerate(intervals(rng, 30, 400))
+            ),
+        )
+
+    cursor.execute("create table targetScanS (bin, chrom, chromStart, chromEnd, name)")
+    insert(
+        cursor,
+        "targetScanS",
+        (
+            (0, "chr" + chrom, start, end, f"miR-{i}")
+            for i, (chrom, start, end) in enumerate(intervals(rng, 50, 20))
+        ),
+    )
+
+    for chrom in [str(c) for c in range(1, 23)] + ["X", "Y"]:
+        table = "tfbsConsSites" + chrom
+        cursor.execute(f"create table {table} (chrom, chromStart, chromEnd, name)")
+        insert(
+            cursor,
+            table,
+            (
+                ("chr" + chrom, start, end, f"V$TF{i}")
+                for i, (c, start, end) in enumerate(intervals(rng, 20, 30))
+            ),
+        )
+
+    conn.commit()
+    conn.close()
+
+
+"""Write a VCF of count records in random order (or position sorted)
+   to path
+   Some records repeat the sites of others; some are on chromosomes the
+   tables have nothing on
+"""
+
+
+def makeVcf(path, count=300, seed=2, sort=False):
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        if len(records) > 0 and rng.random() < 0.1:
+            records.append(list(rng.choice(records)))
+            continue
+        records.append(
+            [
+                rng.choice(["1", "2", "X", "chr1", "chr2", "5", "MT"]),
+                str(rng.randint(1, LENGTH)),
+                "rsold" if rng.random() < 0.1 else ".",
+                rng.choice(BASES),
+                rng.choice(BASES),
+                "50",
+                "PASS",
+                rng.choice([".", "AC=1;AN=2", "DP=10"]),
+                "GT",
+                "0/1",
+            ]
+        )
+    if sort:
+        records.sort(key=lambda fields: (fields[0], int(fields[1])))
+
+    with open(path, "w") as fh:
+        fh.write("##fileformat=VCFv4.1\n##source=test\n")
+        fh.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n")
+        for fields in records:
+            fh.write("\t".join(fields) + "\n")
+
+
+@pytest.fixture(scope="session")
+def referenceDb(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("reference") / "reference.db")
+    makeReferenceDb(path)
+
+    saved = os.environ.get("ANNTOOLS_SQLITE_DB")
+    os.environ["ANNTOOLS_SQLITE_DB"] = path
+    u.configurePool()
+    yield path
+    if saved is None:
+        del os.environ["ANNTOOLS_SQLITE_DB"]
+    else:
+        os.environ["ANNTOOLS_SQLITE_DB"] = saved
+    u.configurePool()
+
+
+@pytest.fixture(scope="session")
+def inputVcf(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("input") / "input.vcf")
+    makeVcf(path)
+    return path
+
+
+@pytest.fixture(scope="session")
+def sortedVcf(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("sorted") / "input.vcf")
+    makeVcf(path, sort=True)
+    return path
+
+
+
+@pytest.fixture(scope="session")
+def snapshotPath(referenceDb, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("snapshot") / "reference")
+    conn = u.db_connect()
+    try:
+        snap.export(conn, path, "test")
+    finally:
+        conn.close()
+    return path
+
+
+### EOF
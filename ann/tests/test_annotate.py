@@ -0,0 +1,145 @@
+# test_annotate.py
+#
+# Pieces of the annotation stages, against the rules they replace
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import random
+
+import annotate as ann
+import utils as u
+
+
+def transcript(starts, ends, strand="+"):
+    return ann.TranscriptModel(
+        (
+            0,
+            "NM_1",
+            "chr1",
+            strand,
+            starts[0],
+            ends[-1],
+            starts[0],
+            ends[-1],
+            len(starts),
+            (",".join(str(s) for s in starts) + ",").encode(),
+            (",".join(str(e) for e in ends) + ",").encode(),
+        )
+    )
+
+
+def scanExons(starts, ends, pos):
+    return [e for e in range(len(starts)) if u.isBetween(pos, starts[e], ends[e])]
+
+
+def test_exons_found_by_bisect_match_a_scan():
+    rng = random.Random(7)
+    for i in range(50):
+        bounds = sorted(rng.sample(range(100, 2000), 2 * rng.randint(1, 8)))
+        starts, ends = bounds[0::2], bounds[1::2]
+        model = transcript(starts, ends)
+        for pos in range(95, 2005, 7):
+            assert model.exonsAt(pos) == scanExons(starts, ends, pos)
+        for pos in starts + ends:
+            assert model.exonsAt(pos) == scanExons(starts, ends, pos)
+
+
+def test_touching_exons_are_scanned():
+    starts, ends = [100, 200, 200], [200, 300, 250]
+    model = transcript(starts, ends)
+
+    for pos in [100, 200, 225, 300]:
+        assert model.exonsAt(pos) == scanExons(starts, ends, pos)
+    assert not model.disjoint
+
+
+
+# The CpG island of a promoter, as the SELECT on cpgIslandExt found it
+def test_cpg_islands_match_the_database(referenceDb):
+    stage = ann.GenesStage()
+    stage.open()
+    try:
+        conn = u.db_connect()
+        try:
+            cursor = conn.cursor()
+            for chrom in ["chr1", "chr2", "chrX", "chr5"]:
+                for pos in range(0, 3400, 37):
+                    u.execute(
+                        cursor,
+                        "select chrom, chromStart, chromEnd, name from cpgIslandExt "
+                        + "where chrom = %s and chromStart <= %s and %s <= chromEnd;",
+                        (chrom, pos, pos),
+                    )
+                    rows = cursor.fetchall()
+                    expected = tuple(rows[0]) if len(rows) > 0 else None
+                    found = stage.fetchCpgIsland(chrom, pos)
+                    assert (tuple(found) if found is not None else None) == expected
+        finally:
+            conn.close()
+    finally:
+        stage.close()
+
+
+
+"""The three SELECTs of the BigRefGene cascade, one tier after the other
+"""
+
+
+def cascade(cursor, chrom, pos, ref, alt):
+    compRef = ann.getComplementary(ref)
+    compAlt = ann.getComplementary(alt)
+    tiers = [
+        (
+            "select * from chrom_pos_equal_base where CHR = %s AND start = %s"
+            + " AND ((haplotypeReference = %s AND haplotypeAlternate = %s)"
+            + " OR (haplotypeReference = %s AND haplotypeAlternate = %s));",
+            (chrom, pos, ref, alt, compRef, compAlt),
+        ),
+        (
+            "select * from chrom_pos_equal_nobase where CHR = %s AND start = %s;",
+            (chrom, pos),
+        ),
+        (
+            "select * from chrom_pos_unequal where CHR = %s"
+            + " AND start <= %s AND %s <= end;",
+            (chrom, pos, pos),
+        ),
+    ]
+    for sql, args in tiers:
+        rows = u.execute(cursor, sql, args).fetchall()
+        if len(rows) > 0:
+            return tuple(tuple(row) for row in rows)
+    return ()
+
+
+def test_big_ref_gene_matches_the_cascade(referenceDb):
+    stage = ann.BigRefGeneStage()
+    stage.open()
+    conn = u.db_connect()
+    try:
+        cursor = conn.cursor()
+        sites = []
+        for table in stage.tables:
+            u.execute(cursor, "select CHR, start, haplotypeReference from " + table)
+            sites.extend(cursor.fetchall()[:40])
+
+        rng = random.Random(11)
+        found = 0
+        for chrom, pos, ref in sites:
+            for pos in [int(pos), int(pos) + 1]:
+                ref = rng.choice([str(ref), "A"])
+                alt = rng.choice("ACGT")
+                fields = ["chr" + str(chrom), str(pos), ".", ref, alt]
+                expected = cascade(cursor, str(chrom), pos, ref, alt)
+                assert tuple(tuple(row) for row in stage.fetch(fields)) == expected
+                found = found + (len(expected) > 0)
+        assert found > 0
+    finally:
+        conn.close()
+        stage.close()
+
+
+### EOF
@@ -0,0 +1,128 @@
+# test_cache.py
+#
+# The lookup cache shared by the jobs (and processes) of an annotator,
+# and the memo of the sites of one job
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import pickle
+import time
+
+import cache as rc
+
+
+def entrySize(result):
+    return len(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def test_results_round_trip(tmp_path):
+    results = rc.ResultCache(str(tmp_path / "cache.db"), "v1")
+    results.put([("v1\ta", ((1, "x"),)), ("v1\tb", ())])
+
+    found = results.get(["v1\ta", "v1\tb", "v1\tc"])
+    assert found == {"v1\ta": ((1, "x"),), "v1\tb": ()}
+    results.close()
+
+
+def test_replacing_an_entry_does_not_grow_the_cache(tmp_path):
+    results = rc.ResultCache(str(tmp_path / "cache.db"), "v1")
+    for i in range(5):
+        results.put([("v1\ta", "x" * 100)])
+
+    assert results.size() == entrySize("x" * 100)
+    results.close()
+
+
+def test_size_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / "cache.db")
+    first = rc.ResultCache(path, "v1")
+    second = rc.ResultCache(path, "v1")
+    first.put([("v1\ta", "x" * 100)])
+    second.put([("v1\tb", "y" * 100)])
+
+    assert first.size() == second.size() == 2 * entrySize("x" * 100)
+    first.close()
+    second.close()
+
+
+def test_size_of_an_existing_file_is_kept(tmp_path):
+    path = str(tmp_path / "cache.db")
+    results = rc.ResultCache(path, "v1")
+    results.put([("v1\t" + str(i), "x" * 100) for i in range(10)])
+    results.close()
+
+    results = rc.ResultCache(path, "v1")
+    assert results.size() == 10 * entrySize("x" * 100)
+    results.close()
+
+
+def test_least_recently_used_go_first(tmp_path):
+    size = entrySize("x" * 1000)
+    path = str(tmp_path / "cache.db")
+    results = rc.ResultCache(path, "v1", max_bytes=10 * size)
+    other = rc.ResultCache(path, "v1", max_bytes=10 * size)
+
+    for i in range(8):
+        results.put([("v1\t" + str(i), "x" * 1000)])
+        time.sleep(0.01)
+    results.get(["v1\t0"])
+    # Written by another process; the cap is over the entries of both
+    other.put([("v1\t" + str(i), "x" * 1000) for i in range(8, 11)])
+
+    assert results.size() <= 10 * size * rc.LOW_WATER
+    kept = results.get(["v1\t" + str(i) for i in range(11)])
+    assert "v1\t0" in kept
+    assert "v1\t1" not in kept
+    assert "v1\t10" in kept
+    results.close()
+    other.close()
+
+
+
+def test_memo_keeps_the_current_site_of_sorted_input():
+    memo = rc.SiteMemo(10)
+    memo.advance("1", 100)
+    memo.put("a", ("1", 100), "A")
+    memo.advance("1", 100)
+
+    assert memo.get("a") == (True, "A")
+
+    memo.advance("1", 200)
+    assert memo.get("a") == (False, None)
+    # Results of another site are not kept while the input is sorted
+    memo.put("b", ("1", 100), "B")
+    assert memo.get("b") == (False, None)
+
+
+def test_memo_keeps_every_site_once_input_goes_back():
+    memo = rc.SiteMemo(2)
+    memo.advance("1", 200)
+    memo.put("a", ("1", 200), "A")
+    memo.advance("1", 100)
+    memo.put("b", ("1", 100), "B")
+
+    assert memo.get("a") == (True, "A")
+
+    memo.advance("2", 5)
+    memo.put("c", ("2", 5), "C")
+    # Beyond maxsize the least recently used site goes
+    assert memo.get("b") == (False, None)
+    assert memo.get("a") == (True, "A")
+    assert memo.get("c") == (True, "C")
+
+
+def test_memo_sees_a_chromosome_coming_back():
+    memo = rc.SiteMemo(10)
+    memo.advance("1", 100)
+    memo.advance("2", 50)
+    memo.put("b", ("2", 50), "B")
+    memo.advance("1", 300)
+
+    assert memo.sorted is False
+    assert memo.get("b") == (True, "B")
+
+
+### EOF
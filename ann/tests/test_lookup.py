@@ -0,0 +1,47 @@
+# test_lookup.py
+#
+# The indexes a long-lived worker keeps between jobs
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import pytest
+
+import lookup
+
+
+@pytest.fixture
+def kept(monkeypatch):
+    monkeypatch.setattr(lookup, "sharedIndexes", None)
+    monkeypatch.setattr(lookup, "sharedVersion", None)
+    lookup.keepIndexes()
+    return lookup
+
+
+def test_indexes_are_not_kept_by_default(monkeypatch):
+    monkeypatch.setattr(lookup, "sharedIndexes", None)
+    assert lookup.sharedIndex("a", object) is not lookup.sharedIndex("a", object)
+    assert lookup.useReferenceVersion("1") is False
+
+
+def test_kept_indexes_are_reused(kept):
+    index = kept.sharedIndex("a", object)
+    assert kept.sharedIndex("a", object) is index
+    assert kept.sharedIndex("b", object) is not index
+
+
+def test_new_reference_version_drops_kept_indexes(kept):
+    # The first job sets the version, with nothing loaded to drop
+    assert kept.useReferenceVersion("1") is False
+    index = kept.sharedIndex("a", object)
+
+    assert kept.useReferenceVersion("1") is False
+    assert kept.sharedIndex("a", object) is index
+
+    assert kept.useReferenceVersion("2") is True
+    assert kept.sharedIndex("a", object) is not index
+
+
+### EOF
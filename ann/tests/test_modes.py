@@ -0,0 +1,226 @@
+# test_modes.py
+#
+# The single-pass engine annotates every record of the input once; every
+# engine and lookup mode must write the annotated VCF and the count log
+# that it writes in plain query mode, record for record and byte for byte
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import shutil
+
+import pytest
+
+import driver
+import lookup
+import pipeline
+import planner
+
+# driver.run arguments of each mode, compared against query mode
+MODES = {
+    "sweep": dict(interval_mode="sweep"),
+    "index": dict(interval_mode="index"),
+    "dbsnp-index": dict(dbsnp_mode="index"),
+    "snapshot": dict(),
+    "parallel": dict(workers=2),
+    "threads": dict(threads=4),
+    "window": dict(interval_mode="window", dbsnp_mode="window", genes_mode="window"),
+    "batch": dict(interval_mode="batch", dbsnp_mode="batch", genes_mode="batch"),
+    "async": dict(engine="async"),
+    "async-window": dict(engine="async", window=1),
+    "staged": dict(engine="staged"),
+}
+
+# Modes made for position-sorted input, also compared on a sorted copy
+SORTED_MODES = ["sweep", "window"]
+
+
+"""Annotate a copy of inputVcf in workdir; returns the annotated VCF and
+   the count log
+"""
+
+
+def annotate(inputVcf, workdir, **kwargs):
+    os.makedirs(str(workdir), exist_ok=True)
+    infile = os.path.join(str(workdir), "input.vcf")
+    shutil.copyfile(inputVcf, infile)
+    driver.run(infile, "vcf", **kwargs)
+
+    with open(os.path.join(str(workdir), "input.annot.vcf")) as fh:
+        annotated = fh.read()
+    with open(infile + ".count.log") as fh:
+        log = fh.read()
+    return annotated, log
+
+
+@pytest.fixture(scope="module")
+def queryMode(referenceDb, inputVcf, tmp_path_factory):
+    return annotate(inputVcf, tmp_path_factory.mktemp("query"))
+
+
+def test_query_mode_annotates(queryMode, inputVcf):
+    annotated, log = queryMode
+    with open(inputVcf) as fh:
+        lines = fh.read().splitlines()
+
+    output = annotated.splitlines()
+    assert len(output) == len(lines)
+    # Header lines pass through, records keep their first columns
+    for line, annotatedLine in zip(lines, output):
+        if line.startswith("#"):
+            assert annotatedLine == line
+        else:
+            assert annotatedLine.split("\t")[:2] == line.split("\t")[:2]
+
+    records = [line for line in output if not line.startswith("#")]
+    ids = [line.split("\t")[2] for line in records]
+    assert any(id.startswith("rs") and id != "rsold" for id in ids)
+    assert "Variants located:" in log
+
+
+@pytest.mark.parametrize("mode", sorted(MODES))
+def test_mode_matches_query(mode, queryMode, inputVcf, tmp_path, request):
+    kwargs = dict(MODES[mode])
+    if mode == "snapshot":
+        kwargs["snapshot"] = request.getfixturevalue("snapshotPath")
+
+    annotated, log = annotate(inputVcf, tmp_path, **kwargs)
+
+    assert annotated == queryMode[0]
+    assert log == queryMode[1]
+
+
+@pytest.fixture(scope="module")
+def sortedQueryMode(referenceDb, sortedVcf, tmp_path_factory):
+    return annotate(sortedVcf, tmp_path_factory.mktemp("sorted"))
+
+
+# The sweep and the window pass over sorted input once; on unsorted input
+# they fall back to looking up each chromosome again
+@pytest.mark.parametrize("mode", SORTED_MODES)
+def test_mode_matches_query_on_sorted_input(mode, sortedQueryMode, sortedVcf, tmp_path):
+    assert annotate(sortedVcf, tmp_path, **MODES[mode]) == sortedQueryMode
+
+
+# Records repeating a site reuse its lookup; the share that did is
+# added to the log
+@pytest.mark.parametrize("dedup", [1, 1000])
+def test_dedup_keeps_output(
+    dedup, queryMode, sortedQueryMode, inputVcf, sortedVcf, tmp_path
+):
+    annotated, log = annotate(inputVcf, tmp_path, dedup=dedup)
+
+    assert annotated == queryMode[0]
+    assert log.split("Repeated sites:\n")[0] == queryMode[1]
+    assert "Repeated sites:\n" in log
+
+    annotated, log = annotate(sortedVcf, tmp_path / "sorted", dedup=dedup)
+    assert annotated == sortedQueryMode[0]
+    assert log.split("Repeated sites:\n")[0] == sortedQueryMode[1]
+
+
+# Lookups cached by one job are found by the next; the cache only adds
+# its hit rates to the log
+def test_cache_keeps_output(queryMode, inputVcf, tmp_path):
+    path = str(tmp_path / "cache.db")
+    cold = annotate(inputVcf, tmp_path / "cold", cache=path)
+    warm = annotate(inputVcf, tmp_path / "warm", cache=path)
+
+    for annotated, log in [cold, warm]:
+        assert annotated == queryMode[0]
+        assert log.split("Lookup cache:\n")[0] == queryMode[1]
+    assert " 0 hits" in cold[1]
+    assert " 0 hits" not in warm[1]
+
+
+# The planner picks a lookup for each table and adds its choices to the
+# log; the row counts it reads are kept in the stats file for later jobs
+def test_auto_mode_keeps_output(queryMode, inputVcf, tmp_path):
+    auto = dict(interval_mode="auto", dbsnp_mode="auto", genes_mode="auto")
+    path = str(tmp_path / "table_stats.json")
+    first = annotate(inputVcf, tmp_path / "first", table_stats=path, **auto)
+    planner.rowCounts.clear()
+    second = annotate(inputVcf, tmp_path / "second", table_stats=path, **auto)
+
+    for annotated, log in [first, second]:
+        assert annotated == queryMode[0]
+        assert log.split("Lookup plan:\n")[0] == queryMode[1]
+        assert "In cytoBand: " in log
+    assert first[1] == second[1]
+    assert os.path.exists(path)
+
+
+class Interrupted(Exception):
+    pass
+
+
+"""Interrupt a staged run once it has checkpointed stages stages
+"""
+
+
+def interruptAfter(stages):
+    def on_checkpoint(files, stale):
+        if files[0].endswith(f"stage-{stages:02d}.rec"):
+            raise Interrupted()
+
+    return on_checkpoint
+
+
+# An interrupted staged run resumes after the last stage it completed,
+# with the counts of the stages done restored for the log
+def test_staged_run_resumes(queryMode, inputVcf, tmp_path, capsys):
+    with pytest.raises(Interrupted):
+        annotate(inputVcf, tmp_path, engine="staged", on_checkpoint=interruptAfter(3))
+    capsys.readouterr()
+
+    assert annotate(inputVcf, tmp_path, engine="staged") == queryMode
+    assert "Resumed after 3 of " in capsys.readouterr().out
+    assert not os.path.exists(driver.checkpointDir(str(tmp_path / "input.vcf")))
+
+
+# A checkpoint that no longer matches its marker is not resumed from;
+# the run goes back to the one before it
+def test_staged_run_skips_damaged_checkpoints(queryMode, inputVcf, tmp_path, capsys):
+    with pytest.raises(Interrupted):
+        annotate(inputVcf, tmp_path, engine="staged", on_checkpoint=interruptAfter(3))
+    checkpoints = driver.checkpointDir(str(tmp_path / "input.vcf"))
+    with open(pipeline.stagePath(checkpoints, 3), "ab") as fh:
+        fh.write(b"x")
+    capsys.readouterr()
+
+    assert annotate(inputVcf, tmp_path, engine="staged") == queryMode
+    assert "Resumed after" not in capsys.readouterr().out
+
+
+# A warm worker keeps the indexes its jobs load; the next job on the same
+# reference version annotates from them
+def test_kept_indexes_keep_output(queryMode, inputVcf, tmp_path, monkeypatch):
+    monkeypatch.setattr(lookup, "sharedIndexes", None)
+    monkeypatch.setattr(lookup, "sharedVersion", None)
+    lookup.keepIndexes()
+
+    for job in ["first", "second"]:
+        assert annotate(inputVcf, tmp_path / job, **MODES["index"]) == queryMode
+        assert len(lookup.sharedIndexes) > 0
+
+
+@pytest.mark.parametrize("batchSize", [1, 7])
+def test_batch_size_does_not_change_output(
+    batchSize, queryMode, referenceDb, inputVcf, tmp_path
+):
+    outfile = str(tmp_path / "input.annot")
+    logfile = str(tmp_path / "input.vcf.count.log")
+    pipeline.run(
+        inputVcf, outfile, driver.stages(), logfile=logfile, batch_size=batchSize
+    )
+
+    with open(outfile) as fh:
+        assert fh.read() == queryMode[0]
+    with open(logfile) as fh:
+        assert fh.read() == queryMode[1]
+
+
+### EOF
@@ -0,0 +1,74 @@
+# test_pipeline.py
+#
+# The order stages may run in, and how the records of the input are
+# split between parallel workers
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import driver
+import pipeline
+
+
+class Stage(object):
+    def __init__(self, inputs, outputs):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.counts = {"hits": 1}
+
+
+def test_stages_wait_for_the_columns_they_read():
+    stages = [
+        Stage(("CHROM", "POS", "REF"), ("ID", "INFO")),
+        Stage(("CHROM", "POS"), ("INFO",)),
+        Stage(("ID",), ()),
+        Stage(("CHROM", "POS"), ()),
+    ]
+
+    assert pipeline.schedule(stages) == [set(), set(), {0}, set()]
+
+
+# The stages of a job read only the columns they are given, so all of
+# their lookups may run at once
+def test_job_stages_are_independent():
+    assert pipeline.schedule(driver.stages()) == [set()] * len(driver.stages())
+
+
+def test_shards_are_balanced_runs_of_a_chromosome():
+    chromCounts = {"1": 50, "2": 20, "X": 10, "MT": 1}
+    share, owners = pipeline.shardPlan(chromCounts, 3)
+
+    assert share == 27
+    loads = {}
+    for chrom, count in chromCounts.items():
+        assert len(owners[chrom]) == (count + share - 1) // share
+        for k in range(count):
+            shard = owners[chrom][k // share]
+            loads[shard] = loads.get(shard, 0) + 1
+
+    assert sorted(loads) == [0, 1, 2]
+    assert max(loads.values()) - min(loads.values()) <= share
+
+
+def test_no_more_shards_than_pieces():
+    share, owners = pipeline.shardPlan({"1": 3}, 8)
+
+    assert share == 1
+    assert owners == {"1": [0, 1, 2]}
+
+
+def test_empty_input():
+    assert pipeline.shardPlan({}, 4) == (1, {})
+
+
+def test_counts_are_added_up():
+    stages = [Stage((), ()), Stage((), ())]
+    pipeline.mergeCounts(stages, [{"hits": 2, "misses": 3}, {}])
+
+    assert stages[0].counts == {"hits": 3, "misses": 3}
+    assert stages[1].counts == {"hits": 1}
+
+
+### EOF
@@ -0,0 +1,66 @@
+# test_planner.py
+#
+# The planner's row counts against the table, and the stats file that
+# keeps them across jobs
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import json
+
+import planner
+import utils as u
+
+
+def countRows(cursor, stats=None):
+    planner.rowCounts.clear()
+    return planner.tableRows(
+        cursor, "cytoBand", "chrom", "chromStart", "chromEnd", stats=stats
+    )
+
+
+def test_table_rows(referenceDb):
+    conn = u.db_connect()
+    try:
+        counts = countRows(conn.cursor())
+    finally:
+        conn.close()
+
+    # 13 bands of 250 on each chromosome, the last ending past LENGTH
+    assert counts == dict((chrom, (13, 0, 3250)) for chrom in ["chr1", "chr2", "chrX"])
+
+
+class NoCursor(object):
+    def execute(self, *args):
+        raise AssertionError("the table was counted again")
+
+
+def test_stats_keep_the_counts(referenceDb, tmp_path):
+    path = str(tmp_path / "table_stats.json")
+    conn = u.db_connect()
+    try:
+        counts = countRows(conn.cursor(), planner.TableStats(path, "1"))
+    finally:
+        conn.close()
+
+    # A later job of the same version reads them from the file
+    assert countRows(NoCursor(), planner.TableStats(path, "1")) == counts
+
+    # A new version counts again and drops the counts of the old one
+    stats = planner.TableStats(path, "2")
+    assert stats.get("\t".join(["rows", "cytoBand"])) is None
+    stats.put("name", {"chr1": (1, 2, 3)})
+    with open(path) as fh:
+        assert list(json.load(fh)) == ["2"]
+
+
+def test_stats_file_may_be_missing_or_broken(tmp_path):
+    path = tmp_path / "table_stats.json"
+    assert planner.TableStats(str(path), "1").counts == {}
+    path.write_text("{")
+    assert planner.TableStats(str(path), "1").counts == {}
+
+
+### EOF
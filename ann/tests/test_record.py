@@ -0,0 +1,130 @@
+# test_record.py
+#
+# Binary record files and the INFO column of a record
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import hashlib
+
+import pytest
+
+import record
+import utils as u
+from record import Info, RecordReader, RecordWriter
+
+ITEMS = [
+    "##fileformat=VCFv4.1",
+    "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO",
+    ["1", "100", ".", "A", "G", "50", "PASS", "DP=10", "GT", "0/1"],
+    ["1", "250", "rs1", "C", "T", "50", "PASS", "AC=1;AN=2"],
+    ["chrX", "7", ".", "G", "A", "", "", ""],
+    # Positions that are not compact int32s keep all columns as strings
+    ["2", "3000000000", ".", "T", "C", "50", "PASS", "."],
+    ["2", "0100", ".", "T", "C", "50", "PASS", "."],
+    ["MT", "pos", ".", "T", "C", "50", "PASS", "."],
+    ["1", "5", ".", "A", "éß", "50", "PASS", "note=✓"],
+    "",
+    ["1", "6"],
+]
+
+
+def asText(item):
+    if isinstance(item, str):
+        return item
+    return [str(column) for column in item]
+
+
+def test_records_round_trip(tmp_path):
+    path = str(tmp_path / "stage.rec")
+    with RecordWriter(path) as writer:
+        for item in ITEMS:
+            writer.write(item)
+
+    with RecordReader(path) as reader:
+        items = list(reader)
+
+    assert [asText(item) for item in items] == ITEMS
+    # The INFO column comes back ready for the stages
+    assert isinstance(items[2][record.INFO], Info)
+    assert isinstance(items[-1], list)
+
+
+def test_checksum_covers_the_file(tmp_path):
+    path = str(tmp_path / "stage.rec")
+    with RecordWriter(path) as writer:
+        for item in ITEMS:
+            writer.write(item)
+
+    with open(path, "rb") as fh:
+        assert writer.checksum() == hashlib.sha256(fh.read()).hexdigest()
+
+
+def test_reader_rejects_other_files(tmp_path):
+    path = tmp_path / "other.rec"
+    path.write_bytes(b"not a record file")
+
+    with pytest.raises(ValueError):
+        RecordReader(str(path))
+
+
+def test_reader_rejects_truncated_files(tmp_path):
+    path = str(tmp_path / "stage.rec")
+    with RecordWriter(path) as writer:
+        for item in ITEMS:
+            writer.write(item)
+    with open(path, "rb") as fh:
+        data = fh.read()
+    with open(path, "wb") as fh:
+        fh.write(data[:-3])
+
+    with pytest.raises(ValueError):
+        with RecordReader(path) as reader:
+            list(reader)
+
+
+def test_split_and_join_round_trip():
+    line = "1\t100\t.\tA\tG\t50\tPASS\tDP=10\tGT\t0/1"
+    fields = record.split(line)
+
+    assert isinstance(fields[record.INFO], Info)
+    assert record.join(fields) == line
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "DP=10;AC=1;AN=2",
+        "AC=1;AN=2;ACX=5",
+        "XAC=3;AC=1",
+        "AC=1=2;AN=",
+        "positionType=Exonic;name2=G13",
+        "",
+        " DP=10 ; AC=1 ",
+    ],
+)
+@pytest.mark.parametrize("key", ["AC", "AN", "DP", "X", "positionType"])
+def test_info_get_matches_parse_field(text, key):
+    assert Info(text).get(key) == u.parse_field(text, key, ";", "=")
+
+
+# parse_field fails on a flag (a name without a value) matching the key;
+# get passes over it
+def test_info_get_skips_flags():
+    assert Info("AC;AN=2;XAC=3").get("AC") == "3"
+    assert Info(".").get("AC") == "."
+
+
+def test_info_get_sees_appended_fragments():
+    info = Info("DP=10")
+    assert info.get("GMAF") == "."
+
+    info.append("GMAF=0.2")
+
+    assert str(info) == "DP=10;GMAF=0.2"
+    assert info.get("GMAF") == "0.2"
+
+
+### EOF
@@ -0,0 +1,338 @@
+# test_scheduler.py
+#
+# The job slots of the annotator, the heartbeat of their requests, the
+# share of free slots each tier is allotted and the backlog ordering
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+from concurrent.futures import Future
+
+import annotator_scheduler as sched
+from annotator_scheduler import Backlog, Heartbeat, JobSlots, Tier, TierScheduler
+
+
+# Stands in for the subprocess.Popen of a run.py
+class Process(object):
+    def __init__(self):
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+
+def makeSlots(slots):
+    finished = []
+    jobSlots = JobSlots(
+        slots, lambda job_id, message, ok: finished.append((job_id, message, ok))
+    )
+    return jobSlots, finished
+
+
+def test_slots_are_held_until_the_job_is_done():
+    slots, finished = makeSlots(2)
+    process = Process()
+    slots.add("a", process, "message a")
+
+    assert slots.free() == 1
+    assert slots.messages() == ["message a"]
+
+    process.returncode = 0
+    assert slots.free() == 2
+    assert slots.messages() == []
+    assert finished == [("a", "message a", True)]
+
+
+def test_free_is_never_negative():
+    slots, finished = makeSlots(1)
+    slots.add("a", Process())
+    slots.add("b", Process())
+
+    assert slots.free() == 0
+    assert slots.messages() == []
+
+
+def test_process_success_is_its_exit_status():
+    slots, finished = makeSlots(2)
+    ok, failed = Process(), Process()
+    slots.add("ok", ok, "m1")
+    slots.add("failed", failed, "m2")
+    ok.returncode = 0
+    failed.returncode = 1
+
+    slots.reap()
+    assert sorted(finished) == [("failed", "m2", False), ("ok", "m1", True)]
+
+
+def test_future_success_is_its_result():
+    slots, finished = makeSlots(4)
+    futures = dict((name, Future()) for name in ["ok", "false", "raised", "running"])
+    for name, future in futures.items():
+        slots.add(name, future, name)
+    futures["ok"].set_result(True)
+    futures["false"].set_result(False)
+    futures["raised"].set_exception(OSError("lost"))
+
+    assert slots.free() == 3
+    assert sorted(finished) == [
+        ("false", "false", False),
+        ("ok", "ok", True),
+        ("raised", "raised", False),
+    ]
+    assert slots.messages() == ["running"]
+
+
+def test_wait_returns_once_a_slot_frees(monkeypatch):
+    slots, finished = makeSlots(1)
+    process = Process()
+    slots.add("a", process)
+
+    def sleep(seconds):
+        process.returncode = 0
+
+    monkeypatch.setattr("annotator_scheduler.time.sleep", sleep)
+    assert slots.wait() == 1
+
+
+
+# A beat lets go of finished jobs before it extends the requests of the
+# jobs still running, so that their requests are not kept hidden
+def test_heartbeat_extends_running_jobs():
+    slots, finished = makeSlots(3)
+    running, done = Process(), Process()
+    slots.add("running", running, "message running")
+    slots.add("done", done, "message done")
+    slots.add("no message", Process())
+    done.returncode = 0
+
+    extended = []
+    Heartbeat(slots, extended.append, 60).beat()
+
+    assert extended == ["message running"]
+    assert finished == [("done", "message done", True)]
+
+
+
+# Stands in for the time module of annotator_scheduler
+class Clock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def makeScheduler():
+    tiers = [Tier("premium", None, 3), Tier("free", None, 1)]
+    return TierScheduler(tiers, max_wait=120)
+
+
+def allotted(allotment):
+    return [(tier.name, count) for tier, count in allotment]
+
+
+def test_allot_shares_slots_by_weight():
+    scheduler = makeScheduler()
+
+    assert allotted(scheduler.allot(4)) == [("premium", 3), ("free", 1)]
+
+
+def test_allot_single_slots_follow_the_weights():
+    scheduler = makeScheduler()
+    counts = {"premium": 0, "free": 0}
+    for i in range(8):
+        for name, count in allotted(scheduler.allot(1)):
+            counts[name] = counts[name] + count
+
+    assert counts == {"premium": 6, "free": 2}
+
+
+def test_allot_serves_starved_tier_first():
+    scheduler = makeScheduler()
+    scheduler.tiers[1].last_latency = 300
+
+    assert allotted(scheduler.allot(1)) == [("free", 1), ("premium", 0)]
+
+    scheduler = makeScheduler()
+    scheduler.tiers[1].last_latency = 300
+
+    assert allotted(scheduler.allot(4)) == [("free", 2), ("premium", 2)]
+
+
+def test_allot_lists_every_tier():
+    scheduler = makeScheduler()
+
+    assert allotted(scheduler.allot(0)) == [("premium", 0), ("free", 0)]
+
+
+# Stands in for the queues: receive hands out up to count of the send
+# times queued for a tier and notes each poll
+class Queues(object):
+    def __init__(self, **queued):
+        self.queued = queued
+        self.polls = []
+
+    def receive(self, tier, count, wait):
+        self.polls.append((tier.name, count, wait))
+        got = self.queued[tier.name][:count]
+        self.queued[tier.name] = self.queued[tier.name][count:]
+        return [(f"{tier.name} {sent}", sent) for sent in got]
+
+
+def received(requests):
+    return [(tier.name, message) for tier, message in requests]
+
+
+def test_receive_passes_unused_slots_on(monkeypatch):
+    monkeypatch.setattr(sched, "time", Clock(1000.0))
+    scheduler = makeScheduler()
+    queues = Queues(premium=[990.0], free=[980.0, 970.0, 960.0])
+
+    requests = scheduler.receive(4, queues.receive, 20)
+
+    assert received(requests) == [
+        ("premium", "premium 990.0"),
+        ("free", "free 980.0"),
+        ("free", "free 970.0"),
+        ("free", "free 960.0"),
+    ]
+    assert queues.polls == [("premium", 3, 0), ("free", 3, 0)]
+    assert scheduler.tiers[1].latencies == [20.0, 30.0, 40.0]
+    assert scheduler.tiers[1].last_latency == 40.0
+
+
+# A short poll returning less than asked may have missed requests; the
+# tier stays starved until one is received or a long poll finds none
+def test_short_poll_keeps_the_latency(monkeypatch):
+    monkeypatch.setattr(sched, "time", Clock(1000.0))
+    scheduler = makeScheduler()
+    scheduler.tiers[1].last_latency = 300
+    queues = Queues(premium=[990.0], free=[])
+
+    assert received(scheduler.receive(2, queues.receive, 20)) == [
+        ("premium", "premium 990.0")
+    ]
+    assert scheduler.tiers[1].last_latency == 300
+    assert queues.polls[0] == ("free", 1, 0)
+
+
+def test_empty_long_poll_clears_the_latency(monkeypatch):
+    monkeypatch.setattr(sched, "time", Clock(1000.0))
+    scheduler = makeScheduler()
+    scheduler.tiers[0].last_latency = 200
+    scheduler.tiers[1].last_latency = 300
+    queues = Queues(premium=[], free=[])
+
+    assert scheduler.receive(2, queues.receive, 20) == []
+    assert [tier.last_latency for tier in scheduler.tiers] == [0.0, 0.0]
+    assert queues.polls[-2:] == [("free", 2, 10), ("premium", 2, 10)]
+
+
+def test_long_poll_stops_at_the_first_request(monkeypatch):
+    monkeypatch.setattr(sched, "time", Clock(1000.0))
+    scheduler = makeScheduler()
+    scheduler.tiers[1].last_latency = 50
+    queues = Queues(premium=[], free=[])
+
+    def receive(tier, count, wait):
+        if wait > 0:
+            queues.queued["premium"] = [999.0]
+        return queues.receive(tier, count, wait)
+
+    assert received(scheduler.receive(1, receive, 20)) == [
+        ("premium", "premium 999.0")
+    ]
+    assert queues.polls[-1] == ("premium", 1, 10)
+    # The free queue was not long-polled, so its latency stands
+    assert scheduler.tiers[1].last_latency == 50
+
+
+
+def makeBacklog(monkeypatch, half_life=100, max_wait=0):
+    clock = Clock()
+    monkeypatch.setattr(sched, "time", clock)
+    return Backlog(half_life, max_wait), clock
+
+
+def test_backlog_starts_smallest_first(monkeypatch):
+    backlog, clock = makeBacklog(monkeypatch)
+    backlog.add("large", {"job_id": "large"}, 5000)
+    backlog.add("small", {"job_id": "small"}, 10)
+    backlog.add("medium", {"job_id": "medium"}, 300)
+
+    assert len(backlog) == 3
+    assert sorted(backlog.messages()) == ["large", "medium", "small"]
+    assert [backlog.pop()[0] for i in range(3)] == ["small", "medium", "large"]
+    assert len(backlog) == 0
+
+
+def test_backlog_unknown_size_counts_as_zero(monkeypatch):
+    backlog, clock = makeBacklog(monkeypatch)
+    backlog.add("sized", {}, 10)
+    backlog.add("unknown", {}, None)
+
+    assert backlog.pop() == ("unknown", {})
+
+
+def test_backlog_ties_go_to_the_oldest(monkeypatch):
+    backlog, clock = makeBacklog(monkeypatch)
+    backlog.add("newer", {}, 0)
+    clock.now = clock.now - 1
+    backlog.add("older", {}, 0)
+
+    assert backlog.pop()[0] == "older"
+
+
+def test_backlog_ages_waiting_requests(monkeypatch):
+    backlog, clock = makeBacklog(monkeypatch, half_life=100)
+    backlog.add("large", {}, 1000)
+    clock.now = clock.now + 500
+    backlog.add("small", {}, 50)
+
+    # Five half-lives bring the large input down to 1000 / 32 < 50
+    assert backlog.pop()[0] == "large"
+    assert backlog.pop()[0] == "small"
+
+
+def test_backlog_expires_requests_held_too_long(monkeypatch):
+    backlog, clock = makeBacklog(monkeypatch, max_wait=60)
+    backlog.add("old", {}, 10)
+    clock.now = clock.now + 30
+    backlog.add("new", {}, 20)
+
+    assert backlog.expire() == []
+    clock.now = clock.now + 31
+    assert backlog.expire() == ["old"]
+    assert backlog.messages() == ["new"]
+
+
+def test_backlog_without_max_wait_keeps_requests(monkeypatch):
+    backlog, clock = makeBacklog(monkeypatch)
+    backlog.add("old", {}, 10)
+    clock.now = clock.now + 10**6
+
+    assert backlog.expire() == []
+    assert len(backlog) == 1
+
+
+# Requests held too long are released to the queue instead of hidden
+# again, so that the backpressure of the slots holds
+def test_heartbeat_releases_expired_requests(monkeypatch):
+    backlog, clock = makeBacklog(monkeypatch, max_wait=60)
+    backlog.add("old", {}, 10)
+    clock.now = clock.now + 61
+    backlog.add("new", {}, 20)
+    slots, finished = makeSlots(1)
+    slots.add("running", Process(), "message running")
+
+    extended, released = [], []
+    Heartbeat(slots, extended.append, 60, backlog, released.append).beat()
+
+    assert extended == ["message running", "new"]
+    assert released == ["old"]
+    assert backlog.messages() == ["new"]
+
+
+### EOF
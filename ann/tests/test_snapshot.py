@@ -0,0 +1,78 @@
+# test_snapshot.py
+#
+# Rows of the memory-mapped reference snapshot against the database
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import json
+import os
+from decimal import Decimal
+
+import pytest
+
+import snapshot as snap
+import utils as u
+
+
+def test_rows_round_trip():
+    row = (None, "chr1", "", "éß", 0, -7, 2**40, 1.5, Decimal("0.125"), b"1,2,", True)
+    packed = snap.packRow(row)
+
+    assert snap.unpackRow(memoryview(packed)) == row
+    assert type(snap.unpackRow(packed)[-1]) is bool
+
+
+def test_snapshot_matches_database(snapshotPath):
+    reference = snap.Snapshot(snapshotPath)
+    assert reference.version == "test"
+
+    conn = u.db_connect()
+    try:
+        cursor = conn.cursor()
+        for table in ["cytoBand", "refGene", "dbSNP", "chrom_pos_unequal"]:
+            chromColumn, startName, endName = snap.TABLES[table]
+            u.execute(cursor, "select * from " + table + ";")
+            names = [d[0] for d in cursor.description]
+            rows = cursor.fetchall()
+            chrom = names.index(chromColumn)
+            start = names.index(startName)
+            end = names.index(endName)
+
+            snapshotTable = reference.table(table)
+            for row in rows[:50]:
+                expected = tuple(
+                    other
+                    for other in rows
+                    if other[chrom] == row[chrom]
+                    and other[start] <= row[start]
+                    and other[end] >= row[start]
+                )
+                found = snapshotTable.query(str(row[chrom]), row[start])
+                assert found == expected
+    finally:
+        conn.close()
+
+
+def test_unknown_chromosome_and_table(snapshotPath):
+    reference = snap.Snapshot(snapshotPath)
+
+    assert reference.table("cytoBand").query("chr22", 100) == ()
+    with pytest.raises(KeyError):
+        reference.table("noSuchTable")
+
+
+def test_other_format_is_refused(snapshotPath, tmp_path):
+    with open(os.path.join(snapshotPath, snap.MANIFEST)) as fh:
+        manifest = json.load(fh)
+    manifest["format"] = snap.FORMAT + 1
+    with open(str(tmp_path / snap.MANIFEST), "w") as fh:
+        json.dump(manifest, fh)
+
+    with pytest.raises(ValueError):
+        snap.Snapshot(str(tmp_path))
+
+
+### EOF
@@ -0,0 +1,244 @@
+# test_utils.py
+#
+# The in-memory interval index against a plain scan of its intervals
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import random
+
+import pytest
+
+import utils as u
+from utils import ConnectionPool, DbSnpIndex, IntervalIndex, PackedStrings
+
+
+def scan(intervals, start, end):
+    return tuple(
+        row
+        for row, (first, last) in enumerate(intervals)
+        if first <= end and last >= start
+    )
+
+
+def test_index_matches_scan():
+    rng = random.Random(3)
+    intervals = []
+    for i in range(500):
+        first = rng.randint(0, 5000)
+        intervals.append((first, first + rng.choice([0, 1, 10, 300, 2000])))
+
+    index = IntervalIndex()
+    index.add(
+        "chr1",
+        [first for first, last in intervals],
+        [last for first, last in intervals],
+        range(len(intervals)),
+    )
+
+    for i in range(300):
+        start = rng.randint(-10, 7500)
+        end = start + rng.choice([0, 0, 5, 500])
+        assert index.queryRange("chr1", start, end) == scan(intervals, start, end)
+        assert index.query("chr1", start) == scan(intervals, start, start)
+
+
+def test_index_bounds_are_inclusive():
+    index = IntervalIndex()
+    index.add("1", [10, 20], [15, 20], ["a", "b"])
+
+    assert index.query("1", 9) == ()
+    assert index.query("1", 10) == ("a",)
+    assert index.query("1", 15) == ("a",)
+    assert index.query("1", 16) == ()
+    assert index.query("1", 20) == ("b",)
+    assert index.queryRange("1", 15, 20) == ("a", "b")
+
+
+def test_rows_come_back_in_the_order_added():
+    index = IntervalIndex()
+    index.add("1", [50, 10, 30], [60, 100, 40], ["late", "wide", "middle"])
+
+    assert index.query("1", 35) == ("wide", "middle")
+    assert index.query("1", 55) == ("late", "wide")
+
+
+def test_unknown_chromosome():
+    index = IntervalIndex()
+    index.add("1", [10], [20], ["a"])
+
+    assert "1" in index
+    assert "2" not in index
+    assert index.query("2", 15) == ()
+    assert len(index.overlapIds("2", 0, 100)) == 0
+
+
+def test_load_from_table(referenceDb):
+    conn = u.db_connect()
+    try:
+        cursor = conn.cursor()
+        index = u.loadIntervalIndex(cursor, "cytoBand")
+        u.execute(cursor, "select * from cytoBand where chrom = %s;", ("chr1",))
+        rows = cursor.fetchall()
+    finally:
+        conn.close()
+
+    for pos in [0, 1, 250, 251, 2999]:
+        expected = tuple(row for row in rows if row[1] <= pos and row[2] >= pos)
+        assert index.query("chr1", pos) == expected
+
+
+
+def test_packed_strings():
+    values = ["rs1", "", "éß", "rs22"]
+    packed = PackedStrings(values, [3, 0, 2, 1])
+
+    assert len(packed) == 4
+    assert [packed[j] for j in range(4)] == ["rs22", "rs1", "éß", ""]
+
+
+def test_dbsnp_probe_matches_scan():
+    rng = random.Random(5)
+    rows = [
+        (
+            rng.randint(1, 200),
+            rng.choice("ACGT"),
+            rng.choice(["SNV", "DIV"]),
+            f"rs{i}",
+            rng.choice([".", "0.1"]),
+        )
+        for i in range(400)
+    ]
+    index = DbSnpIndex()
+    index.add("1", *[[row[k] for row in rows] for k in range(5)])
+
+    complement = {"A": "T", "C": "G", "G": "C", "T": "A"}
+    positions = [rng.randint(0, 210) for i in range(100)]
+    refs = [rng.choice("ACGT") for i in range(100)]
+    compRefs = [complement[ref] for ref in refs]
+    hits = index.probe("1", positions, refs, compRefs, "SNV")
+
+    for pos, ref, compRef, found in zip(positions, refs, compRefs, hits):
+        expected = tuple(
+            (rsid, gmaf)
+            for position, dbRef, info, rsid, gmaf in rows
+            if position == pos and dbRef in (ref, compRef) and info == "SNV"
+        )
+        assert found == expected
+    assert index.probe("2", positions, refs, compRefs, "SNV") == [()] * 100
+
+
+
+class FakeConnection(object):
+    def __init__(self, healthy=True):
+        self.healthy = healthy
+        self.closed = False
+
+    def rollback(self):
+        pass
+
+    def ping(self, reconnect=False):
+        if not self.healthy:
+            raise OSError("gone away")
+
+    def close(self):
+        self.closed = True
+
+
+def makePool(**kwargs):
+    opened = []
+
+    def connect():
+        opened.append(FakeConnection())
+        return opened[-1]
+
+    return ConnectionPool(connect=connect, **kwargs), opened
+
+
+def test_pool_reuses_connections():
+    pool, opened = makePool(size=2, overflow=0)
+    conn = pool.acquire()
+    pool.release(conn)
+
+    assert pool.acquire() is conn
+    assert len(opened) == 1
+
+
+def test_pool_closes_connections_beyond_its_size():
+    pool, opened = makePool(size=1, overflow=1)
+    first, second = pool.acquire(), pool.acquire()
+    pool.release(first)
+    pool.release(second)
+
+    assert not first.closed
+    assert second.closed
+    assert pool.opened == 1
+
+
+def test_pool_waits_for_a_free_connection():
+    pool, opened = makePool(size=1, overflow=0, timeout=0.05)
+    pool.acquire()
+
+    with pytest.raises(TimeoutError):
+        pool.acquire()
+
+
+def test_pool_replaces_dropped_connections():
+    pool, opened = makePool(size=1, overflow=0, ping_interval=-1)
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.healthy = False
+
+    replacement = pool.acquire()
+    assert replacement is not conn
+    assert conn.closed
+    assert pool.opened == 1
+
+
+def test_pool_counts_failed_connects():
+    def connect():
+        raise OSError("refused")
+
+    pool = ConnectionPool(connect=connect, size=1, overflow=0)
+    for i in range(2):
+        with pytest.raises(OSError):
+            pool.acquire()
+    assert pool.opened == 0
+
+
+
+# One statement per chunk finds, for each probe, the rows a point query
+# finds, also over a chunk boundary
+def test_probe_rows_match_point_queries(referenceDb):
+    conn = u.db_connect()
+    try:
+        cursor = conn.cursor()
+        probes = [
+            ("chr" + chrom, pos)
+            for chrom in ["1", "X", "5"]
+            for pos in range(1, 3000, 31)
+        ]
+        assert len(probes) > u.PROBE_CHUNK
+
+        matches = u.probeRows(
+            cursor,
+            "cytoBand",
+            ["chrom", "pos"],
+            probes,
+            "t.chrom = p.chrom AND t.chromStart <= p.pos AND p.pos <= t.chromEnd",
+        )
+        for (chrom, pos), rows in zip(probes, matches):
+            u.execute(
+                cursor,
+                "select * from cytoBand where chrom = %s"
+                + " AND chromStart <= %s AND %s <= chromEnd;",
+                (chrom, pos, pos),
+            )
+            assert sorted(rows) == sorted(tuple(row) for row in cursor.fetchall())
+    finally:
+        conn.close()
+
+
+### EOF
@@ -13,41 +13,348 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import os
 import json
+import time
+import sqlite3
+import threading
+import numpy as np
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
+"""Credentials of the reference database, from AWS Secrets Manager
+   The secret is cached for CREDENTIAL_TTL seconds so that opening a
+   connection does not cost a Secrets Manager call; pass refresh=True
+   to fetch it again (e.g. after the secret was rotated)
+"""
+
+CREDENTIAL_TTL = 3600
+
+_credentials = None
+_credentialsTime = 0
+_credentialsLock = threading.Lock()
+
+
+def getDbCredentials(refresh=False):
+    global _credentials, _credentialsTime
+
+    with _credentialsLock:
+        if (
+            not refresh
+            and _credentials is not None
+            and time.time() - _credentialsTime < CREDENTIAL_TTL
+        ):
+            return _credentials
+
+        AWS_REGION_NAME = (
+            os.environ["AWS_REGION_NAME"]
+            if ("AWS_REGION_NAME" in os.environ)
+            else "us-east-1"
+        )
+
+        # Get RDS secret from AWS Secrets Manager
+        asm = boto3.client("secretsmanager", region_name=AWS_REGION_NAME)
+        try:
+            asm_response = asm.get_secret_value(SecretId="rds/anntools_database")
+            rds_secret = json.loads(asm_response["SecretString"])
+        except ClientError as e:
+            print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+            raise e
+
+        _credentials = rds_secret
+        _credentialsTime = time.time()
+        return _credentials
+
+
 """Get connection to reference database
+   For testing, ANNTOOLS_SQLITE_DB names an SQLite file to use instead,
+   and ANNTOOLS_MYSQL_HOST (with ANNTOOLS_MYSQL_PORT, _USER and
+   _PASSWORD) a local MySQL server; otherwise the RDS credentials are
+   taken from Secrets Manager
 """
 
+ER_ACCESS_DENIED = 1045
+
 
 def db_connect():
-    AWS_REGION_NAME = (
-        os.environ["AWS_REGION_NAME"]
-        if ("AWS_REGION_NAME" in os.environ)
-        else "us-east-1"
-    )
+    if "ANNTOOLS_SQLITE_DB" in os.environ:
+        return sqlite3.connect(
+            os.environ["ANNTOOLS_SQLITE_DB"], check_same_thread=False
+        )
 
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client("secretsmanager", region_name=AWS_REGION_NAME)
-    try:
-        asm_response = asm.get_secret_value(SecretId="rds/anntools_database")
-        rds_secret = json.loads(asm_response["SecretString"])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
-
-    # Extract database connection parameters
-    rds_host = rds_secret["host"]
-    mysql_port = rds_secret["port"]
-    username = rds_secret["username"]
-    password = rds_secret["password"]
     database_name = "annotator"
 
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host, port=mysql_port, user=username, passwd=password, db=database_name
-    )
+    if "ANNTOOLS_MYSQL_HOST" in os.environ:
+        return pymysql.connect(
+            host=os.environ["ANNTOOLS_MYSQL_HOST"],
+            port=int(os.environ.get("ANNTOOLS_MYSQL_PORT", 3306)),
+            user=os.environ.get("ANNTOOLS_MYSQL_USER", "root"),
+            passwd=os.environ.get("ANNTOOLS_MYSQL_PASSWORD", ""),
+            db=database_name,
+        )
+
+    for refresh in [False, True]:
+        rds_secret = getDbCredentials(refresh=refresh)
+
+        # Extract database connection parameters
+        rds_host = rds_secret["host"]
+        mysql_port = rds_secret["port"]
+        username = rds_secret["username"]
+        password = rds_secret["password"]
+
+        # Return a connection to the database
+        try:
+            return pymysql.connect(
+                host=rds_host,
+                port=mysql_port,
+                user=username,
+                passwd=password,
+                db=database_name,
+            )
+        except pymysql.err.OperationalError as e:
+            # Access denied with cached credentials: the secret may
+            # have been rotated, so fetch it again once
+            if refresh or e.args[0] != ER_ACCESS_DENIED:
+                raise e
+
+
+"""Process-wide pool of reference database connections
+
+   Every stage of every job run by this process borrows its connection
+   here instead of opening its own. Up to size idle connections are kept
+   for reuse; at most size + overflow are open at once, and acquire waits
+   up to timeout seconds for one to be released. A connection that has
+   been idle for more than ping_interval seconds is checked before it is
+   handed out and replaced if the server dropped it.
+"""
+
+
+class ConnectionPool(object):
+    def __init__(
+        self, connect=None, size=16, overflow=16, timeout=60, ping_interval=30
+    ):
+        self.connect = connect if connect is not None else db_connect
+        self.size = size
+        self.overflow = overflow
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+
+        # (connection, time it was released), most recent last
+        self.idle = []
+        self.opened = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        deadline = time.time() + self.timeout
+        with self.condition:
+            while len(self.idle) == 0 and self.opened >= self.size + self.overflow:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        f"No database connection free after {self.timeout} seconds"
+                    )
+                self.condition.wait(remaining)
+
+            conn = None
+            if len(self.idle) > 0:
+                conn, released = self.idle.pop()
+            else:
+                self.opened = self.opened + 1
+
+        if conn is not None and time.time() - released > self.ping_interval:
+            if not isHealthy(conn):
+                closeQuietly(conn)
+                conn = None
+
+        if conn is None:
+            try:
+                conn = self.connect()
+            except Exception:
+                self.discard(None)
+                raise
+        return conn
+
+    def release(self, conn):
+        try:
+            # Do not carry a read snapshot over to the next borrower
+            conn.rollback()
+        except Exception:
+            self.discard(conn)
+            return
+
+        with self.condition:
+            if len(self.idle) < self.size:
+                self.idle.append((conn, time.time()))
+                conn = None
+            else:
+                self.opened = self.opened - 1
+            self.condition.notify()
+
+        if conn is not None:
+            closeQuietly(conn)
+
+    # Drop a broken connection (or a failed attempt to open one)
+    def discard(self, conn):
+        if conn is not None:
+            closeQuietly(conn)
+        with self.condition:
+            self.opened = self.opened - 1
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            idle = self.idle
+            self.idle = []
+            self.opened = self.opened - len(idle)
+        for conn, released in idle:
+            closeQuietly(conn)
+
+
+def isHealthy(conn):
+    try:
+        if hasattr(conn, "ping"):
+            conn.ping(reconnect=False)
+        else:
+            conn.execute("select 1;")
+        return True
+    except Exception:
+        return False
+
+
+def closeQuietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+_pool = None
+_poolLock = threading.Lock()
+
+
+"""The process-wide connection pool, created on first use
+"""
+
+
+def getPool():
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+
+
+"""Forget the pool inherited from the parent in a forked worker process
+   The parent's connections are left alone: closing them here would
+   close the parent's sockets
+"""
+
+
+def resetPool():
+    global _pool
+    with _poolLock:
+        if _pool is not None:
+            _pool = ConnectionPool(
+                connect=_pool.connect,
+                size=_pool.size,
+                overflow=_pool.overflow,
+                timeout=_pool.timeout,
+                ping_interval=_pool.ping_interval,
+            )
+
+
+"""Replace the process-wide pool, e.g. with sizes from the configuration
+"""
+
+
+def configurePool(
+    size=16, overflow=16, timeout=60, ping_interval=30, credential_ttl=None
+):
+    global _pool, CREDENTIAL_TTL
+    if credential_ttl is not None:
+        CREDENTIAL_TTL = credential_ttl
+
+    with _poolLock:
+        old = _pool
+        _pool = ConnectionPool(
+            size=size, overflow=overflow, timeout=timeout, ping_interval=ping_interval
+        )
+    if old is not None:
+        old.close()
+    return _pool
+
+
+"""Run a parameterized statement; placeholders are written %s
+   SQLite stand-ins (see db_connect) take ? instead
+"""
+
+
+def execute(cursor, sql, args=()):
+    if isinstance(cursor, sqlite3.Cursor):
+        sql = sql.replace("%s", "?")
+    cursor.execute(sql, args)
+    return cursor
+
+
+"""Names of the columns of table, in order
+"""
+
+
+def tableColumns(cursor, table):
+    execute(cursor, "select * from " + table + " limit 0;").fetchall()
+    return [d[0] for d in cursor.description]
+
+
+"""Look up many probes with one statement per chunk
+
+   The probes (tuples of values named by columns) are sent as a derived
+   table p, joined against the reference table t on condition, which
+   refers to both, e.g. "t.chromStart <= p.pos AND p.pos <= t.chromEnd".
+   args fill the placeholders of condition. Chunks are padded to a power
+   of two, so that only a few distinct statements are ever sent.
+   Returns the rows of t matching each probe, in the order the database
+   returned them.
+"""
+
+# Keeps a chunk within the parameter and compound SELECT limits of SQLite
+PROBE_CHUNK = 128
+
+
+def probeRows(cursor, table, columns, probes, condition, args=(), select="t.*"):
+    matches = [[] for _ in probes]
+    for first in range(0, len(probes), PROBE_CHUNK):
+        chunk = list(probes[first : first + PROBE_CHUNK])
+        size = 1
+        while size < len(chunk):
+            size = size * 2
+        # Padding repeats the last probe; its rows are dropped below
+        chunk = chunk + [chunk[-1]] * (size - len(chunk))
+
+        derived = " union all ".join(
+            ["select %s as probe, " + ", ".join("%s as " + c for c in columns)]
+            + ["select %s, " + ", ".join("%s" for c in columns)] * (size - 1)
+        )
+        sql = (
+            "select p.probe, "
+            + select
+            + " from ("
+            + derived
+            + ") as p join "
+            + table
+            + " as t on "
+            + condition
+            + ";"
+        )
+        params = []
+        for i, probe in enumerate(chunk):
+            params.append(first + i)
+            params.extend(probe)
+        execute(cursor, sql, params + list(args))
+
+        for row in cursor.fetchall():
+            i = int(row[0])
+            if i < len(probes):
+                matches[i].append(tuple(row[1:]))
+    return matches
 
 
 """Column inices for pileup and VCF
@@ -111,6 +418,232 @@ def isBetween(testStart, refStart, refEnd):
         return False
 
 
+"""Sort intervals by start for an IntervalIndex
+   Returns int32 starts, ends, running maximum of ends and the original
+   row number of each interval
+"""
+
+
+def sortIntervals(starts, ends):
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    order = np.argsort(starts, kind="stable")
+    starts = starts[order]
+    ends = ends[order]
+
+    if len(ends) > 0:
+        maxends = np.maximum.accumulate(ends)
+    else:
+        maxends = ends
+
+    return (
+        starts.astype(np.int32),
+        ends.astype(np.int32),
+        maxends.astype(np.int32),
+        order.astype(np.int32),
+    )
+
+
+"""In-memory interval index keyed by chromosome
+
+   The intervals of each chromosome are held in compact NumPy arrays
+   sorted by start, next to a running maximum of the ends. A query finds
+   the candidate slice with two binary searches (everything past it
+   starts too late, everything before it ends too early) and filters
+   the slice in one vectorised comparison. Rows come back in the order
+   they were added, like a point query against the database.
+"""
+
+
+class IntervalIndex(object):
+    def __init__(self):
+        # chrom -> (starts, ends, maxends, order) sorted by start
+        self.arrays = {}
+        # chrom -> rows in the order they were added
+        self.rows = {}
+
+    def add(self, chrom, starts, ends, rows):
+        starts, ends, maxends, order = sortIntervals(starts, ends)
+        self.addSorted(chrom, starts, ends, maxends, order, list(rows))
+
+    # Arrays as returned by sortIntervals, e.g. memory-mapped from a
+    # snapshot; rows is anything indexable by the original row number
+    def addSorted(self, chrom, starts, ends, maxends, order, rows):
+        self.arrays[chrom] = (starts, ends, maxends, order)
+        self.rows[chrom] = rows
+
+    def __contains__(self, chrom):
+        return chrom in self.arrays
+
+    def overlapIds(self, chrom, start, end):
+        if chrom not in self.arrays:
+            return np.empty(0, dtype=np.int32)
+
+        starts, ends, maxends, order = self.arrays[chrom]
+        first = np.searchsorted(maxends, start, side="left")
+        last = np.searchsorted(starts, end, side="right")
+        if first >= last:
+            return np.empty(0, dtype=np.int32)
+
+        hits = order[first:last][ends[first:last] >= start]
+        hits.sort()
+        return hits
+
+    # All rows overlapping the position
+    def query(self, chrom, pos):
+        return self.queryRange(chrom, pos, pos)
+
+    # All rows overlapping [start, end]
+    def queryRange(self, chrom, start, end):
+        rows = self.rows.get(chrom, [])
+        return tuple(rows[i] for i in self.overlapIds(chrom, start, end))
+
+
+"""Build an interval index from an annotator table
+   Works for any table with a chromosome column and an interval, e.g.
+   cytoBand, the CNV tables, genomicSuperDups, targetScanS, cpgIslandExt
+   (chromStart/chromEnd) or refGene transcript spans (txStart/txEnd).
+   Loads the whole table unless chrom is given. columns selects the
+   columns kept for each row (all of them by default); they must include
+   the chromosome and interval columns.
+"""
+
+
+def loadIntervalIndex(
+    cursor,
+    table,
+    chromColumn="chrom",
+    startName="chromStart",
+    endName="chromEnd",
+    chrom=None,
+    index=None,
+    columns="*",
+):
+    if index is None:
+        index = IntervalIndex()
+
+    sql = "select " + columns + " from " + table
+    args = ()
+    if chrom is not None:
+        sql = sql + " where " + chromColumn + " = %s"
+        args = (str(chrom),)
+    rows = execute(cursor, sql + ";", args).fetchall()
+
+    names = [d[0] for d in cursor.description]
+    chromIndex = names.index(chromColumn)
+    startIndex = names.index(startName)
+    endIndex = names.index(endName)
+
+    byChrom = {}
+    if chrom is not None:
+        byChrom[chrom] = list(rows)
+    else:
+        for row in rows:
+            byChrom.setdefault(str(row[chromIndex]), []).append(row)
+
+    for c, chromRows in byChrom.items():
+        index.add(
+            c,
+            [int(row[startIndex]) for row in chromRows],
+            [int(row[endIndex]) for row in chromRows],
+            chromRows,
+        )
+    return index
+
+
+"""Strings packed end to end as UTF-8, with an array of their offsets
+   Costs the bytes of the strings plus eight per string; a string is
+   decoded only when it is read
+"""
+
+
+class PackedStrings(object):
+    def __init__(self, values, order):
+        data = [str(values[j]).encode("utf-8") for j in order]
+        self.offsets = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in data], out=self.offsets[1:])
+        self.data = b"".join(data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, j):
+        return self.data[self.offsets[j] : self.offsets[j + 1]].decode("utf-8")
+
+
+"""In-memory dbSNP index keyed by chromosome
+
+   Each chromosome holds a sorted uint32 array of positions next to
+   packed REF, INFO, rsID and GMAF columns (PackedStrings) in the same
+   order. A batch of variants is probed with one pair of searchsorted
+   calls; only the few rows at the position of a variant are decoded and
+   matched on REF (either strand) and INFO. Hits come back in the order
+   they were added, like the SELECT on dbSNP.
+"""
+
+
+class DbSnpIndex(object):
+    def __init__(self):
+        # chrom -> (positions, refs, infos, rsids, gmafs) sorted by position
+        self.columns = {}
+
+    def add(self, chrom, positions, refs, infos, rsids, gmafs):
+        positions = np.asarray(positions, dtype=np.uint32)
+        order = np.argsort(positions, kind="stable")
+        self.columns[chrom] = (positions[order],) + tuple(
+            PackedStrings(column, order) for column in [refs, infos, rsids, gmafs]
+        )
+
+    def __contains__(self, chrom):
+        return chrom in self.columns
+
+    # For each variant, the (rsID, GMAF) of every matching row
+    def probe(self, chrom, positions, refs, compRefs, varclass):
+        hits = [() for _ in positions]
+        if chrom not in self.columns or len(positions) == 0:
+            return hits
+
+        sortedPositions, dbRefs, dbInfos, rsids, gmafs = self.columns[chrom]
+        positions = np.asarray(positions, dtype=np.uint32)
+        first = np.searchsorted(sortedPositions, positions, side="left")
+        last = np.searchsorted(sortedPositions, positions, side="right")
+
+        for i in np.flatnonzero(last > first):
+            hits[i] = tuple(
+                (rsids[j], gmafs[j])
+                for j in range(first[i], last[i])
+                if dbRefs[j] in (refs[i], compRefs[i]) and dbInfos[j] == varclass
+            )
+        return hits
+
+
+"""Load the dbSNP rows of one chromosome into a DbSnpIndex
+   rsID and GMAF are the fourth and eighth columns of dbSNP
+"""
+
+
+def loadDbSnpIndex(cursor, chrom, index=None, table="dbSNP"):
+    if index is None:
+        index = DbSnpIndex()
+
+    sql = "select * from " + table + " where CHR = %s;"
+    rows = execute(cursor, sql, (str(chrom),)).fetchall()
+    names = [d[0] for d in cursor.description]
+    posIndex = names.index("POS")
+    refIndex = names.index("REF")
+    infoIndex = names.index("INFO")
+
+    index.add(
+        chrom,
+        [int(row[posIndex]) for row in rows],
+        [str(row[refIndex]) for row in rows],
+        [str(row[infoIndex]) for row in rows],
+        [str(row[3]) for row in rows],
+        [str(row[7]) for row in rows],
+    )
+    return index
+
+
 """Helper method to deduplicate the list
 """
 
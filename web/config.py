@@ -153,12 +153,22 @@ class Config(object):
     AWS_SNS_JOB_REQUEST_TOPIC = (
         f"arn:aws:sns:us-east-1:127134666975:{iam_username}_a16_job_requests" 
     )
+    # Requests of premium users go to a topic (and queue) of their own,
+    # which the annotator serves ahead of the free tier by weight. Only
+    # turn this on once the annotators poll the premium queue (its
+    # PremiumQueueUrl is set); until then all requests go to
+    # AWS_SNS_JOB_REQUEST_TOPIC
+    AWS_SNS_PREMIUM_QUEUE_ENABLED = False
+    AWS_SNS_JOB_REQUEST_TOPIC_PREMIUM = (
+        f"arn:aws:sns:us-east-1:127134666975:{iam_username}_a16_job_requests_premium"
+    )
     # a16 new edited
     AWS_SNS_JOB_REQUEST_TOPIC_THAW = (
         f"arn:aws:sns:us-east-1:127134666975:{iam_username}_a16_job_thaw" 
     )
     # AWS SQS queues
     AWS_SQS_REQUESTS_QUEUE_NAME = f"https://sqs.us-east-1.amazonaws.com/127134666975/{iam_username}_a16_job_requests"
+    AWS_SQS_REQUESTS_QUEUE_NAME_PREMIUM = f"https://sqs.us-east-1.amazonaws.com/127134666975/{iam_username}_a16_job_requests_premium"
 
     # AWS DynamoDB table
     AWS_DYNAMODB_ANNOTATIONS_TABLE = f"{iam_username}_annotations"
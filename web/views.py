@@ -144,14 +144,25 @@ def create_annotation_job_request():
         "submit_time": int(time.time()),
         "job_status": "PENDING"
     }
+
+    # Size of the input, so that the annotator can start small jobs first
+    try:
+        head = s3.head_object(Bucket=bucket_name, Key=s3_key)
+        data["input_file_size"] = int(head["ContentLength"])
+    except (BotoCoreError, ClientError) as e:
+        print(f"Error reading the size of {s3_key}: {e}")
+
     try: 
         annotations_table.put_item(Item=data)
         print("data: ", data)
     except (BotoCoreError, ClientError, ParamValidationError) as e:
         return jsonify(code=500, message="Error putting item into DynamoDB: " + str(e))
 
-    # Send message to request queue
+    # Send message to the request queue of the user's tier
     sns_topic_arn = app.config["AWS_SNS_JOB_REQUEST_TOPIC"]
+    if (app.config["AWS_SNS_PREMIUM_QUEUE_ENABLED"]
+            and session.get("role") == "premium_user"):
+        sns_topic_arn = app.config["AWS_SNS_JOB_REQUEST_TOPIC_PREMIUM"]
     try:
         topic = sns.Topic(arn=sns_topic_arn)
         topic.publish(